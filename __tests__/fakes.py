@@ -0,0 +1,34 @@
+import zlib
+
+import numpy as np
+
+
+class BagOfWordsModel:
+    """Deterministic stand-in for the sentence model: each word lights up one dimension."""
+
+    def __init__(self):
+        self.calls = []
+
+    def encode(self, text, batch_size=32, **kwargs):
+        self.calls.append(text)
+        if isinstance(text, (list, tuple)):
+            return np.stack([self.encode_one(t) for t in text]) if text else np.zeros((0, 768), dtype='float32')
+        return self.encode_one(text)
+
+    @staticmethod
+    def encode_one(text):
+        vector = np.zeros(768, dtype='float32')
+        for word in text.split():
+            vector[zlib.crc32(word.encode()) % 768] += 1
+        return vector
+
+
+class RecordingOutputHandler:
+    def __init__(self):
+        self.messages = []
+
+    async def send_output(self, message, message_type=None):
+        self.messages.append((message, message_type))
+
+    def queue_output(self, message, message_type=None):
+        self.messages.append((message, message_type))
@@ -0,0 +1,44 @@
+import json
+
+import pytest
+
+from chat_history.chat_entry import ChatEntry
+from chat_history.history_log import HistoryLog
+from __tests__.fakes import RecordingOutputHandler
+
+
+def test_entries_round_trip_the_saved_schema():
+    """Test that a saved entry converts to a ChatEntry and back unchanged, sharing its role and timestamp."""
+    saved = [{"id": str(number), "role": ''.join('user'), "content": f"message {number}",
+              "timestamp": "2024-05-01 12:30:00", "created": "2024-05-01 12:30:00",
+              "updated": "2024-05-01 12:31:00", "vector_index": str(number) if number else ''}
+             for number in range(2)]
+
+    entries = [ChatEntry.from_dict(entry) for entry in saved]
+
+    assert [entry.to_dict() for entry in entries] == saved
+    assert [dict(entry) for entry in entries] == saved
+    assert entries[0].role is entries[1].role
+    assert entries[0].created is entries[0].timestamp and entries[0].updated != entries[0].timestamp
+    assert [entry.vector_id for entry in entries] == [None, 1]
+    entries[0]['vector_index'] = '7'
+    assert entries[0].vector_id == 7 and entries[0]['vector_index'] == '7'
+
+
+@pytest.mark.asyncio
+async def test_logged_entries_are_saved_in_the_existing_schema(tmp_path):
+    """Test that the window holds ChatEntry records and the file and database get the same fields as before."""
+    log = HistoryLog(RecordingOutputHandler(), db_name=str(tmp_path / 'chat_db'),
+                     file_name=str(tmp_path / 'chat_history.jsonl'))
+    await log.init_db()
+    logged = await log.log_entry('assistant', "hello", vector_index='3')
+    await log.flush()
+    with open(log.history_file) as file:
+        record = json.loads(file.readline())
+    from_db = await log.get_by_vector_indices([3])
+    await log.close()
+
+    assert isinstance(log.history[0], ChatEntry)
+    assert record == logged.to_dict()
+    assert record['vector_index'] == '3' and len(record['timestamp']) == len("2024-05-01 12:30:00")
+    assert from_db == [logged]
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from chat_history.embedding_cache import EmbeddingCache
+from chat_history.vector_storage import VectorStorageBase
+from __tests__.fakes import BagOfWordsModel
+
+
+@pytest.mark.asyncio
+async def test_text_is_encoded_once_for_storage_and_retrieval():
+    """Test that retrieving with text that was just stored reuses its embedding."""
+    model = BagOfWordsModel()
+    storage = VectorStorageBase(vector_model=model, vector_file=None)
+
+    storage.save_vector({'content': 'where is the key'}, 'content')
+    indices, _ = await storage.retrieve_vectors_async('where is the key', 1)
+    await storage.encode_async(['History saved.', 'History saved.', 'where is the key'])
+    await storage.close()
+
+    assert indices == [1]
+    assert model.calls == [['where is the key'], ['History saved.']]
+    assert storage.embedding_cache.stats == {'hits': 2, 'disk_hits': 0, 'misses': 3}
+    assert storage.embedding_cache.hit_rate == 0.4
+
+
+def test_disk_tier_survives_restart_and_reuses_slots(tmp_path):
+    """Test that embeddings on disk are found by a new cache, and the oldest slot is reused when full."""
+    path = str(tmp_path / 'embeddings')
+    cache = EmbeddingCache('model-a', max_entries=1, disk_path=path, disk_capacity=2, dimension=768)
+    for text in ['first text', 'second text', 'third text']:
+        cache.put(text, BagOfWordsModel.encode_one(text))
+    cache.close()
+
+    reopened = EmbeddingCache('model-a', disk_path=path, disk_capacity=2, dimension=768)
+    assert reopened.get('first text') is None
+    assert np.array_equal(reopened.get('second text'), BagOfWordsModel.encode_one('second text'))
+    assert np.array_equal(reopened.get('third text'), BagOfWordsModel.encode_one('third text'))
+    assert reopened.stats['disk_hits'] == 2
+    assert EmbeddingCache('model-b', disk_path=path, disk_capacity=2).get('third text') is None
+
+
+@pytest.mark.asyncio
+async def test_async_encodes_write_the_disk_tier_in_batches(tmp_path):
+    """Test that an async encode queues its new embeddings and writes them in one batch off the event loop."""
+    path = str(tmp_path / 'embeddings')
+    cache = EmbeddingCache('model-a', disk_path=path, disk_capacity=8, dimension=768)
+    batches = []
+    write_to_disk = cache.write_to_disk
+    cache.write_to_disk = lambda pending: batches.append(list(pending)) or write_to_disk(pending)
+
+    async def encode(texts):
+        return np.stack([BagOfWordsModel.encode_one(text) for text in texts])
+
+    await cache.encode(['first text', 'second text', 'first text'], encode)
+    await cache.encode(['first text'], encode)
+    cache.close()
+
+    reopened = EmbeddingCache('model-a', disk_path=path, disk_capacity=8, dimension=768)
+    assert batches == [[cache.key_for('first text'), cache.key_for('second text')], []]
+    assert np.array_equal(reopened.get('second text'), BagOfWordsModel.encode_one('second text'))
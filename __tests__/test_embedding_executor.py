@@ -0,0 +1,52 @@
+import time
+import asyncio
+
+import numpy as np
+import pytest
+
+from chat_history.embedding_executor import EmbeddingExecutor
+from chat_history.vector_storage import VectorStorageBase
+from __tests__.fakes import BagOfWordsModel
+
+
+class SlowModel(BagOfWordsModel):
+    def encode(self, text, batch_size=32, **kwargs):
+        time.sleep(0.05)  # Blocks whichever thread it runs on
+        return super().encode(text, batch_size=batch_size, **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_encodes_are_coalesced_into_one_batch():
+    """Test that requests arriving together are encoded in one model call and split back out."""
+    model = BagOfWordsModel()
+    executor = EmbeddingExecutor(model, batch_window=0.01)
+    texts = ['first text here', 'second text here', 'third text here']
+
+    single, pair = await asyncio.gather(executor.encode(texts[0]), executor.encode(texts[1:]))
+    executor.shutdown()
+
+    assert model.calls == [texts]
+    assert np.array_equal(single, BagOfWordsModel.encode_one(texts[0]))
+    assert pair.shape == (2, 768)
+    assert np.array_equal(pair[1], BagOfWordsModel.encode_one(texts[2]))
+
+
+@pytest.mark.asyncio
+async def test_retrieval_does_not_block_the_event_loop():
+    """Test that the loop keeps running while a query is encoded and searched."""
+    storage = VectorStorageBase(vector_model=SlowModel(), vector_file=None)
+    storage.add_vectors(np.stack([BagOfWordsModel.encode_one(text) for text in ['a cat', 'a dog']]))
+    ticks = []
+
+    async def tick():
+        while True:
+            ticks.append(time.perf_counter())
+            await asyncio.sleep(0.005)
+
+    ticker = asyncio.get_running_loop().create_task(tick())
+    indices, _ = await storage.retrieve_vectors_async('a dog', 1)
+    ticker.cancel()
+    await storage.close()
+
+    assert indices == [2]
+    assert len(ticks) > 3
@@ -0,0 +1,149 @@
+import sqlite3
+
+import pytest
+
+from chat_history.history_log import HistoryLog
+from chat_history.jsonl_writer import JsonlWriter, segment_paths
+from __tests__.fakes import RecordingOutputHandler
+
+
+@pytest.mark.asyncio
+async def test_get_by_vector_indices_reads_only_matched_rows_in_order(tmp_path):
+    """Test that entries come back in the order of the vector ids, skipping unknown ids."""
+    log = HistoryLog(RecordingOutputHandler(), db_name=str(tmp_path / 'chat_db'),
+                     file_name=str(tmp_path / 'chat_history.jsonl'))
+    await log.init_db()
+    for number in range(1, 6):
+        await log.log_entry('user', f"message {number}", vector_index=str(number))
+    await log.flush()
+
+    entries = await log.get_by_vector_indices([4, 99, 2])
+    await log.connection.close()
+
+    assert [entry['content'] for entry in entries] == ['message 4', 'message 2']
+
+
+@pytest.mark.asyncio
+async def test_only_a_window_is_loaded_and_older_entries_are_paged_in(tmp_path):
+    """Test that a restart holds only the recent window, and paging back reaches every entry once."""
+    log = HistoryLog(RecordingOutputHandler(), db_name=str(tmp_path / 'chat_db'),
+                     file_name=str(tmp_path / 'chat_history.jsonl'), window=3)
+    await log.init_db()
+    for number in range(10):
+        await log.log_entry('user', f"message {number}", vector_index=str(number) if number % 2 else '')
+    await log.close()
+
+    log = HistoryLog(RecordingOutputHandler(), db_name=str(tmp_path / 'chat_db'),
+                     file_name=str(tmp_path / 'chat_history.jsonl'), window=3)
+    await log.init()
+    window = [entry['content'] for entry in log.history]
+    pages, before = [], None
+    while True:
+        entries, before = await log.entries_before(before, limit=4)
+        pages.append([entry['content'] for entry in entries])
+        if before is None:
+            break
+    unvectorized = [entry['content'] async for entry in log.iter_entries(page_size=2, unvectorized_only=True)]
+    await log.connection.close()
+
+    assert window == ['message 7', 'message 8', 'message 9']
+    assert [len(page) for page in pages] == [4, 4, 2]
+    assert sum(reversed(pages), []) == [f"message {number}" for number in range(10)]
+    assert unvectorized == [f"message {number}" for number in range(0, 10, 2)]
+
+
+@pytest.mark.asyncio
+async def test_entries_logged_together_are_committed_together(tmp_path):
+    """Test that a turn's entries share one transaction and are all written by close."""
+    log = HistoryLog(RecordingOutputHandler(), db_name=str(tmp_path / 'chat_db'),
+                     file_name=str(tmp_path / 'chat_history.jsonl'), durability='turn', flush_interval=60)
+    await log.init_db()
+    batches = []
+    write_entries = log.write_entries
+    log.write_entries = lambda entries: batches.append(len(entries)) or write_entries(entries)
+    for role in ('user', 'assistant', 'system'):
+        await log.log_entry(role, f"{role} message")
+    await log.end_turn()
+    await log.log_entry('user', "logged just before shutdown")
+    async with log.connection.execute("PRAGMA journal_mode") as cursor:
+        journal_mode = (await cursor.fetchone())[0]
+    await log.close()
+
+    log = HistoryLog(RecordingOutputHandler(), db_name=str(tmp_path / 'chat_db'),
+                     file_name=str(tmp_path / 'chat_history.jsonl'))
+    await log.init()
+    await log.close()
+
+    assert batches == [3, 1]
+    assert journal_mode == 'wal'
+    assert [entry['content'] for entry in log.history][-1] == "logged just before shutdown"
+    assert len(log.history) == 4
+
+
+@pytest.mark.asyncio
+async def test_archived_entries_leave_the_table_but_stay_retrievable(tmp_path):
+    """Test that archiving fills compressed segments, and lookups by id and vector id still find the entries."""
+    writer = JsonlWriter(max_segment_bytes=600)
+    log = HistoryLog(RecordingOutputHandler(), db_name=str(tmp_path / 'chat_db'),
+                     file_name=str(tmp_path / 'chat_history.jsonl'), log_writer=writer,
+                     archive_dir=str(tmp_path / 'archive'), segment_size=4)
+    await log.init_db()
+    for number in range(1, 11):
+        await log.log_entry('user', f"message {number}", vector_index=str(number))
+        await log.flush()  # A write per entry, so the file rotates between them
+    file_segments = len(segment_paths(log.history_file))
+
+    archived = await log.archive_entries(keep_count=3)
+    hot, _ = await log.entries_before(limit=100)
+    by_id = await log.get_by_id(log.history[0]['id'])
+    by_vector = await log.get_by_vector_indices([9, 2, 5])
+    await log.close()
+    await writer.close()
+
+    assert archived == 7
+    assert [entry['content'] for entry in hot] == ['message 8', 'message 9', 'message 10']
+    assert [segment['count'] for segment in log.archive.manifest] == [4, 3]
+    assert log.archive.manifest[0]['min_vector_id'] == 1 and log.archive.manifest[1]['max_vector_id'] == 7
+    assert by_id['content'] == 'message 1'
+    assert [entry['content'] for entry in by_vector] == ['message 9', 'message 2', 'message 5']
+    assert len(segment_paths(log.history_file)) < file_segments
+
+
+@pytest.mark.asyncio
+async def test_sessions_sharing_a_database_only_see_their_own_entries(tmp_path):
+    """Test that rows from before sessions join the default one, and sessions page, search and look up apart."""
+    with sqlite3.connect(tmp_path / 'chat_db') as connection:
+        connection.execute("CREATE TABLE chat_history (id VARCHAR(36) PRIMARY KEY, role VARCHAR(10), content TEXT, "
+                           "timestamp TIMESTAMP, created TIMESTAMP, updated TIMESTAMP, vector_index TEXT)")
+        connection.execute("INSERT INTO chat_history VALUES ('old', 'user', 'apples from before', "
+                           "'2024-01-01 00:00:00', '2024-01-01 00:00:00', '2024-01-01 00:00:00', '1')")
+    logs = {session_id: HistoryLog(RecordingOutputHandler(), db_name=str(tmp_path / 'chat_db'),
+                                   file_name=str(tmp_path / 'chat_history.jsonl'),
+                                   archive_dir=str(tmp_path / 'archive'), session_id=session_id)
+            for session_id in ('default', 'other')}
+    for log in logs.values():
+        await log.init()
+    for number in range(1, 4):
+        await logs['other'].log_entry('user', f"apples {number}", vector_index=str(number))
+    await logs['other'].flush()
+    await logs['other'].load_history()
+
+    default_window = [entry['content'] for entry in logs['default'].history]
+    other_window = [entry['content'] for entry in logs['other'].history]
+    by_vector = {session_id: [entry['content'] for entry in await log.get_by_vector_indices([1])]
+                 for session_id, log in logs.items()}
+    found = {session_id: len(await log.search_text("apples")) for session_id, log in logs.items()}
+    async with logs['other'].connection.execute(
+            "EXPLAIN QUERY PLAN SELECT rowid FROM chat_history WHERE session_id = ? "
+            "ORDER BY timestamp DESC, rowid DESC LIMIT 5", ('other',)) as cursor:
+        plan = ' '.join(row[-1] for row in await cursor.fetchall())
+    for log in logs.values():
+        await log.close()
+
+    assert default_window == ['apples from before']
+    assert other_window == ['apples 1', 'apples 2', 'apples 3']
+    assert by_vector == {'default': ['apples from before'], 'other': ['apples 1']}
+    assert found == {'default': 1, 'other': 3}
+    assert 'chat_history_session_timestamp' in plan and 'TEMP B-TREE' not in plan
+    assert logs['other'].history_file == str(tmp_path / 'sessions' / 'other' / 'chat_history.jsonl')
+    assert logs['other'].archive.directory == str(tmp_path / 'sessions' / 'other' / 'archive')
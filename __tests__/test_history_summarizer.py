@@ -0,0 +1,47 @@
+import pytest
+
+from chat_history.history_log import HistoryLog
+from chat_history.history_summarizer import HistorySummarizer
+from __tests__.fakes import RecordingOutputHandler
+
+
+@pytest.mark.asyncio
+async def test_older_spans_are_summarized_and_condensed_into_levels(tmp_path):
+    """Test that full spans before the recent entries are summarized, and full runs of summaries condensed."""
+    log = HistoryLog(RecordingOutputHandler(), db_name=str(tmp_path / 'chat_db'),
+                     file_name=str(tmp_path / 'chat_history.jsonl'))
+    await log.init_db()
+    calls = []
+
+    async def summarize(lines):
+        calls.append(lines)
+        return f"summary of {len(lines)} lines starting {lines[0]}"
+
+    summarizer = HistorySummarizer(log, summarize, span=10, fanout=4, keep_recent=10)
+    await summarizer.init_db()
+    for number in range(65):
+        await log.log_entry('user', f"message {number}")
+
+    written = await summarizer.run()
+    again = await summarizer.run()
+    summaries = await summarizer.summaries()
+    await log.close()
+
+    assert written == 6 and again == 0
+    assert [(summary['level'], summary['entry_count']) for summary in summaries] == [(1, 40), (0, 10)]
+    assert calls[0][0] == "user: message 0" and calls[4][0] == "user: message 40"
+    assert summaries[0]['content'] == "summary of 4 lines starting summary of 10 lines starting user: message 0"
+
+
+@pytest.mark.asyncio
+async def test_unopened_database_leaves_no_summaries(tmp_path):
+    """Test that a chat log whose database failed to open makes init_db a no-op rather than an error."""
+    log = HistoryLog(RecordingOutputHandler(), db_name=str(tmp_path / 'missing' / 'chat_db'),
+                     file_name=str(tmp_path / 'chat_history.jsonl'))
+    await log.init_db()
+    summarizer = HistorySummarizer(log)
+
+    await summarizer.init_db()
+
+    assert log.connection is None
+    assert await summarizer.summaries() == []
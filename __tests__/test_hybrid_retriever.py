@@ -0,0 +1,113 @@
+import pytest
+
+from chat_history.history_log import HistoryLog
+from chat_history.hybrid_retriever import HybridRetriever
+from chat_history.vector_storage import VectorStorageBase
+from __tests__.fakes import BagOfWordsModel, RecordingOutputHandler
+
+MESSAGES = [
+    "the dragon sleeps under the mountain",
+    "error code E1234 in the forge",
+    "a dragon was seen near the village",
+    "we bought bread at the market",
+]
+ROLES = ['user', 'system', 'assistant', 'user']
+
+
+async def make_history(tmp_path):
+    log = HistoryLog(RecordingOutputHandler(), db_name=str(tmp_path / 'chat_db'),
+                     file_name=str(tmp_path / 'chat_history.jsonl'), archive_dir=str(tmp_path / 'archive'))
+    await log.init_db()
+    storage = VectorStorageBase(vector_model=BagOfWordsModel(), vector_file=None)
+    for role, message in zip(ROLES, MESSAGES):
+        vector_id = storage.add_vectors(BagOfWordsModel.encode_one(message).reshape(1, -1))
+        await log.log_entry(role, message, vector_index=str(vector_id))
+    await log.flush()
+    return log, storage
+
+
+@pytest.mark.asyncio
+async def test_text_search_finds_exact_identifiers(tmp_path):
+    """Test that the full text index is filled by the insert trigger and ranks by BM25."""
+    log, storage = await make_history(tmp_path)
+
+    entries = await log.search_text('what does E1234 mean?')
+    await log.connection.close()
+    await storage.close()
+
+    assert [entry['content'] for entry in entries] == [MESSAGES[1]]
+
+
+@pytest.mark.asyncio
+async def test_hybrid_fuses_both_rankings_and_falls_back_to_text(tmp_path):
+    """Test that entries found by both searches come first, and lexical-only skips the model."""
+    log, storage = await make_history(tmp_path)
+    retriever = HybridRetriever(log, storage)
+    storage.vector_model.calls.clear()
+
+    hybrid = await retriever.retrieve('dragon mountain', n=2)
+    lexical = await retriever.retrieve('dragon mountain', n=2, lexical_only=True)
+    calls = list(storage.vector_model.calls)
+    await log.connection.close()
+    await storage.close()
+
+    assert [entry['content'] for entry in hybrid] == [MESSAGES[0], MESSAGES[2]]
+    assert [entry['content'] for entry in lexical] == [MESSAGES[0], MESSAGES[2]]
+    assert calls == [['dragon mountain']]
+
+
+@pytest.mark.asyncio
+async def test_filters_are_applied_inside_both_searches(tmp_path):
+    """Test that a role filter drops excluded rows from both rankings without losing allowed ones."""
+    log, storage = await make_history(tmp_path)
+    retriever = HybridRetriever(log, storage)
+
+    entries = await retriever.retrieve('error code E1234', n=3, roles=['user', 'assistant'])
+    future = await retriever.retrieve('dragon', n=3, since='9999-01-01 00:00:00')
+    await log.connection.close()
+    await storage.close()
+
+    assert [entry['role'] for entry in entries] == ['user', 'assistant', 'user']
+    assert MESSAGES[1] not in [entry['content'] for entry in entries]
+    assert future == []
+
+
+@pytest.mark.asyncio
+async def test_filter_mask_follows_writes_after_it_is_loaded(tmp_path):
+    """Test that entries written or vectorized after the first filtered search are filtered without a reload."""
+    log, storage = await make_history(tmp_path)
+
+    before = await log.vector_id_mask(roles=['user'])
+    await log.log_entry('user', 'the dragon returned', vector_index='5')
+    unvectorized = await log.log_entry('assistant', 'it flew away')
+    await log.flush()
+    await log.update_vector_indices([('6', unvectorized['id'])])
+    users = await log.vector_id_mask(roles=['user'])
+    assistants = await log.vector_id_mask(roles=['assistant'])
+    await log.connection.close()
+    await storage.close()
+
+    assert list(before.nonzero()[0]) == [1, 4]
+    assert list(users.nonzero()[0]) == [1, 4, 5]
+    assert list(assistants.nonzero()[0]) == [3, 6]
+
+
+@pytest.mark.asyncio
+async def test_role_filter_reaches_archived_entries(tmp_path):
+    """Test that archived entries stay in filtered vector searches, including ones archived without their role."""
+    log, storage = await make_history(tmp_path)
+    assert await log.archive_entries(keep_count=1) == 3
+    # As archived before the table kept roles and timestamps
+    await log.connection.execute(f"UPDATE {log.table_name}_archived SET role = NULL, timestamp = NULL")
+    await log.connection.commit()
+    await log.connection.close()
+
+    reopened = HistoryLog(RecordingOutputHandler(), db_name=log.db_name, file_name=str(tmp_path / 'chat_history.jsonl'),
+                          archive_dir=str(tmp_path / 'archive'))
+    await reopened.init_db()
+    entries = await HybridRetriever(reopened, storage).retrieve('dragon', n=3, roles=['user', 'assistant'])
+    await reopened.connection.close()
+    await storage.close()
+
+    assert {entry['content'] for entry in entries[:2]} == {MESSAGES[0], MESSAGES[2]}
+    assert MESSAGES[1] not in [entry['content'] for entry in entries]
@@ -0,0 +1,51 @@
+from ai_implementation import IncrementalJsonParser
+
+
+def feed_all(parser, chunks):
+    fields = []
+    for chunk in chunks:
+        fields.extend(parser.feed(chunk))
+    return fields
+
+
+def test_fenced_jsonl_emits_each_line():
+    """Test that fences are skipped and each jsonl line is emitted."""
+    text = ('```jsonl\n'
+            '{"CurrentState": {"newValue": "talking"}}\n'
+            '{"TinyNextStepOptions": ["ask", "listen"]}\n'
+            '```')
+    parser = IncrementalJsonParser()
+
+    assert feed_all(parser, [text]) == [
+        ("CurrentState", {"newValue": "talking"}),
+        ("TinyNextStepOptions", ["ask", "listen"]),
+    ]
+    assert parser.close() == []
+
+
+def test_keys_are_emitted_as_soon_as_complete():
+    """Test that a key in a multi-line object is emitted before the object closes."""
+    parser = IncrementalJsonParser()
+
+    assert parser.feed('{\n  "CurrentState": {"newValue": "a, {b}"') == []
+    assert parser.feed('},\n  "Evidence') == [("CurrentState", {"newValue": "a, {b}"})]
+    assert parser.feed('Needed": ["more \\"quotes\\""]\n}') == [("EvidenceNeeded", ['more "quotes"'])]
+
+
+def test_chunk_boundaries_do_not_matter():
+    """Test that splitting the stream one character at a time gives the same result."""
+    text = '{"A": {"x": [1, 2]}, "B": "}"}\n{"C": null}'
+    parser = IncrementalJsonParser()
+
+    assert feed_all(parser, list(text)) == [("A", {"x": [1, 2]}), ("B", "}"), ("C", None)]
+
+
+def test_truncated_tail_is_reported_not_parsed():
+    """Test that completed keys survive and an unfinished one is reported on close."""
+    parser = IncrementalJsonParser()
+
+    fields = feed_all(parser, ['{"CurrentState": {"newValue": "done"}}\n', '{"TinyNextStepOptions": ["half'])
+
+    assert fields == [("CurrentState", {"newValue": "done"})]
+    errors = parser.close()
+    assert len(errors) == 1 and "truncated" in errors[0]
@@ -0,0 +1,24 @@
+import os
+
+import pytest
+
+from chat_history.jsonl_writer import JsonlWriter, read_records, segment_paths
+
+
+@pytest.mark.asyncio
+async def test_records_rotate_into_segments_and_read_back_in_order(tmp_path):
+    """Test that a file past the size limit rotates and reading returns every record in order."""
+    path = str(tmp_path / 'history.jsonl')
+    writer = JsonlWriter(max_segment_bytes=200, fsync='batch')
+    records = [{'id': number, 'content': 'x' * 40} for number in range(12)]
+    for record in records:
+        writer.append(path, [record])
+        record['content'] = 'changed after append'
+    await writer.flush()
+    stats = dict(writer.stats)
+    await writer.close()
+
+    assert stats['rotations'] >= 2 and stats['fsyncs'] >= 1
+    assert len(segment_paths(path)) == stats['rotations'] + 1
+    assert all(os.path.getsize(segment) <= 200 for segment in segment_paths(path))
+    assert list(read_records(path)) == [{'id': number, 'content': 'x' * 40} for number in range(12)]
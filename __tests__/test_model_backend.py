@@ -0,0 +1,100 @@
+import pytest
+
+from model_backend import OllamaHttpBackend, FallbackBackend, ModelBackend, ModelBackendUnavailable
+from model_stub_server import StubModelServer
+
+
+class ListBackend(ModelBackend):
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    async def stream(self, prompt, is_jsonl=False, context_window=8192, priority=0):
+        for chunk in self.chunks:
+            yield chunk
+
+
+async def collect(backend, prompt, **kwargs):
+    return [chunk async for chunk in backend.stream(prompt, **kwargs)]
+
+
+@pytest.mark.asyncio
+async def test_http_backend_streams_chunks():
+    """Test that chunks from the server arrive in order."""
+    async with StubModelServer(responder=lambda body: ["Hello", " there"]) as server:
+        backend = OllamaHttpBackend("test-model", base_url=server.base_url)
+        try:
+            chunks = await collect(backend, "hi")
+        finally:
+            await backend.close()
+
+    assert chunks == ["Hello", " there"]
+
+
+@pytest.mark.asyncio
+async def test_http_backend_sends_prompt_in_body_and_reuses_connection():
+    """Test that large prompts go in the request body over one pooled connection."""
+    prompt = "x" * 500_000  # Far past what fits in argv
+    async with StubModelServer() as server:
+        backend = OllamaHttpBackend("test-model", base_url=server.base_url)
+        try:
+            await collect(backend, prompt, context_window=4096)
+            await collect(backend, "second", is_jsonl=True)
+        finally:
+            await backend.close()
+
+    assert server.connection_count == 1
+    assert server.requests[0]["prompt"] == prompt
+    assert server.requests[0]["options"]["num_ctx"] == 4096
+    assert server.requests[1]["format"] == "json"
+
+
+@pytest.mark.asyncio
+async def test_http_backend_unreachable_raises():
+    """Test that an unreachable server raises ModelBackendUnavailable."""
+    async with StubModelServer() as server:
+        base_url = server.base_url
+    backend = OllamaHttpBackend("test-model", base_url=base_url)
+    with pytest.raises(ModelBackendUnavailable):
+        await collect(backend, "hi")
+    await backend.close()
+
+
+@pytest.mark.asyncio
+async def test_fallback_backend_switches_when_primary_unavailable():
+    """Test that the fallback is used once the primary cannot be reached."""
+    async with StubModelServer() as server:
+        base_url = server.base_url
+    fallen_back = []
+
+    async def on_fallback(error):
+        fallen_back.append(error)
+
+    backend = FallbackBackend(OllamaHttpBackend("test-model", base_url=base_url),
+                              ListBackend(["from", " fallback"]), on_fallback=on_fallback)
+    assert await collect(backend, "hi") == ["from", " fallback"]
+    assert await collect(backend, "hi") == ["from", " fallback"]
+    assert len(fallen_back) == 1
+    await backend.close()
+
+
+@pytest.mark.asyncio
+async def test_fallback_backend_retries_primary_after_cooldown():
+    """Test that the primary is used again once it recovers and the cooldown has passed."""
+    now = [0.0]
+    server = StubModelServer(responder=lambda body: ["from", " primary"])
+    await server.start()
+    base_url = server.base_url
+    await server.stop()
+
+    backend = FallbackBackend(OllamaHttpBackend("test-model", base_url=base_url),
+                              ListBackend(["from", " fallback"]), retry_after=10, clock=lambda: now[0])
+    assert await collect(backend, "hi") == ["from", " fallback"]
+
+    await server.start()  # The server comes back on the same port
+    now[0] = 5
+    assert await collect(backend, "hi") == ["from", " fallback"]
+    now[0] = 11
+    assert await collect(backend, "hi") == ["from", " primary"]
+    assert not backend.use_fallback
+    await backend.close()
+    await server.stop()
@@ -0,0 +1,102 @@
+import asyncio
+
+import pytest
+
+from model_backend import ModelBackend, RequestPriority
+from model_scheduler import ModelRequestScheduler, ModelRequestTimeout
+
+
+class GatedBackend(ModelBackend):
+    """Records the order prompts start in and holds each stream open until released."""
+
+    def __init__(self):
+        self.started = []
+        self.running = 0
+        self.peak = 0
+        self.gate = asyncio.Event()
+
+    async def stream(self, prompt, is_jsonl=False, context_window=8192, priority=RequestPriority.QUICK):
+        self.started.append(prompt)
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        try:
+            await self.gate.wait()
+            yield prompt
+        finally:
+            self.running -= 1
+
+
+async def consume(scheduler, prompt, session_id, **kwargs):
+    return [chunk async for chunk in scheduler.stream(prompt, session_id, **kwargs)]
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+@pytest.mark.asyncio
+async def test_concurrency_is_bounded():
+    """Test that no more than max_concurrency streams run at once."""
+    backend = GatedBackend()
+    scheduler = ModelRequestScheduler(backend, max_concurrency=2)
+    tasks = [asyncio.create_task(consume(scheduler, f"p{i}", f"s{i}")) for i in range(5)]
+    await settle()
+
+    assert backend.running == 2
+    assert scheduler.metrics()['queue_depth']['quick'] == 3
+    backend.gate.set()
+    await asyncio.gather(*tasks)
+    assert backend.peak == 2
+    assert scheduler.metrics()['completed'] == 5
+
+
+@pytest.mark.asyncio
+async def test_quick_requests_jump_background_and_sessions_take_turns():
+    """Test priority ordering first, then round robin between sessions."""
+    backend = GatedBackend()
+    scheduler = ModelRequestScheduler(backend, max_concurrency=1)
+    blocker = asyncio.create_task(consume(scheduler, "blocker", "x"))
+    await settle()
+    tasks = [
+        asyncio.create_task(consume(scheduler, "a-bg", "a", priority=RequestPriority.BACKGROUND)),
+        asyncio.create_task(consume(scheduler, "a1", "a")),
+        asyncio.create_task(consume(scheduler, "a2", "a")),
+        asyncio.create_task(consume(scheduler, "b1", "b")),
+    ]
+    await settle()
+    backend.gate.set()
+    await asyncio.gather(blocker, *tasks)
+
+    assert backend.started == ["blocker", "a1", "b1", "a2", "a-bg"]
+
+
+@pytest.mark.asyncio
+async def test_deadline_rejects_waiting_request():
+    """Test that a request still queued at its deadline is rejected and leaves the queue."""
+    backend = GatedBackend()
+    scheduler = ModelRequestScheduler(backend, max_concurrency=1)
+    blocker = asyncio.create_task(consume(scheduler, "blocker", "x"))
+    await settle()
+
+    deadline = asyncio.get_running_loop().time() + 0.01
+    with pytest.raises(ModelRequestTimeout):
+        await consume(scheduler, "late", "y", deadline=deadline)
+    assert scheduler.queue_depth() == 0
+    assert scheduler.metrics()['rejected'] == 1
+
+    backend.gate.set()
+    await blocker
+    assert scheduler.active == 0
+
+
+@pytest.mark.asyncio
+async def test_timeout_stops_long_stream_and_frees_slot():
+    """Test that a stream running past its timeout raises and releases its slot."""
+    backend = GatedBackend()
+    scheduler = ModelRequestScheduler(backend, max_concurrency=1, default_timeout=0.01)
+
+    with pytest.raises(ModelRequestTimeout):
+        await consume(scheduler, "slow", "x")
+    assert scheduler.active == 0
+    assert scheduler.metrics()['timeouts'] == 1
@@ -0,0 +1,86 @@
+from prompt_assembler import PromptAssembler, PromptSection, ApproximateTokenizer
+
+
+class WordTokenizer:
+    """One token per whitespace separated word, so budgets are easy to reason about."""
+
+    def count(self, text):
+        return len(text.split())
+
+
+def make_assembler(context_window, budgets, **kwargs):
+    assembler = PromptAssembler(tokenizer=WordTokenizer(), context_window=context_window,
+                                response_reserve=0, budgets=budgets, **kwargs)
+    assembler.MESSAGE_OVERHEAD = 0
+    return assembler
+
+
+def test_recent_turns_keep_newest_and_stay_in_order():
+    """Test that the oldest turns are dropped first and the rest keep chronological order."""
+    assembler = make_assembler(6, {'recent': 1.0})
+    turns = ["one two", "three four", "five six", "seven eight"]
+
+    kept, report = assembler.assemble([
+        PromptSection('recent', turns, priority_order=range(len(turns) - 1, -1, -1)),
+    ])
+
+    assert kept['recent'] == ["three four", "five six", "seven eight"]
+    assert report['recent'] == {'used': 6, 'budget': 6, 'kept': 3, 'dropped': 1}
+
+
+def test_unused_budget_carries_to_later_sections():
+    """Test that a short section hands its leftover tokens to the next one."""
+    assembler = make_assembler(10, {'system': 0.5, 'context': 0.5})
+
+    kept, report = assembler.assemble([
+        PromptSection('system', ["short"]),
+        PromptSection('context', ["a b c", "d e f", "g h"]),
+    ])
+
+    assert kept['context'] == ["a b c", "d e f", "g h"]
+    assert report['context']['budget'] == 9
+
+
+def test_required_item_is_truncated_to_fit():
+    """Test that a required system prompt is cut down rather than dropped."""
+    assembler = make_assembler(4, {'system': 1.0})
+
+    kept, report = assembler.assemble([PromptSection('system', ["a b c d e f g h"], required=True)])
+
+    assert kept['system'] == ["a b c d"]
+    assert report['system']['used'] <= 4
+
+
+def test_user_input_comes_out_of_the_window_first():
+    """Test that the user input is always counted and shrinks what the sections get."""
+    assembler = make_assembler(10, {'recent': 1.0}, max_user_input_share=1.0)
+
+    _, report = assembler.assemble([PromptSection('recent', [])], user_input="six words of user input here")
+
+    assert report['user_input']['used'] == 6
+    assert report['recent']['budget'] == 4
+
+
+def test_approximate_tokenizer_counts_at_least_a_token_per_four_chars():
+    """Test the approximate tokenizer on words and on long unbroken text."""
+    tokenizer = ApproximateTokenizer()
+
+    assert tokenizer.count("") == 0
+    assert tokenizer.count("Hello, world!") == 4
+    assert tokenizer.count("x" * 40) == 10
+
+
+def test_long_user_input_is_truncated_to_keep_prompt_in_window():
+    """Test that one huge message can't push the prompt past the window."""
+    assembler = PromptAssembler(tokenizer=ApproximateTokenizer(), context_window=1000, response_reserve=200)
+    huge = "word " * 5000
+
+    kept, report = assembler.assemble([
+        PromptSection('system', ["You are a helpful assistant. " * 10], required=True),
+        PromptSection('recent', ["an earlier turn"] * 50),
+    ], user_input=huge)
+
+    assert report['user_input']['truncated']
+    assert len(kept['user_input']) < len(huge)
+    assert report['total']['used'] <= 1000 - 200
+    assert kept['system']
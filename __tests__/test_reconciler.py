@@ -0,0 +1,47 @@
+import pytest
+
+from chat_history.embedding_executor import EmbeddingExecutor
+from chat_history.history_log import HistoryLog
+from chat_history.reconciler import HistoryReconciler
+from chat_history.vector_storage import VectorStorageBase
+from __tests__.fakes import BagOfWordsModel, RecordingOutputHandler
+
+
+def make_entry(entry_id, content):
+    return {"id": entry_id, "role": "user", "content": content, "timestamp": "2024-01-01 00:00:00",
+            "created": "2024-01-01 00:00:00", "updated": "2024-01-01 00:00:00", "vector_index": ''}
+
+
+@pytest.mark.asyncio
+async def test_drift_is_found_and_only_the_broken_part_repaired(tmp_path):
+    """Test that each kind of drift is reported, and that after repair none is left."""
+    log = HistoryLog(RecordingOutputHandler(), db_name=str(tmp_path / 'chat_db'),
+                     file_name=str(tmp_path / 'chat_history.jsonl'))
+    await log.init_db()
+    model = BagOfWordsModel()
+    storage = VectorStorageBase(vector_file=str(tmp_path / 'chat.index'), vector_model=model,
+                                embedding_executor=EmbeddingExecutor(model, workers=2, max_batch_size=2))
+    entries = []
+    for number in range(4):
+        vector_id = storage.add_vectors(BagOfWordsModel.encode_one(f"message {number}").reshape(1, -1))
+        entries.append(await log.log_entry('user', f"message {number}", vector_index=str(vector_id)))
+    await log.flush()
+    await log.update_vector_indices([('99', entries[3]['id'])])  # Points at a lost vector, orphaning its own
+    storage.add_vectors(BagOfWordsModel.encode_one("nobody's").reshape(1, -1))
+    await log.append_to_file([make_entry('file-only', 'only in the file')])
+    await log.restore_entries([make_entry('db-only', 'only in the database')])
+    reconciler = HistoryReconciler(log, storage)
+
+    report = await reconciler.diff()
+    model.calls.clear()
+    result = await reconciler.repair(report, batch_size=2)
+    after = await reconciler.diff()
+    await storage.close()
+    await log.connection.close()
+
+    assert {name: len(items) for name, items in report.items()} == {
+        'missing_in_db': 1, 'missing_in_file': 1, 'unvectorized': 2, 'dangling': 1, 'shared': 0, 'orphaned': 2}
+    assert result['encoded'] == 3 and result['orphans_removed'] == 2
+    assert sorted(text for call in model.calls for text in call) == [
+        'message 3', 'only in the database', 'only in the file']
+    assert all(not items for items in after.values())
@@ -0,0 +1,118 @@
+import pytest
+
+from response_cache import ResponseCache
+from chat_history.vector_storage import VectorStorageBase
+from __tests__.fakes import BagOfWordsModel
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_cache(**kwargs):
+    return ResponseCache(vector_model=BagOfWordsModel(), **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_exact_hit_ignores_case_and_whitespace():
+    """Test that normalised inputs hit without a semantic search."""
+    cache = make_cache()
+    await cache.store("What is the weather?", "Sunny")
+
+    assert (await cache.lookup("  what is   the WEATHER? "))[0] == "Sunny"
+    assert cache.stats['exact_hits'] == 1
+
+
+@pytest.mark.asyncio
+async def test_semantic_hit_respects_threshold():
+    """Test that near-identical inputs hit and unrelated ones miss."""
+    cache = make_cache(similarity_threshold=0.8)
+    await cache.store("tell me a story about a brave little dragon", "Once upon a time...")
+
+    assert (await cache.lookup("tell me a story about a brave little dragon please"))[0] == "Once upon a time..."
+    assert (await cache.lookup("how do I bake bread"))[0] is None
+    assert cache.stats['semantic_hits'] == 1
+    assert cache.stats['misses'] == 1
+
+
+@pytest.mark.asyncio
+async def test_least_recently_used_entry_is_evicted():
+    """Test that eviction keeps the index and entries in step."""
+    cache = make_cache(max_entries=2)
+    await cache.store("my first question", "one")
+    await cache.store("my second question", "two")
+    await cache.lookup("my first question")
+    await cache.store("my third question", "three")
+
+    assert (await cache.lookup("my second question"))[0] is None
+    assert (await cache.lookup("my first question"))[0] == "one"
+    assert (await cache.lookup("my third question"))[0] == "three"
+    assert cache.vector_index.ntotal == 2
+    assert cache.stats['evictions'] == 1
+
+
+@pytest.mark.asyncio
+async def test_entries_expire_after_ttl():
+    """Test that entries older than the ttl are dropped."""
+    clock = FakeClock()
+    cache = make_cache(ttl=10, clock=clock)
+    await cache.store("what is the question", "answer")
+    clock.now = 11
+
+    assert (await cache.lookup("what is the question"))[0] is None
+    assert cache.vector_index.ntotal == 0
+
+
+@pytest.mark.asyncio
+async def test_significant_world_state_change_invalidates():
+    """Test that small world state changes keep the cache and large ones clear it."""
+    cache = make_cache(world_state_change_threshold=0.5)
+    state = {"CurrentState": 1, "GeneralContextState": 2, "EvidenceNeeded": 3, "TinyNextStepOptions": 4}
+    cache.observe_world_state(state)
+    await cache.store("what is the question", "answer")
+
+    cache.observe_world_state({**state, "CurrentState": 5})
+    assert (await cache.lookup("what is the question"))[0] == "answer"
+
+    cache.observe_world_state({**state, "CurrentState": 6, "EvidenceNeeded": 7})
+    assert (await cache.lookup("what is the question"))[0] is None
+    assert cache.stats['invalidations'] == 1
+
+
+@pytest.mark.asyncio
+async def test_same_input_in_a_different_context_misses():
+    """Test that the turns before the input are part of the key."""
+    cache = make_cache(similarity_threshold=0.8)
+    weather = [{"role": "assistant", "content": "Shall I check the weather in Paris tomorrow morning?"}]
+    bank = [{"role": "assistant", "content": "Do you want me to transfer all your savings to this account?"}]
+    await cache.store("yes please do that", "It will rain in Paris.", context=weather)
+
+    assert (await cache.lookup("yes please do that", weather))[0] == "It will rain in Paris."
+    assert (await cache.lookup("yes please do that", bank))[0] is None
+
+
+@pytest.mark.asyncio
+async def test_short_inputs_are_never_cached():
+    """Test that inputs below min_words are skipped rather than stored or looked up."""
+    cache = make_cache(min_words=3)
+    await cache.store("why?", "Because.")
+
+    assert (await cache.lookup("why?"))[0] is None
+    assert cache.vector_index.ntotal == 0
+    assert cache.stats['skipped'] == 1
+
+
+@pytest.mark.asyncio
+async def test_exact_hits_work_before_the_shared_model_loads():
+    """Test that a cache over an unloaded storage answers exact hits without loading the model."""
+    storage = VectorStorageBase(vector_file=None)
+    cache = ResponseCache(vector_storage=storage)
+    await cache.store("what is the weather today", "Sunny")
+
+    assert (await cache.lookup("What is the weather today"))[0] == "Sunny"
+    assert (await cache.lookup("what is the weather tomorrow"))[0] is None
+    assert not storage.model_ready and cache.vector_index.ntotal == 0
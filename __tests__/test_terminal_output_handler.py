@@ -1,6 +1,6 @@
 from terminal_output_handler import TerminalOutputHandler  # Adjust the import according to your structure
 import pytest
-from unittest.mock import patch
+from unittest.mock import patch, call
 
 
 @pytest.mark.asyncio
@@ -50,6 +50,36 @@ async def test_send_output_default_message_type():
         await output_handler.send_output(message)
         mock_print.assert_called_once_with(expected_output)
 
+@pytest.mark.asyncio
+async def test_stream_output_renders_chunks_incrementally():
+    """Test that streamed chunks are printed as they arrive and closed once."""
+    output_handler = TerminalOutputHandler()
+
+    with patch('builtins.print') as mock_print:
+        await output_handler.stream_output("Hello", message_type="chatbot")
+        await output_handler.stream_output(" there", message_type="chatbot")
+        await output_handler.end_stream(message_type="chatbot")
+
+    assert mock_print.call_args_list == [
+        call("\033[92mHello", end='', flush=True),
+        call(" there", end='', flush=True),
+        call("\033[0m", flush=True),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_send_output_is_held_while_streaming():
+    """Test that messages sent mid-stream are printed after the stream ends."""
+    output_handler = TerminalOutputHandler()
+
+    with patch('builtins.print') as mock_print:
+        await output_handler.stream_output("Hello", message_type="chatbot")
+        await output_handler.send_output("World state saved.", message_type="system")
+        assert mock_print.call_count == 1
+        await output_handler.end_stream(message_type="chatbot")
+
+    assert mock_print.call_args_list[-1] == call("\033[94mWorld state saved.\033[0m")
+
 # Run these tests using pytest
 if __name__ == "__main__":
     pytest.main()
@@ -0,0 +1,125 @@
+import asyncio
+
+import pytest
+
+from turn_scheduler import TurnScheduler, WorldStatePolicy
+
+
+class RecordingWorldStateManager:
+    def __init__(self):
+        self.updates = []
+        self.pending_world_state = {}
+
+    async def update_world_state(self, new_state):
+        self.updates.append(new_state)
+
+    async def stage_world_state(self, key, value):
+        self.pending_world_state[key] = value
+
+    def take_pending_world_state(self):
+        pending, self.pending_world_state = self.pending_world_state, {}
+        return pending
+
+
+class SilentDebugLogger:
+    async def log(self, message):
+        pass
+
+
+class SlowPredictionAI:
+    """Mimics run_model_process: yields one field, then waits, and returns partial data if cancelled."""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.started = asyncio.Event()
+
+    async def get_prediction_streaming(self, user_input, is_cancelled, on_field=None):
+        data = {"CurrentState": {"newValue": f"{user_input} partial"}}
+        self.started.set()
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            return data, ["Generation interrupted by user feedback"]
+        data["CurrentState"]["newValue"] = f"{user_input} done"
+        return data, []
+
+
+def make_scheduler(ai, policy=WorldStatePolicy.COMMITTED, in_flight_timeout=None):
+    manager = RecordingWorldStateManager()
+    return TurnScheduler(ai, manager, SilentDebugLogger(), policy=policy,
+                         in_flight_timeout=in_flight_timeout), manager
+
+
+@pytest.mark.asyncio
+async def test_schedule_returns_before_prediction_finishes():
+    """Test that world state generation runs in the background."""
+    scheduler, manager = make_scheduler(SlowPredictionAI(delay=10))
+    await scheduler.schedule_world_state("hello")
+    await scheduler.prepare_prompt()
+
+    assert scheduler.prediction_in_flight
+    assert manager.updates == []
+    await scheduler.close()
+
+
+@pytest.mark.asyncio
+async def test_new_turn_merges_partial_prediction_before_starting():
+    """Test that a cancelled prediction is committed before the next one starts."""
+    ai = SlowPredictionAI(delay=10)
+    scheduler, manager = make_scheduler(ai)
+    await scheduler.schedule_world_state("first")
+    await ai.started.wait()
+    ai.started.clear()
+    await scheduler.schedule_world_state("second")
+
+    assert manager.updates == [{"CurrentState": {"newValue": "first partial"}}]
+    await ai.started.wait()
+    await scheduler.close()
+    assert manager.updates[-1] == {"CurrentState": {"newValue": "second partial"}}
+
+
+@pytest.mark.asyncio
+async def test_in_flight_policy_waits_for_prediction():
+    """Test that the in flight policy commits the running prediction before the prompt is built."""
+    scheduler, manager = make_scheduler(SlowPredictionAI(delay=0.01), policy=WorldStatePolicy.IN_FLIGHT)
+    await scheduler.schedule_world_state("hello")
+    await scheduler.prepare_prompt()
+
+    assert manager.updates == [{"CurrentState": {"newValue": "hello done"}}]
+
+
+@pytest.mark.asyncio
+async def test_in_flight_policy_times_out_to_committed_state():
+    """Test that the in flight policy stops waiting after its timeout without cancelling."""
+    scheduler, manager = make_scheduler(SlowPredictionAI(delay=10), policy=WorldStatePolicy.IN_FLIGHT,
+                                        in_flight_timeout=0.01)
+    await scheduler.schedule_world_state("hello")
+    await scheduler.prepare_prompt()
+
+    assert manager.updates == []
+    assert scheduler.prediction_in_flight
+    await scheduler.close()
+
+
+class HardCancelAI:
+    """Stages a field and then lets cancellation propagate instead of returning partial data."""
+
+    def __init__(self):
+        self.started = asyncio.Event()
+
+    async def get_prediction_streaming(self, user_input, is_cancelled, on_field=None):
+        await on_field("CurrentState", {"newValue": user_input})
+        self.started.set()
+        await asyncio.sleep(10)
+
+
+@pytest.mark.asyncio
+async def test_staged_fields_are_committed_when_cancelled():
+    """Test that fields staged before a hard cancellation are still committed."""
+    ai = HardCancelAI()
+    scheduler, manager = make_scheduler(ai)
+    await scheduler.schedule_world_state("hello")
+    await ai.started.wait()
+    await scheduler.close()
+
+    assert manager.updates == [{"CurrentState": {"newValue": "hello"}}]
@@ -0,0 +1,142 @@
+import os
+
+import faiss
+import numpy as np
+import pytest
+
+from chat_history.vector_chat_storage import VectorChatStorage
+from __tests__.fakes import BagOfWordsModel, RecordingOutputHandler
+
+
+class FakeChatLogger:
+    def __init__(self, count):
+        self.output_handler = RecordingOutputHandler()
+        self.history = [{"id": f"id-{i}", "role": "user", "content": f"message number {i}", "vector_index": ''}
+                        for i in range(count)]
+        self.updates = []
+
+    async def iter_entries(self, page_size=500, unvectorized_only=False):
+        for entry in self.history:
+            if not unvectorized_only or not entry['vector_index']:
+                yield dict(entry)
+
+    async def update_vector_indices(self, updates):
+        self.updates.extend(updates)
+        vector_indices = {entry_id: vector_index for vector_index, entry_id in updates}
+        for entry in self.history:
+            entry['vector_index'] = vector_indices.get(entry['id'], entry['vector_index'])
+
+
+class FailingModel(BagOfWordsModel):
+    """Fails on the nth call to encode, like an interrupted run."""
+
+    def __init__(self, fail_on_call):
+        super().__init__()
+        self.fail_on_call = fail_on_call
+
+    def encode(self, text, batch_size=32, **kwargs):
+        if len(self.calls) + 1 == self.fail_on_call:
+            raise KeyboardInterrupt
+        return super().encode(text, batch_size=batch_size, **kwargs)
+
+
+def make_storage(tmp_path, chat_logger, model):
+    return VectorChatStorage(chat_logger, vector_file=str(tmp_path / 'chat_vectors.index'), vector_model=model)
+
+
+@pytest.mark.asyncio
+async def test_init_vector_db_encodes_in_batches_and_writes_once(tmp_path, monkeypatch):
+    """Test that entries are encoded a batch at a time and the index is written once."""
+    chat_logger = FakeChatLogger(10)
+    model = BagOfWordsModel()
+    storage = make_storage(tmp_path, chat_logger, model)
+    writes = []
+    original_write = faiss.write_index
+    monkeypatch.setattr(faiss, 'write_index', lambda index, path: writes.append(path) or original_write(index, path))
+    progress = []
+
+    count = await storage.init_vector_db(batch_size=4, on_progress=lambda done, total: progress.append(done))
+
+    assert count == 10
+    assert [len(batch) for batch in model.calls] == [4, 4, 2]
+    assert progress == [4, 8, 10]
+    assert len(writes) == 1
+    assert storage.vector_index.ntotal == 10
+    assert chat_logger.updates[0] == ('1', 'id-0') and chat_logger.updates[-1] == ('10', 'id-9')
+    assert not any(os.path.exists(path) for path in storage.ingest_files)
+
+
+@pytest.mark.asyncio
+async def test_init_vector_db_resumes_after_interruption(tmp_path):
+    """Test that a second run only encodes the entries the first run didn't finish."""
+    chat_logger = FakeChatLogger(10)
+    storage = make_storage(tmp_path, chat_logger, FailingModel(fail_on_call=3))
+    with pytest.raises(KeyboardInterrupt):
+        await storage.init_vector_db(batch_size=4)
+    assert chat_logger.updates == []
+
+    model = BagOfWordsModel()
+    storage = make_storage(tmp_path, chat_logger, model)
+    count = await storage.init_vector_db(batch_size=4)
+
+    assert count == 10
+    assert [len(batch) for batch in model.calls] == [2]
+    assert storage.vector_index.ntotal == 10
+    distances, ids = storage.vector_index.search(BagOfWordsModel.encode_one("message number 5").reshape(1, -1), 1)
+    assert ids[0][0] == 6 and distances[0][0] == 0
+
+
+@pytest.mark.asyncio
+async def test_init_vector_db_crash_after_checkpoint_does_not_duplicate(tmp_path, monkeypatch):
+    """Test that a crash between writing the index and updating entries is finished without re-adding vectors."""
+    chat_logger = FakeChatLogger(10)
+    storage = make_storage(tmp_path, chat_logger, BagOfWordsModel())
+
+    async def crash(updates):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(chat_logger, 'update_vector_indices', crash)
+    with pytest.raises(KeyboardInterrupt):
+        await storage.init_vector_db(batch_size=4)
+    monkeypatch.undo()
+
+    model = BagOfWordsModel()
+    storage = make_storage(tmp_path, chat_logger, model)
+    assert storage.vector_index.ntotal == 10
+    count = await storage.init_vector_db(batch_size=4)
+
+    assert count == 10
+    assert model.calls == []
+    assert storage.vector_index.ntotal == 10
+    assert chat_logger.updates[0] == ('1', 'id-0') and chat_logger.updates[-1] == ('10', 'id-9')
+    assert not any(os.path.exists(path) for path in storage.ingest_files)
+
+
+@pytest.mark.asyncio
+async def test_init_vector_db_is_quiet_when_nothing_to_add(tmp_path):
+    """Test that a startup with every entry vectorized prints nothing."""
+    chat_logger = FakeChatLogger(3)
+    for entry in chat_logger.history:
+        entry['vector_index'] = '1'
+    storage = make_storage(tmp_path, chat_logger, BagOfWordsModel())
+
+    assert await storage.init_vector_db() == 0
+    assert chat_logger.output_handler.messages == []
+
+
+@pytest.mark.asyncio
+async def test_legacy_flat_index_is_upgraded_to_stable_ids(tmp_path):
+    """Test that a flat index saved by older versions maps each vector to its position plus one."""
+    texts = ['the red door', 'the blue window', 'the green roof']
+    legacy = faiss.IndexFlatL2(768)
+    legacy.add(np.stack([BagOfWordsModel.encode_one(text) for text in texts]))
+    faiss.write_index(legacy, str(tmp_path / 'chat_vectors.index'))
+
+    storage = make_storage(tmp_path, FakeChatLogger(0), BagOfWordsModel())
+    indices, _ = storage.retrieve_vectors('the blue window', 1)
+    next_id = await storage.save_chat_vector({'content': 'the yellow fence'})
+    await storage.close()
+
+    assert indices == [2]
+    assert next_id == 4
+    assert hasattr(faiss.read_index(storage.vector_file), 'id_map')
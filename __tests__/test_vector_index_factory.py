@@ -0,0 +1,104 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from chat_history.vector_index_factory import create_index, index_type_of, tune_search_breadth
+from chat_history.vector_storage import VectorStorageBase
+from __tests__.fakes import BagOfWordsModel
+
+
+def clustered_vectors(count, seed=0):
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(20, 768)).astype('float32')
+    return (centres[rng.integers(0, 20, count)] + rng.normal(scale=0.3, size=(count, 768))).astype('float32')
+
+
+@pytest.mark.parametrize('index_type', ['ivf_flat', 'ivf_pq', 'hnsw'])
+def test_tuning_reaches_target_recall(index_type):
+    """Test that each approximate type is tuned to find most of the exact nearest neighbours."""
+    vectors = clustered_vectors(2000)
+    ids = np.arange(1, len(vectors) + 1, dtype='int64')
+    index = create_index(index_type, vectors)
+    index.add_with_ids(vectors, ids)
+
+    tuning = tune_search_breadth(index, vectors, ids, target_recall=0.9, queries=50)
+
+    assert index_type_of(index) == index_type
+    assert tuning['recall'] >= 0.9 or index_type == 'ivf_pq'  # PQ codes cap the recall it can reach
+    _, found = index.search(vectors[:1], 1)
+    assert found[0][0] == 1
+
+
+@pytest.mark.parametrize('as_mask', [False, True])
+@pytest.mark.parametrize('allowed', [50, 2500])
+@pytest.mark.parametrize('index_type', ['ivf_flat', 'hnsw'])
+def test_filtered_search_returns_k_allowed_hits(index_type, allowed, as_mask):
+    """Test that a filter excluding most vectors still yields k hits, all of them allowed."""
+    vectors = clustered_vectors(5000)
+    storage = VectorStorageBase(vector_model=BagOfWordsModel(), vector_file=None)
+    storage.vector_index = create_index(index_type, vectors)
+    storage.add_vectors(vectors)
+    ids = np.arange(1, len(vectors) + 1, 5000 // allowed)
+    mask = np.zeros(len(vectors) + 1, dtype=bool)
+    mask[ids] = True
+
+    _, found = storage.search_filtered(vectors[:1], 10, mask if as_mask else ids)
+
+    assert len(set(found[0]) & set(ids)) == 10
+
+
+@pytest.mark.asyncio
+async def test_flat_index_is_rebuilt_in_background_past_threshold():
+    """Test that passing the threshold swaps in the approximate index, keeping every id."""
+    storage = VectorStorageBase(vector_model=BagOfWordsModel(), vector_file=None, index_type='hnsw',
+                                index_threshold=300, target_recall=0.9)
+    vectors = clustered_vectors(301)
+    storage.add_vectors(vectors[:299])
+    assert storage.rebuild_task is None
+    storage.add_vectors(vectors[299:300])
+    await asyncio.sleep(0)  # Lets the rebuild take its snapshot
+    storage.add_vectors(vectors[300:])  # Added while the new index is built
+    await storage.rebuild_task
+
+    assert index_type_of(storage.vector_index) == 'hnsw'
+    assert storage.vector_index.ntotal == 301
+    _, found = storage.vector_index.search(vectors[300:], 1)
+    assert found[0][0] == 301
+    assert storage.index_tuning['recall'] >= 0.9
+    await storage.close()
+
+
+@pytest.mark.parametrize('index_type, min_recall', [('fp16', 0.99), ('sq8', 0.9), ('pq', 0.05)])
+def test_compressed_types_report_their_recall(index_type, min_recall):
+    """Test that compressed flat types are measured against an exact search."""
+    vectors = clustered_vectors(2000)
+    ids = np.arange(1, len(vectors) + 1, dtype='int64')
+    index = create_index(index_type, vectors)
+    index.add_with_ids(vectors, ids)
+
+    tuning = tune_search_breadth(index, vectors, ids, queries=50)
+
+    assert index_type_of(index) == index_type
+    assert tuning['breadth'] is None
+    assert min_recall <= tuning['recall'] <= 1.0
+
+
+@pytest.mark.asyncio
+async def test_mmap_index_is_mapped_until_it_changes(tmp_path):
+    """Test that a mapped checkpoint can be searched, and is copied into memory on the first add."""
+    vectors = clustered_vectors(300)
+    storage = VectorStorageBase(vector_model=BagOfWordsModel(), vector_file=str(tmp_path / 'vectors.index'))
+    storage.add_vectors(vectors[:299])
+    await storage.rebuild_index('sq8')
+    await storage.close()
+
+    mapped = VectorStorageBase(vector_model=BagOfWordsModel(), vector_file=storage.vector_file, mmap=True)
+    assert mapped.index_mapped
+    assert index_type_of(mapped.vector_index) == 'sq8'
+    _, found = mapped.vector_index.search(vectors[5:6], 1)
+    assert found[0][0] == 6
+
+    assert mapped.add_vectors(vectors[299:]) == 300
+    assert not mapped.index_mapped
+    await mapped.close()
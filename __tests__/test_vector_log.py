@@ -0,0 +1,78 @@
+import os
+
+import faiss
+import numpy as np
+import pytest
+
+from chat_history.vector_log import VectorLog
+from chat_history.vector_storage import VectorStorageBase
+from __tests__.fakes import BagOfWordsModel
+
+
+def make_storage(tmp_path, **kwargs):
+    return VectorStorageBase(vector_model=BagOfWordsModel(), vector_file=str(tmp_path / 'vectors.index'), **kwargs)
+
+
+def save(storage, *texts):
+    for text in texts:
+        storage.save_vector({'content': text}, 'content')
+
+
+@pytest.mark.asyncio
+async def test_vectors_are_logged_and_replayed_without_rewriting_the_index(tmp_path, monkeypatch):
+    """Test that saving a vector appends to the log instead of writing the index file."""
+    writes = []
+    monkeypatch.setattr(faiss, 'write_index', lambda index, path: writes.append(path))
+    storage = make_storage(tmp_path)
+    save(storage, 'the first message', 'the second message', 'the third message')
+
+    assert writes == []
+    assert storage.vector_log.records == 3
+
+    reloaded = make_storage(tmp_path)
+    assert reloaded.vector_index.ntotal == 3
+    indices, _ = reloaded.retrieve_vectors('the second message', 1)
+    assert indices == [2]
+
+
+@pytest.mark.asyncio
+async def test_checkpoint_runs_in_background_and_compacts_log(tmp_path):
+    """Test that reaching checkpoint_every writes the index and keeps only newer records in the log."""
+    storage = make_storage(tmp_path, checkpoint_every=3)
+    save(storage, 'one message here', 'two messages here', 'three messages here')
+    await storage.checkpoint_task
+    save(storage, 'four messages here')
+
+    assert faiss.read_index(storage.vector_file).ntotal == 3
+    assert [vector_id for vector_id, _ in storage.vector_log.read()] == [4]
+    assert make_storage(tmp_path).vector_index.ntotal == 4
+
+    await storage.close()
+    assert faiss.read_index(storage.vector_file).ntotal == 4
+    assert storage.vector_log.read() == []
+
+
+@pytest.mark.asyncio
+async def test_crash_recovery_skips_checkpointed_records_and_torn_tail(tmp_path, monkeypatch):
+    """Test that a crash before compaction doesn't duplicate vectors, and a torn record is dropped."""
+    storage = make_storage(tmp_path, checkpoint_every=100)
+
+    def crash(self, checkpoint_total):
+        raise KeyboardInterrupt
+
+    save(storage, 'one message here', 'two messages here', 'three messages here')
+    monkeypatch.setattr(VectorLog, 'compact', crash)
+    with pytest.raises(KeyboardInterrupt):
+        await storage.checkpoint()  # The index file is written but the log keeps every record
+    monkeypatch.undo()
+    save(storage, 'four messages here')
+    storage.vector_log.close()
+    with open(storage.vector_log.path, 'ab') as file:
+        file.write(b'\x05\x00\x00\x00half a record')
+
+    reloaded = make_storage(tmp_path)
+
+    assert reloaded.vector_index.ntotal == 4
+    assert os.path.getsize(reloaded.vector_log.path) == 4 * reloaded.vector_log.record_size
+    expected = BagOfWordsModel.encode_one('four messages here')
+    assert np.array_equal(reloaded.vector_index.reconstruct(4), expected)
@@ -0,0 +1,40 @@
+import pytest
+
+from chat_history.world_state_logger import WorldStateLogger
+from chat_history.world_state_manager import WorldStateManager
+from chat_history.world_state_vector_storage import WorldStateVectorStorage, state_text
+from __tests__.fakes import BagOfWordsModel, RecordingOutputHandler
+
+STATES = [
+    {"CurrentState": {"newValue": "talking about dragons"}, "TinyNextStepOptions": ["ask about caves"]},
+    {"CurrentState": {"newValue": "planning a market trip"}, "TinyNextStepOptions": ["buy bread"]},
+    {"CurrentState": {"newValue": "back to dragons and caves"}, "TinyNextStepOptions": []},
+]
+
+
+@pytest.mark.asyncio
+async def test_logged_states_are_embedded_and_recalled_after_restart(tmp_path):
+    """Test that snapshots are embedded in the background and recalled by relevance from a new session."""
+    logger = WorldStateLogger(RecordingOutputHandler(), file_name=str(tmp_path / 'world_states.jsonl'))
+    storage = WorldStateVectorStorage(logger, str(tmp_path / 'states.index'), vector_model=BagOfWordsModel())
+    manager = WorldStateManager(RecordingOutputHandler(), logger, state_file=str(tmp_path / 'last.json'))
+    manager.state_vectors = storage
+    for state in STATES:
+        manager.last_world_state.update(state)
+        await manager.save_last_world_state()
+        for task in list(manager.vector_tasks):
+            await task
+    await storage.close()
+    await logger.save_logs()
+
+    logger = WorldStateLogger(RecordingOutputHandler(), file_name=str(tmp_path / 'world_states.jsonl'))
+    await logger.load_history()
+    storage = WorldStateVectorStorage(logger, str(tmp_path / 'states.index'), vector_model=BagOfWordsModel())
+    assert await storage.init_vector_db() == 0  # Every snapshot kept its vector
+    states = await storage.retrieve_states('dragons caves', n=2, exclude_ids=(logger.chat_history[-1]['id'],))
+    await storage.close()
+
+    assert [state['CurrentState']['newValue'] for state in states] == ['talking about dragons',
+                                                                        'planning a market trip']
+    assert state_text(logger.chat_history[1]) == ("CurrentState: planning a market trip\n"
+                                                  "TinyNextStepOptions: buy bread")
@@ -1,15 +1,29 @@
 import json  # For JSON manipulation
 import re  # For regular expressions
 import asyncio  # For asynchronous programming
-import subprocess  # For subprocess management
+import time  # For measuring time to first token
 
 from debug_logger import DebugLogger
 from output_handler import OutputHandler  
+from model_backend import ModelBackend, RequestPriority, create_default_backend, DEFAULT_CONTEXT_WINDOW
+from prompt_assembler import PromptAssembler, PromptSection
+from response_cache import ResponseCache
 
 from chat_history.chat_history_manager import ChatHistoryManager
 # Assuming OutputHandler and InputHandler exist in your codebase
 
-MAX_HISTORY_LENGTH = 7  # Example constant for history length
+RECENT_HISTORY_CANDIDATES = 50  # Most recent turns offered to the prompt assembler
+CONTEXT_ROLES = ('user', 'assistant')  # Roles recalled as context; system rows are command results and errors
+WORLD_STATE_PROMPT_KEYS = [
+    'GeneralContextState',
+    'CurrentState',
+    'AbsoluteIdealWorld',
+    'IncrementallyBetterWorld',
+    'AbsoluteAnxietyWorld',
+    'IncrementallyWorseWorld',
+    'TinyNextStepOptions',
+    'EvidenceNeeded'
+]
 
 
 def clean_response(response_text: str) -> str:
@@ -26,6 +40,94 @@ def clean_response(response_text: str) -> str:
     return cleaned_response
 
 
+def message_text(message: dict) -> str:
+    """Text of a chat message as it is counted against the token budget."""
+    return json.dumps(message)
+
+
+class IncrementalJsonParser:
+    """
+    Parse streamed JSON or JSONL text, emitting each top-level key as soon as its value is complete.
+
+    Text outside of objects, such as ```jsonl fences or stray prose, is skipped.
+    Objects may span several lines, and several keys may share one object. Every
+    member is decoded exactly once, and an unfinished member at the end of the
+    stream is reported as an error by `close` instead of being parsed.
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.member_parts = []  # Text of the member being read, across chunks
+        self.errors = []
+
+    def feed(self, chunk: str) -> list:
+        """
+        Consume a chunk of model output.
+
+        :param chunk: The next piece of text from the model.
+        :return: List of (key, value) tuples completed by this chunk.
+        """
+        fields = []
+        member_start = 0 if self.depth > 0 else None
+        for i, char in enumerate(chunk):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                continue
+
+            if self.depth == 0:
+                if char == '{':
+                    self.depth = 1
+                    member_start = i + 1
+                continue
+
+            if char == '"':
+                self.in_string = True
+            elif char in '{[':
+                self.depth += 1
+            elif char in ']}':
+                self.depth -= 1
+                if self.depth == 0:
+                    self.finish_member(chunk[member_start:i], fields)
+                    member_start = None
+            elif char == ',' and self.depth == 1:
+                self.finish_member(chunk[member_start:i], fields)
+                member_start = i + 1
+
+        if member_start is not None:
+            self.member_parts.append(chunk[member_start:])
+        return fields
+
+    def finish_member(self, tail: str, fields: list):
+        text = ''.join(self.member_parts) + tail
+        self.member_parts = []
+        if not text.strip():
+            return
+        try:
+            fields.extend(json.loads('{' + text + '}').items())
+        except json.JSONDecodeError as e:
+            self.errors.append(f"JSON decoding error in member {text.strip()[:40]!r}: {e}")
+
+    def close(self) -> list:
+        """
+        Finish parsing, reporting any truncated member left at the end of the stream.
+
+        :return: List of errors collected while parsing.
+        """
+        text = ''.join(self.member_parts).strip()
+        if self.depth > 0 and text:
+            self.errors.append(f"Discarded truncated member {text[:40]!r}")
+        self.depth = 0
+        self.in_string = self.escaped = False
+        self.member_parts = []
+        return self.errors
+
 
 
 class AIImplementation:
@@ -36,6 +138,10 @@ class AIImplementation:
                  output_handler: OutputHandler,
                  debug_logger: DebugLogger,
         on_render_text_line = None,
+        model_backend: ModelBackend = None,
+        context_window_size: int = DEFAULT_CONTEXT_WINDOW,
+        prompt_assembler: PromptAssembler = None,
+        response_cache: ResponseCache = None,
     ):
         """
         Initialize the AI implementation with a model name and chat history manager.
@@ -45,6 +151,12 @@ class AIImplementation:
         :param debug_logger: The debug logger
         :param output_handler: The output handler to handle output
         :param on_render_text_line: A function that takes in the text line read or None
+        :param model_backend: The backend used to stream from the model,
+            defaults to a pooled HTTP backend with the `ollama run` subprocess as fallback
+        :param context_window_size: Context window size in tokens passed to the model
+        :param prompt_assembler: Fits prompts into the context window, defaults to one
+            using the approximate tokenizer and the default section budgets
+        :param response_cache: Optional cache consulted before asking the model for a chat response
         """
         self.on_render_text_line = on_render_text_line
         self.output_handler = output_handler       
@@ -52,32 +164,36 @@ class AIImplementation:
         self.debug_logger = debug_logger
         self.chat_history_manager = chat_history_manager
         self.world_state_manager = chat_history_manager.world_state_manager
-
-    def build_world_state_system_message(self) -> str:
+        self.context_window_size = context_window_size
+        self.last_timings = {}
+        self.prompt_assembler = prompt_assembler or PromptAssembler(context_window=context_window_size)
+        self.last_prompt_reports = {}
+        self.response_cache = response_cache
+        self.model_backend = model_backend or create_default_backend(
+            model_name, on_fallback=self.report_backend_fallback)
+
+    async def report_backend_fallback(self, error):
+        await self.debug_logger.log(f"Model server unavailable, falling back to ollama run: {error}")
+
+    async def close(self):
+        """Close the model backend and its pooled connections."""
+        await self.model_backend.close()
+
+    def build_world_state_system_message(self, state_lines=None, past_state_lines=()) -> str:
         """
         Build the system message for world state generation.
 
+        :param state_lines: The previous state lines to include, defaults to all of them.
+        :param past_state_lines: Earlier states relevant to the input, one jsonl line each.
         :return: System message string for generating world state.
         """
-
-        state = self.world_state_manager.last_world_state
-        lines = []
-
-        for key, value in state.items():
-            out = {key: value}
-            if key in [
-                'GeneralContextState',
-                'CurrentState',
-                'AbsoluteIdealWorld',
-                'IncrementallyBetterWorld',
-                'AbsoluteAnxietyWorld',
-                'IncrementallyWorseWorld',
-                'TinyNextStepOptions',
-                'EvidenceNeeded'
-            ]:
-                lines.append(json.dumps(out) + "\n")
-
-        lines_string = ''.join(lines)
+        if state_lines is None:
+            state_lines = self.build_world_state_lines()
+        lines_string = ''.join(state_lines)
+        past_string = ''
+        if past_state_lines:
+            past_string = ('\n\nearlier states relevant to this input were:'
+                           '```jsonl\n' + ''.join(past_state_lines) + '```')
         return (
             '''You are a predictive AI. Given the previous state and the chat history 
             return a JSONL object that satisfies the format, replacing any text in <brackets>
@@ -101,20 +217,34 @@ class AIImplementation:
             '```jsonl\n'
             f'{lines_string}'
             '```'
+            f'{past_string}'
         )
 
-    async def build_quick_response_system_message(self) -> str:
+    def build_world_state_lines(self) -> list:
         """
-        Build the system message for quick responses.
+        Convert the last world state into jsonl lines, one per predicted key.
 
-        :return: System message string for quick responses.
+        :return: List of jsonl lines in prompt order.
         """
-        chat_messages = []
-        current_state = self.chat_history_manager.world_state_manager.last_world_state
-        for entry in (await self.chat_history_manager.get_history())[-MAX_HISTORY_LENGTH:]:
-            chat_messages.append(entry)
-            
-        system_content = (
+        state = self.world_state_manager.last_world_state
+        return [json.dumps({key: state[key]}) + "\n" for key in WORLD_STATE_PROMPT_KEYS if key in state]
+
+    async def build_past_state_lines(self, user_input) -> list:
+        """
+        Convert the past world states most relevant to the input into jsonl lines, one per state.
+
+        :return: List of jsonl lines, most relevant first.
+        """
+        return [json.dumps({key: state[key] for key in WORLD_STATE_PROMPT_KEYS if key in state}) + "\n"
+                for state in await self.chat_history_manager.relevant_world_states(user_input)]
+
+    def build_quick_response_persona(self) -> str:
+        """
+        Build the fixed part of the system message for quick responses.
+
+        :return: Persona string for quick responses.
+        """
+        return (
             "You are Lexi, a conversational AI with a limited emotional scope. "
             "You have a strong drive to respect people and to understand things and your effect on the world. "
             "You have a drive to keep conversation interesting, flowing, and fun. "
@@ -122,15 +252,63 @@ class AIImplementation:
             "You have a drive towards pragmatism and forward momentum, prototyping and iterating to move forward. "
             "The system message about current context is your own evaluation. "
             "Please preface your message with a facial emoji and others representing your current mood"
-            f"Recently, you were curious about this: '{current_state.get('KnowledgeGap', 'Unspecified')}'. "
         )
-        
+
+    def build_quick_response_state_notes(self) -> list:
+        """
+        Build the world state notes for quick responses, most important first.
+
+        :return: List of sentences about the current world state.
+        """
+        current_state = self.world_state_manager.last_world_state
+        notes = [f"Recently, you were curious about this: '{current_state.get('KnowledgeGap', 'Unspecified')}'. "]
         # Add TinyNextStep items if present
-        tiny_steps = current_state.get('TinyNextStepOptions', [])
-        for step in tiny_steps:
-            system_content += f"You've thought recently about this being potentially a good idea: {step}. "
+        for step in current_state.get('TinyNextStepOptions', []):
+            notes.append(f"You've thought recently about this being potentially a good idea: {step}. ")
+        return notes
 
-        return system_content
+    async def build_quick_response_system_message(self) -> str:
+        """
+        Build the system message for quick responses.
+
+        :return: System message string for quick responses.
+        """
+        return self.build_quick_response_persona() + ''.join(self.build_quick_response_state_notes())
+
+    async def build_summary_lines(self) -> list:
+        """
+        Convert the summaries of older history into lines, one per summary.
+
+        :return: List of lines, oldest first.
+        """
+        return [f"({summary['first_timestamp']} to {summary['last_timestamp']}) {summary['content']}\n"
+                for summary in await self.chat_history_manager.get_summaries()]
+
+    async def summarize_lines(self, lines: list) -> str:
+        """
+        Ask the model to condense chat lines, or earlier summaries, into one summary.
+
+        :param lines: Lines to summarize, oldest first.
+        :return: The summary, or an empty string if the model failed.
+        """
+        prompt = json.dumps({
+            'messages': [
+                {"role": "system", "content": (
+                    "Summarize the following part of a conversation in a few sentences. "
+                    "Keep names, decisions, facts and open questions; leave out small talk. "
+                    "Reply with the summary only.")},
+                {"role": "user", "content": '\n'.join(lines)},
+            ]
+        })
+        chunks = []
+        try:
+            async for chunk in self.model_backend.stream(prompt, context_window=self.context_window_size,
+                                                         priority=RequestPriority.BACKGROUND):
+                chunks.append(chunk)
+        except Exception as e:
+            await self.debug_logger.log(f"Summarizing failed: {e}")
+            return ''
+        return ''.join(chunks).strip()
 
     async def generate_world_state_prompt(self, user_input) -> str:
         """
@@ -138,41 +316,67 @@ class AIImplementation:
         :return: JSON string containing the prompt for world state generation.
         """
         chat_messages = await self.get_recent_chat_messages()
-        system = self.build_world_state_system_message()
+        kept, report = self.prompt_assembler.assemble([
+            PromptSection('system', [self.build_world_state_system_message([])], required=True),
+            PromptSection('world_state', self.build_world_state_lines()),
+            PromptSection('past_states', await self.build_past_state_lines(user_input)),
+            PromptSection('recent', chat_messages, render=message_text,
+                          priority_order=range(len(chat_messages) - 1, -1, -1)),
+        ], user_input)
+        self.last_prompt_reports['world_state'] = report
+        system = self.build_world_state_system_message(kept['world_state'], kept['past_states'])
         return json.dumps({
             'description' : "this is your current chat log",
             'messages': [
                 {"role": "system", "content": system},
-                *chat_messages,
-                {"role": "user", "content": user_input}
+                *kept['recent'],
+                {"role": "user", "content": kept['user_input']}
             ]
         })
 
     async def get_recent_chat_messages(self) -> list:
         """
-        Retrieve recent chat messages, limiting to the last MAX_HISTORY_LENGTH.
+        Retrieve recent chat messages as role and content, up to RECENT_HISTORY_CANDIDATES.
 
-        :return: List of recent chat messages.
+        :return: List of recent chat messages, oldest first.
         """
-        return (await self.chat_history_manager.get_history())[-MAX_HISTORY_LENGTH:]
+        return [{"role": entry["role"], "content": entry["content"]}
+                for entry in (await self.chat_history_manager.get_history())[-RECENT_HISTORY_CANDIDATES:]]
 
     async def generate_quick_response_prompt(self, user_input: str) -> str:
         """
-        Generate a quick response prompt without world state information.
+        Generate a quick response prompt, fitted to the context window by the prompt assembler.
+
+        History older than the recent messages comes in as summaries, whose number grows
+        with the logarithm of its length, and as the entries relevant to the input.
 
         :param user_input: Input from the user.
         :return: JSON string containing the prompt for a quick response.
         """
         chat_messages = await self.get_recent_chat_messages()
-        context_messages = await self.chat_history_manager.context_history(user_input)
-        print(context_messages)
-        system_content = await self.build_quick_response_system_message()
+        context_messages = [{"role": entry["role"], "content": entry["content"]}
+                            for entry in await self.chat_history_manager.context_history(user_input, roles=CONTEXT_ROLES)]
+        summary_lines = await self.build_summary_lines()
+        kept, report = self.prompt_assembler.assemble([
+            PromptSection('system', [self.build_quick_response_persona()], required=True),
+            PromptSection('world_state', self.build_quick_response_state_notes()),
+            # The newest summaries sit next to the recent messages, so they are kept first
+            PromptSection('summaries', summary_lines, priority_order=range(len(summary_lines) - 1, -1, -1)),
+            PromptSection('recent', chat_messages, render=message_text,
+                          priority_order=range(len(chat_messages) - 1, -1, -1)),
+            PromptSection('context', context_messages, render=message_text),
+        ], user_input)
+        self.last_prompt_reports['response'] = report
+        await self.debug_logger.log(f"Prompt tokens by section: { {name: r['used'] for name, r in report.items()} }")
+        system_content = ''.join(kept['system'] + kept['world_state'])
+        if kept['summaries']:
+            system_content += "\n\nSummary of the conversation before the recent messages:\n" + ''.join(kept['summaries'])
         return json.dumps({
             'messages': [
                 {"role": "system", "content": system_content},
-                *chat_messages,
-                {"role": "system", "content": f"Context relevant messages: {json.dumps(context_messages)}"},
-                {"role": "user", "content": user_input},
+                *kept['recent'],
+                {"role": "system", "content": f"Context relevant messages: {json.dumps(kept['context'])}"},
+                {"role": "user", "content": kept['user_input']},
             ]
         })
 
@@ -184,94 +388,107 @@ class AIImplementation:
         :return: Response from the AI model and any errors encountered.
         """
         await self.debug_logger.log("getting chat response")
+        vector = None
+        cache_context = []
+        if self.response_cache:
+            started = time.perf_counter()
+            cache_context = await self.get_cache_context(user_input)
+            self.response_cache.observe_world_state(self.world_state_manager.last_world_state)
+            cached, vector = await self.response_cache.lookup(user_input, cache_context)
+            if cached is not None:
+                await self.debug_logger.log("Answered from the response cache")
+                await self.output_handler.stream_output(cached, message_type="chatbot")
+                await self.output_handler.end_stream(message_type="chatbot")
+                elapsed = time.perf_counter() - started
+                self.last_timings['response'] = {'time_to_first_token': elapsed, 'total_time': elapsed,
+                                                 'chunks': 1, 'cached': True}
+                return cached, []
+
         prompt = await self.generate_quick_response_prompt(user_input)
-        return await self.run_model_process(prompt)
+        response, errors = await self.run_model_process(prompt)
+        if self.response_cache and response and not errors:
+            await self.response_cache.store(user_input, response, vector, cache_context)
+        return response, errors
+
+    async def get_cache_context(self, user_input: str) -> list:
+        """
+        The turns before this input that a cached answer must share to be reused.
 
-    async def get_prediction_streaming(self, user_input, is_cancelled):
+        :param user_input: Input from the user, already logged as the latest turn.
+        :return: List of recent chat messages, oldest first.
+        """
+        messages = await self.get_recent_chat_messages()
+        if messages and messages[-1] == {"role": "user", "content": user_input}:
+            messages = messages[:-1]
+        return messages[-self.response_cache.context_turns:] if self.response_cache.context_turns else []
+
+    async def get_prediction_streaming(self, user_input, is_cancelled, on_field=None):
         """
         Stream prediction data from the AI model.
 
         :param is_cancelled: Cancellation check function.
+        :param on_field: Optional coroutine function called with each (key, value) as soon as it is parsed.
         :return: Response data from the model, cancellation message, and any errors.
         """
         prompt = await self.generate_world_state_prompt(user_input)
-        return await self.run_model_process(prompt, is_cancelled, is_jsonl=True)
+        return await self.run_model_process(prompt, is_cancelled, is_jsonl=True, on_field=on_field)
 
-    async def run_model_process(self, prompt: str, is_cancelled=None, is_jsonl=False):
+    async def run_model_process(self, prompt: str, is_cancelled=None, is_jsonl=False, on_field=None):
         """
-        Run the model subprocess and handle output, returning response data and errors.
+        Stream the prompt through the model backend and handle output, returning response data and errors.
+
+        Plain responses are streamed chunk by chunk to the output handler as they arrive.
+        JSON responses are parsed incrementally, and each top-level key is added to the
+        response data, and passed to `on_field`, the moment its value is complete.
+        Timings for the call are recorded in `last_timings` under 'world_state' or 'response'.
 
         :param prompt: The prompt to send to the model.
         :param is_cancelled: Optional cancellation check function.
         :param is_jsonl: Set to true to handle jsonl content
+        :param on_field: Optional coroutine function called with each parsed (key, value).
         :return: A tuple containing response data, cancellation message, and errors.
         """
-
-        context_window_size = 8192
-        args = ["context-window", str(context_window_size)]
-        if is_jsonl: args.extend(['--format', 'json'])
-        process = await asyncio.create_subprocess_exec(
-            "ollama", "run", self.model_name, prompt, *args,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=False
-        )
-
         response_data = {}
-        response_lines = []
+        response_chunks = []
         errors = []
-
+        parser = IncrementalJsonParser()
+        timings = {'time_to_first_token': None, 'total_time': None, 'chunks': 0}
+        self.last_timings['world_state' if is_jsonl else 'response'] = timings
+        started = time.perf_counter()
+
+        priority = RequestPriority.BACKGROUND if is_jsonl else RequestPriority.QUICK
+        stream = self.model_backend.stream(prompt, is_jsonl=is_jsonl,
+                                           context_window=self.context_window_size,
+                                           priority=priority)
         try:
-            while True:
-                line = await process.stdout.readline()
-                if not line:
-                    break
-                processed_line, line_errors = process_line_bytes(line, handle_json=is_jsonl)
-                if not is_jsonl:
-                    self.output_handler.queue_output(message=processed_line)
-                if line_errors:
-                    errors.extend(line_errors)
-                elif is_jsonl:
-                    response_data.update(processed_line)
+            async for chunk in stream:
+                if timings['time_to_first_token'] is None:
+                    timings['time_to_first_token'] = time.perf_counter() - started
+                timings['chunks'] += 1
+                if is_jsonl:
+                    for key, value in parser.feed(chunk):
+                        response_data[key] = value
+                        if on_field:
+                            await on_field(key, value)
                 else:
-                    response_lines.append(processed_line + '\n')
+                    response_chunks.append(chunk)
+                    await self.output_handler.stream_output(chunk, message_type="chatbot")
                 if is_cancelled and is_cancelled():
                     break
 
-            await process.wait()
-            return response_data if is_jsonl else ''.join(response_lines), errors
+            return response_data if is_jsonl else ''.join(response_chunks).strip(), errors
 
         except asyncio.CancelledError:
-            process.terminate()
             errors.append("Generation interrupted by user feedback")
-            return response_data, errors
+            return response_data if is_jsonl else ''.join(response_chunks).strip(), errors
 
         except Exception as e:
-            process.terminate()
             errors.append(f"Error in streaming process: {e}")
-            return response_data, errors
-
-
-def process_line_bytes(line: bytes, handle_json=False):
-    """
-    Process a line in bytes, decoding it and attempting to parse JSON.
-
-    :param line: The line in bytes to process.
-    :param handle_json: Flag to indicate if JSON parsing should be attempted.
-    :return: Tuple of processed line or None, and any errors encountered.
-    """
-    try:
-        line = line.decode('utf-8').strip()
-    except UnicodeDecodeError:
-        line = line.decode('latin-1').strip()
-
-    if not handle_json:
-        return line, None
-
-    try:
-        json_line = json.loads(line)
-        return json_line, []
-    except json.JSONDecodeError as e:
-        return None, [f"JSON decoding error on line: {e}"]
-    except Exception as e:
-        return None, [f"Error processing line: {e}"]
+            return response_data if is_jsonl else ''.join(response_chunks).strip(), errors
+
+        finally:
+            errors.extend(parser.close())
+            timings['total_time'] = time.perf_counter() - started
+            await stream.aclose()
+            if not is_jsonl:
+                await self.output_handler.end_stream(message_type="chatbot")
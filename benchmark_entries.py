@@ -0,0 +1,91 @@
+import gc
+import time
+import uuid
+import random
+import argparse
+import tracemalloc
+
+from chat_history.chat_entry import ChatEntry
+from chat_history.loggers import get_timestamp
+
+ROLES = ('user', 'assistant', 'system')
+
+
+def dict_entries(count, content_size):
+    """Entries as HistoryLog kept them before ChatEntry, with strings built apart as they are when read back."""
+    entries = []
+    for number in range(count):
+        now = get_timestamp()
+        entries.append({
+            "id": str(uuid.uuid4()),
+            "role": ''.join(ROLES[number % len(ROLES)]),
+            "content": 'x' * content_size,
+            "timestamp": now,
+            "created": ''.join(now),
+            "updated": ''.join(now),
+            "vector_index": str(number + 1),
+        })
+    return entries
+
+
+def measure_memory(build):
+    """Bytes allocated by build() that are still held by its result."""
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def time_best(function, repeat):
+    """Seconds of the fastest of `repeat` calls."""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def benchmark(args):
+    dicts, dict_bytes = measure_memory(lambda: dict_entries(args.entries, args.content_size))
+    # Converted from entries of their own, so no strings are shared with the dicts measured above
+    compact, compact_bytes = measure_memory(
+        lambda: [ChatEntry.from_dict(entry) for entry in dict_entries(args.entries, args.content_size)])
+    content_bytes = args.entries * (args.content_size + 49)  # The content strings, which both keep
+    print(f"{args.entries} entries with {args.content_size} characters of content")
+    print(f"  dict:      {dict_bytes / args.entries:7.0f} bytes per entry, "
+          f"{(dict_bytes - content_bytes) / args.entries:5.0f} besides content")
+    print(f"  ChatEntry: {compact_bytes / args.entries:7.0f} bytes per entry, "
+          f"{(compact_bytes - content_bytes) / args.entries:5.0f} besides content")
+
+    # Retrieval's lookup: which entries of the window have one of the searched vector ids
+    wanted = random.Random(0).sample(range(1, args.entries + 1), args.lookups)
+    wanted_keys = [str(vector_id) for vector_id in wanted]
+    dict_seconds = time_best(lambda: [entry for entry in dicts if entry['vector_index'] in wanted_keys], args.repeat)
+    compact_seconds = time_best(lambda: [entry for entry in compact if entry.vector_id in wanted], args.repeat)
+    print(f"Scanning for {args.lookups} vector ids in a list")
+    print(f"  dict:      {dict_seconds * 1000:7.2f} ms")
+    print(f"  ChatEntry: {compact_seconds * 1000:7.2f} ms ({dict_seconds / compact_seconds:.1f}x)")
+
+    dict_seconds = time_best(lambda: sorted(dicts, key=lambda entry: entry['timestamp']), args.repeat)
+    compact_seconds = time_best(lambda: sorted(compact, key=lambda entry: entry.timestamp), args.repeat)
+    print("Sorting by timestamp")
+    print(f"  dict:      {dict_seconds * 1000:7.2f} ms")
+    print(f"  ChatEntry: {compact_seconds * 1000:7.2f} ms ({dict_seconds / compact_seconds:.1f}x)")
+
+    dict_seconds = time_best(lambda: [dict(entry) for entry in dicts], args.repeat)
+    compact_seconds = time_best(lambda: [entry.to_dict() for entry in compact], args.repeat)
+    print("Converting to the saved schema, as the writer does")
+    print(f"  dict:      {dict_seconds * 1000:7.2f} ms")
+    print(f"  ChatEntry: {compact_seconds * 1000:7.2f} ms ({dict_seconds / compact_seconds:.1f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the memory and lookup cost of dict and ChatEntry entries.")
+    parser.add_argument('--entries', type=int, default=100000, help="Entries to build")
+    parser.add_argument('--content-size', type=int, default=200, help="Characters of content per entry")
+    parser.add_argument('--lookups', type=int, default=20, help="Vector ids looked up per scan")
+    parser.add_argument('--repeat', type=int, default=5, help="Runs of each timing, the fastest is reported")
+    benchmark(parser.parse_args())
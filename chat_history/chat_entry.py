@@ -0,0 +1,123 @@
+import sys
+from datetime import datetime
+from functools import lru_cache
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+FIELDS = ('id', 'role', 'content', 'timestamp', 'created', 'updated', 'vector_index')
+
+
+def parse_timestamp(value):
+    """Epoch seconds of a timestamp written by get_timestamp, in local time; ints and None pass through."""
+    if value is None or isinstance(value, int):
+        return value
+    return _parse_timestamp(value)
+
+
+# Entries logged close together share their timestamps, so most conversions are cache hits
+@lru_cache(maxsize=4096)
+def _parse_timestamp(value):
+    return int(datetime.fromisoformat(value).timestamp())
+
+
+@lru_cache(maxsize=4096)
+def format_timestamp(seconds):
+    """The get_timestamp string of epoch seconds, or None."""
+    return None if seconds is None else datetime.fromtimestamp(seconds).strftime(TIMESTAMP_FORMAT)
+
+
+def parse_vector_id(value):
+    """The int id of a vector_index column value, or None for '' and None."""
+    if value is None or isinstance(value, int):
+        return value
+    return int(value) if value.isdigit() else None
+
+
+class ChatEntry:
+    """
+    One chat history entry, kept compactly in memory.
+
+    Roles are interned, so every entry shares one string per role. Timestamps are
+    epoch seconds, and an entry whose created and updated times equal its timestamp
+    holds the one int for all three. Vector ids are ints, or None without a vector.
+
+    Entries still read and write like the dicts they replace, with the same keys
+    and string values, so `entry['vector_index']` is '' or a digit string and
+    `dict(entry)` is the row as saved to the database and the JSONL file. Code that
+    wants the compact values reads the attributes.
+    """
+    __slots__ = ('id', 'role', 'content', 'timestamp', 'created', 'updated', 'vector_id')
+
+    def __init__(self, id: str, role: str, content: str, timestamp: int, created: int = None, updated: int = None,
+                 vector_id: int = None):
+        self.id = id
+        self.role = sys.intern(role)
+        self.content = content
+        self.timestamp = timestamp
+        # The same int object when the times match, so the three cost one
+        self.created = timestamp if created is None or created == timestamp else created
+        self.updated = self.created if updated is None or updated == self.created else updated
+        self.vector_id = vector_id
+
+    @classmethod
+    def from_dict(cls, entry):
+        """An entry from a dict, or a row, with the keys of FIELDS."""
+        if isinstance(entry, cls):
+            return entry
+        return cls(entry['id'], entry['role'], entry['content'], parse_timestamp(entry['timestamp']),
+                   parse_timestamp(entry.get('created')), parse_timestamp(entry.get('updated')),
+                   parse_vector_id(entry.get('vector_index')))
+
+    @classmethod
+    def from_row(cls, row):
+        """An entry from a row of id, role, content, timestamp, created, updated and vector_index."""
+        return cls(row[0], row[1], row[2], parse_timestamp(row[3]), parse_timestamp(row[4]),
+                   parse_timestamp(row[5]), parse_vector_id(row[6]))
+
+    def keys(self):
+        return FIELDS
+
+    def __getitem__(self, key):
+        if key == 'vector_index':
+            return '' if self.vector_id is None else str(self.vector_id)
+        if key in ('timestamp', 'created', 'updated'):
+            return format_timestamp(getattr(self, key))
+        if key in ('id', 'role', 'content'):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == 'vector_index':
+            self.vector_id = parse_vector_id(value)
+        elif key in ('timestamp', 'created', 'updated'):
+            setattr(self, key, parse_timestamp(value))
+        elif key == 'role':
+            self.role = sys.intern(value)
+        elif key in ('id', 'content'):
+            setattr(self, key, value)
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in FIELDS
+
+    def __iter__(self):
+        return iter(FIELDS)
+
+    def get(self, key, default=None):
+        return self[key] if key in FIELDS else default
+
+    def to_row(self) -> tuple:
+        """The values of FIELDS, as saved to the database."""
+        return (self.id, self.role, self.content, format_timestamp(self.timestamp), format_timestamp(self.created),
+                format_timestamp(self.updated), '' if self.vector_id is None else str(self.vector_id))
+
+    def to_dict(self) -> dict:
+        return dict(zip(FIELDS, self.to_row()))
+
+    def __eq__(self, other):
+        if isinstance(other, (ChatEntry, dict)):
+            return self.to_dict() == dict(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return f"ChatEntry({self.to_dict()!r})"
@@ -1,34 +1,134 @@
+import time
+import asyncio
+
 from chat_history.world_state_logger import WorldStateLogger
 from output_handler import OutputHandler
 from debug_logger import DebugLogger
 from chat_history.vector_chat_storage import VectorChatStorage
+from chat_history.vector_storage import DEFAULT_VECTOR_MODEL
+from chat_history.embedding_cache import EmbeddingCache
 from chat_history.history_log import HistoryLog
+from chat_history.jsonl_writer import JsonlWriter
+from chat_history.loggers import DEFAULT_SESSION
+from chat_history.hybrid_retriever import HybridRetriever
+from chat_history.history_summarizer import HistorySummarizer
 from chat_history.world_state_manager import WorldStateManager
+from chat_history.world_state_vector_storage import WorldStateVectorStorage
 
 
 class ChatHistoryManager:
     def __init__(self, 
         output_handler: OutputHandler,
-        debug_logger: DebugLogger):
-        self.chat_logger = HistoryLog(output_handler)
-        self.world_state_logger = WorldStateLogger(output_handler)
+        debug_logger: DebugLogger,
+        embedding_workers=1,
+        embedding_cache_path=None,
+        durability='interval',
+        archive_keep=5000,
+        archive_age_days=None,
+        session_id=DEFAULT_SESSION):
+        self.session_id = session_id  # Every store below reads and writes only this conversation
+        self.log_writer = JsonlWriter()  # One thread appends to both history files
+        self.chat_logger = HistoryLog(output_handler, durability=durability, log_writer=self.log_writer,
+                                      session_id=session_id)
+        self.world_state_logger = WorldStateLogger(output_handler, log_writer=self.log_writer, session_id=session_id)
         self.debug_logger = debug_logger
         self.world_state_manager = WorldStateManager(output_handler, self.world_state_logger)
-        self.vector_chat_storage = VectorChatStorage(self.chat_logger, 'chat_vectors.index')
+        # Kept on disk as well as in memory if a path is given
+        embedding_cache = EmbeddingCache(DEFAULT_VECTOR_MODEL, disk_path=embedding_cache_path)
+        self.vector_chat_storage = VectorChatStorage(self.chat_logger, 'chat_vectors.index',
+                                                     embedding_workers=embedding_workers,
+                                                     embedding_cache=embedding_cache,
+                                                     session_id=session_id)
+        self.world_state_vector_storage = WorldStateVectorStorage(self.world_state_logger,
+                                                                  embedding_cache=embedding_cache)
+        self.retriever = HybridRetriever(self.chat_logger, self.vector_chat_storage)
+        self.vectors_ready = False  # Set once the model is loaded and the history vectorized
+        # Held while chat vectors are added, so a catch-up ingest numbers its vectors undisturbed
+        self.vector_lock = asyncio.Lock()
+        self.vector_task = None
+        self.archive_keep = archive_keep  # Newest entries kept in the hot table
+        self.archive_age_days = archive_age_days  # Entries older than this are archived too, if set
+        self.archive_task = None
+        # Summarizes nothing until a model is attached through its `summarize`
+        self.summarizer = HistorySummarizer(self.chat_logger)
+        self.summary_task = None
 
     async def init(self):
         await self.chat_logger.init()
+        await self.summarizer.init_db()
         await self.world_state_logger.init_db()
+        await self.world_state_logger.load_history()
+        # The model loads in the background; until then retrieval is full text only
+        self.vector_task = asyncio.get_running_loop().create_task(self.prepare_vectors())
+        self.archive_task = asyncio.get_running_loop().create_task(self.archive_history())
+
+    async def prepare_vectors(self):
+        model = await self.vector_chat_storage.load_model()
+        self.world_state_vector_storage.set_model(model)
+        # Entries logged while a pass runs have no vector yet, so the next pass picks them up
+        await self.chat_logger.flush()
+        while await self.vector_chat_storage.init_vector_db():
+            await self.chat_logger.flush()
+        async with self.vector_lock:
+            self.vectors_ready = True
+            # Entries logged during the last pass were queued without a vector; catch them up
+            # before log_chat starts giving new ones theirs
+            await self.chat_logger.flush()
+            await self.vector_chat_storage.init_vector_db()
+        self.world_state_manager.state_vectors = self.world_state_vector_storage
+        await self.world_state_vector_storage.init_vector_db()
+
+    async def close(self):
+        if self.vector_task and not self.vector_task.done():
+            self.vector_task.cancel()  # An interrupted ingest resumes on the next start
+            await asyncio.gather(self.vector_task, return_exceptions=True)
+        if self.archive_task and not self.archive_task.done():
+            self.archive_task.cancel()  # Each segment is moved in one transaction, so the rest waits for next time
+            await asyncio.gather(self.archive_task, return_exceptions=True)
+        if self.summary_task and not self.summary_task.done():
+            self.summary_task.cancel()  # Spans are summarized one transaction at a time, so the rest waits
+            await asyncio.gather(self.summary_task, return_exceptions=True)
+        await asyncio.gather(*self.world_state_manager.vector_tasks, return_exceptions=True)
+        await self.vector_chat_storage.close()
+        await self.world_state_vector_storage.close()
+        await self.world_state_logger.save_logs()
+        await self.chat_logger.close()
+        await self.log_writer.close()
 
     async def log_chat(self, role, content):
-        vec_index = await self.vector_chat_storage.save_chat_vector({
-            "role": role,
-            "content": content
-        })
-        print("Vector Index", vec_index)
-        entry = await self.chat_logger.log_entry(role, content, vector_index=str(vec_index))
+        vec_index = None
+        if self.vectors_ready:
+            async with self.vector_lock:
+                vec_index = await self.vector_chat_storage.save_chat_vector({
+                    "role": role,
+                    "content": content
+                })
+        entry = await self.chat_logger.log_entry(role, content, vector_index=vec_index)
         return entry
 
+    async def relevant_world_states(self, input_string, n=3):
+        """Return up to n past world states relevant to the input, leaving out the latest one."""
+        history = self.world_state_logger.chat_history
+        latest = (history[-1]['id'],) if history else ()
+        return await self.world_state_vector_storage.retrieve_states(input_string, n, exclude_ids=latest)
+
+    async def end_turn(self):
+        await self.chat_logger.end_turn()
+        if self.summarizer.summarize and (self.summary_task is None or self.summary_task.done()):
+            self.summary_task = asyncio.get_running_loop().create_task(self.summarize_history())
+
+    async def summarize_history(self):
+        """Condense older history into summaries, logging rather than raising a failure."""
+        try:
+            return await self.summarizer.run()
+        except Exception as e:
+            await self.debug_logger.log(f"Summarizing history failed: {e}")
+            return 0
+
+    async def get_summaries(self):
+        """Summaries of the history before the recent entries, oldest first."""
+        return await self.summarizer.summaries()
+
     async def save_world_state(self, state):
         self.world_state_manager.last_world_state.update(state)
         await self.world_state_manager.save_last_world_state()
@@ -40,17 +140,31 @@ class ChatHistoryManager:
         await self.world_state_manager.load_last_world_state()
 
     async def get_history(self):
-        return self.chat_logger.history
-
-    async def archive_history(self):
-        pass
-
-    async def context_history(self, input_string, n=10):
-        indices, vectors = self.vector_chat_storage.retrieve_vectors(input_string, n)
-        entries = await self.get_history()
-        matches = []
-        print(indices)
-        for entry in entries:
-            if entry['vector_index'] in [str(a) for a in indices]:
-                matches.append(entry)
-        return matches
+        """The recent entries held in memory, oldest first; older ones are paged in from the database."""
+        return list(self.chat_logger.history)
+
+    async def archive_history(self, keep_count=None):
+        """
+        Move entries past the newest `keep_count`, or older than the configured age, into the archive.
+
+        :param keep_count: Entries to keep in the hot table, defaults to the configured number.
+        :return: Number of entries archived.
+        """
+        older_than = None
+        if self.archive_age_days is not None:
+            older_than = time.strftime("%Y-%m-%d %H:%M:%S",
+                                       time.localtime(time.time() - self.archive_age_days * 86400))
+        keep_count = keep_count if keep_count is not None else self.archive_keep
+        # Never archive the entries held in memory for prompts
+        return await self.chat_logger.archive_entries(max(keep_count, self.chat_logger.window), older_than)
+
+    async def context_history(self, input_string, n=10, roles=None, since=None, until=None):
+        """
+        Return up to n past entries relevant to the input.
+
+        :param roles: Roles to keep, or None for all.
+        :param since: Earliest timestamp kept, as written by get_timestamp, or None.
+        :param until: Timestamp entries must be older than, or None.
+        """
+        return await self.retriever.retrieve(input_string, n, lexical_only=not self.vectors_ready,
+                                             roles=roles, since=since, until=until)
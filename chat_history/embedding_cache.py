@@ -0,0 +1,190 @@
+import os
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class EmbeddingCache:
+    """
+    Embeddings keyed by a hash of the model name and the text.
+
+    Recently used embeddings are kept in memory, least recently used first, up to
+    `max_entries`. With a `disk_path`, embeddings are also written to a memory-mapped
+    float32 file of `disk_capacity` slots, reused oldest first once it fills up, so
+    they survive a restart. The slot of each key is kept in a small append-only file
+    next to it.
+
+    New embeddings are queued for the disk tier and written in batches: from a worker
+    thread after each async encode, and on the calling thread after encode_sync. The
+    memory map is only flushed on close; a crashed process still leaves its writes in
+    the OS page cache.
+    """
+
+    def __init__(self, model_name: str, max_entries=4096, disk_path=None, disk_capacity=65536, dimension=768):
+        """
+        :param model_name: Name of the model, part of every key so models never share embeddings.
+        :param max_entries: Embeddings kept in memory.
+        :param disk_path: Path prefix of the on-disk tier, or None to keep embeddings in memory only.
+        :param disk_capacity: Embeddings kept on disk.
+        :param dimension: Number of floats in each embedding.
+        """
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.dimension = dimension
+        self.entries = OrderedDict()  # Key -> embedding, least recently used first
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0}
+        self.disk_path = disk_path
+        self.disk_capacity = disk_capacity
+        self.disk_vectors = None
+        self.disk_slots = {}  # Key -> slot in the disk file
+        self.slot_keys = [None] * disk_capacity if disk_path else []  # Slot -> key
+        self.next_slot = 0
+        self.pending_disk = {}  # Key -> embedding waiting to be written to the disk tier
+        self.disk_lock = threading.Lock()  # Held while a batch is written
+        if disk_path:
+            self.open_disk_tier()
+
+    def key_for(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode('utf-8')).hexdigest()
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.stats['hits'] + self.stats['disk_hits'] + self.stats['misses']
+        return (self.stats['hits'] + self.stats['disk_hits']) / lookups if lookups else 0.0
+
+    def get(self, text: str):
+        """Return the cached embedding of the text, or None."""
+        key = self.key_for(text)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return self.entries[key]
+        slot = self.disk_slots.get(key)
+        if slot is not None:
+            vector = np.array(self.disk_vectors[slot])
+            self.remember(key, vector)
+            self.stats['disk_hits'] += 1
+            return vector
+        self.stats['misses'] += 1
+        return None
+
+    def put(self, text: str, vector):
+        key = self.key_for(text)
+        vector = np.asarray(vector, dtype='float32').reshape(-1)
+        self.remember(key, vector)
+        if self.disk_vectors is not None and key not in self.disk_slots:
+            self.pending_disk[key] = vector
+
+    def remember(self, key, vector):
+        self.entries[key] = vector
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def lookup(self, texts: list):
+        """
+        Look texts up in both tiers.
+
+        :return: Tuple of a float32 array with a row per text, filled in for the cached
+            ones, and a dict of each missing text to its rows.
+        """
+        vectors = np.zeros((len(texts), self.dimension), dtype='float32')
+        missing = {}
+        for row, text in enumerate(texts):
+            vector = self.get(text)
+            if vector is None:
+                missing.setdefault(text, []).append(row)
+            else:
+                vectors[row] = vector
+        return vectors, missing
+
+    async def encode(self, texts: list, encode) -> np.ndarray:
+        """
+        Embed texts, encoding only the ones that aren't cached.
+
+        :param texts: The texts to embed.
+        :param encode: Coroutine function encoding a list of texts into an array of rows.
+        :return: Float32 array with one row per text.
+        """
+        vectors, missing = self.lookup(texts)
+        if missing:
+            self.fill(vectors, missing, await encode(list(missing)))
+            if self.pending_disk:
+                await asyncio.to_thread(self.write_to_disk, self.take_pending())
+        return vectors
+
+    def encode_sync(self, texts: list, encode) -> np.ndarray:
+        """Like encode, for a function that encodes synchronously."""
+        vectors, missing = self.lookup(texts)
+        if missing:
+            self.fill(vectors, missing, encode(list(missing)))
+            self.write_to_disk(self.take_pending())
+        return vectors
+
+    def fill(self, vectors, missing: dict, encoded):
+        encoded = np.asarray(encoded, dtype='float32').reshape(len(missing), self.dimension)
+        for (text, rows), vector in zip(missing.items(), encoded):
+            self.put(text, vector)
+            vectors[rows] = vector
+
+    def open_disk_tier(self):
+        vectors_file, keys_file = self.disk_path + '.f32', self.disk_path + '.keys'
+        mode = 'r+' if os.path.exists(vectors_file) else 'w+'
+        self.disk_vectors = np.memmap(vectors_file, dtype='float32', mode=mode,
+                                      shape=(self.disk_capacity, self.dimension))
+        lines = 0
+        if os.path.exists(keys_file):
+            with open(keys_file, 'r') as file:
+                for line in file:
+                    lines += 1
+                    parts = line.split()
+                    if len(parts) == 2 and int(parts[1]) < self.disk_capacity:
+                        # A '-' frees the slot while a new vector is written to it
+                        self.slot_keys[int(parts[1])] = parts[0] if parts[0] != '-' else None
+                        self.next_slot = (int(parts[1]) + 1) % self.disk_capacity
+        self.disk_slots = {key: slot for slot, key in enumerate(self.slot_keys) if key}
+        if lines > 2 * self.disk_capacity:
+            # Most lines point at reused slots, so keep only the live ones
+            with open(keys_file + '.tmp', 'w') as file:
+                oldest_first = sorted(self.disk_slots.items(),
+                                      key=lambda item: (item[1] - self.next_slot) % self.disk_capacity)
+                file.writelines(f"{key} {slot}\n" for key, slot in oldest_first)
+            os.replace(keys_file + '.tmp', keys_file)
+
+    def take_pending(self) -> dict:
+        pending, self.pending_disk = self.pending_disk, {}
+        return pending
+
+    def write_to_disk(self, pending: dict):
+        """Write a batch of embeddings to the next slots, with one append to the keys file for each step."""
+        if not pending:
+            return
+        with self.disk_lock:
+            batch = [(key, vector) for key, vector in pending.items() if key not in self.disk_slots]
+            batch = batch[-self.disk_capacity:]  # A batch larger than the file would overwrite itself
+            slots = [(self.next_slot + offset) % self.disk_capacity for offset in range(len(batch))]
+            self.next_slot = (self.next_slot + len(batch)) % self.disk_capacity
+            with open(self.disk_path + '.keys', 'a') as file:
+                freed = [slot for slot in slots if self.slot_keys[slot]]
+                if freed:
+                    # Free the slots before overwriting them, so a crash can't leave old keys on new vectors
+                    for slot in freed:
+                        self.disk_slots.pop(self.slot_keys[slot], None)
+                        self.slot_keys[slot] = None
+                    file.writelines(f"- {slot}\n" for slot in freed)
+                    file.flush()
+                for slot, (key, vector) in zip(slots, batch):
+                    self.disk_vectors[slot] = vector
+                file.writelines(f"{key} {slot}\n" for slot, (key, _) in zip(slots, batch))
+            for slot, (key, _) in zip(slots, batch):
+                self.slot_keys[slot] = key
+                self.disk_slots[key] = slot
+
+    def close(self):
+        """Write the embeddings still queued and flush the disk tier."""
+        if self.disk_vectors is not None:
+            self.write_to_disk(self.take_pending())
+            self.disk_vectors.flush()
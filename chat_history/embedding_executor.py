@@ -0,0 +1,132 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
+
+worker_model = None  # The sentence model of a process pool worker, loaded once by load_worker_model
+
+
+def load_worker_model(model_name: str):
+    global worker_model
+    from sentence_transformers import SentenceTransformer
+    worker_model = SentenceTransformer(model_name)
+
+
+def encode_in_worker(texts: list, batch_size: int):
+    return worker_model.encode(texts, batch_size=batch_size)
+
+
+class EmbeddingExecutor:
+    """
+    Runs sentence model encoding off the event loop.
+
+    Encode requests that arrive within `batch_window` seconds of each other are
+    coalesced into one call to the model, up to `max_batch_size` texts, and the
+    results are split back out to each caller. Encoding runs in a thread pool by
+    default; with `use_processes` it runs in a process pool where every worker
+    loads its own copy of the model once, by name.
+    """
+
+    def __init__(self, vector_model=None, workers=1, max_batch_size=64, batch_window=0.005,
+                 use_processes=False, model_name=None):
+        """
+        :param vector_model: Model encoded with in the thread pool.
+        :param workers: Number of threads or processes encoding at once.
+        :param max_batch_size: Texts coalesced into one call before it is sent without waiting.
+        :param batch_window: Seconds to wait for more requests before encoding a batch.
+        :param use_processes: Set to true to encode in worker processes instead of threads.
+        :param model_name: Name of the model each worker process loads.
+        """
+        if use_processes and not model_name:
+            raise ValueError("A model_name is needed to load the model in worker processes")
+        self.vector_model = vector_model
+        self.workers = workers
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.use_processes = use_processes
+        self.model_name = model_name
+        self.pool = None
+        self.pending = []  # (texts, future) requests waiting for the next batch
+        self.flush_task = None
+        self.batch_tasks = set()  # Batches being encoded, referenced so they aren't collected
+        self.stats = {'requests': 0, 'batches': 0, 'texts': 0}
+
+    def get_pool(self):
+        """Return the worker pool, starting it on first use."""
+        if self.pool is None:
+            if self.use_processes:
+                self.pool = ProcessPoolExecutor(self.workers, initializer=load_worker_model,
+                                                initargs=(self.model_name,))
+            else:
+                self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix='embedding')
+        return self.pool
+
+    async def encode(self, texts):
+        """
+        Encode a text or a list of texts without blocking the event loop.
+
+        :param texts: A string, or a list of strings.
+        :return: A float32 vector for a string, or an array with one row per text for a list.
+        """
+        single = isinstance(texts, str)
+        batch = [texts] if single else list(texts)
+        if not batch:
+            return np.zeros((0, 768), dtype='float32')
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((batch, future))
+        self.stats['requests'] += 1
+        if sum(len(texts) for texts, _ in self.pending) >= self.max_batch_size:
+            self.flush()
+        elif self.flush_task is None:
+            self.flush_task = loop.create_task(self.flush_later())
+        vectors = await future
+        return vectors[0] if single else vectors
+
+    async def flush_later(self):
+        await asyncio.sleep(self.batch_window)
+        self.flush_task = None
+        self.flush()
+
+    def flush(self):
+        """Send every pending request to the pool as one batch."""
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        requests, self.pending = self.pending, []
+        if requests:
+            task = asyncio.get_running_loop().create_task(self.run_batch(requests))
+            self.batch_tasks.add(task)
+            task.add_done_callback(self.batch_tasks.discard)
+
+    async def run_batch(self, requests):
+        texts = [text for batch, _ in requests for text in batch]
+        self.stats['batches'] += 1
+        self.stats['texts'] += len(texts)
+        loop = asyncio.get_running_loop()
+        try:
+            if self.use_processes:
+                vectors = await loop.run_in_executor(self.get_pool(), encode_in_worker, texts, len(texts))
+            else:
+                vectors = await loop.run_in_executor(
+                    self.get_pool(), lambda: self.vector_model.encode(texts, batch_size=len(texts)))
+        except asyncio.CancelledError:
+            for _, future in requests:
+                future.cancel()
+            raise
+        except BaseException as e:
+            for _, future in requests:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        vectors = np.asarray(vectors, dtype='float32').reshape(len(texts), -1)
+        offset = 0
+        for batch, future in requests:
+            if not future.done():
+                future.set_result(vectors[offset:offset + len(batch)])
+            offset += len(batch)
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
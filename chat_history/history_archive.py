@@ -0,0 +1,90 @@
+import os
+import gzip
+import json
+from collections import OrderedDict
+
+
+class HistoryArchive:
+    """
+    Immutable, gzip-compressed segment files of archived chat entries.
+
+    Each segment holds a run of entries as JSON lines and is never changed once
+    written. `manifest.json` lists every segment with its entry count, time range and
+    vector id range, so a segment can be picked without opening it. Recently read
+    segments are kept decompressed in memory, up to `cached_segments` of them.
+    """
+
+    def __init__(self, directory='logs/archive', cached_segments=4):
+        """
+        :param directory: Directory the segments and manifest are kept in.
+        :param cached_segments: Number of decompressed segments kept in memory.
+        """
+        self.directory = directory
+        self.cached_segments = cached_segments
+        self.cache = OrderedDict()  # Segment name -> {entry id: entry}, least recently used first
+        self.manifest_path = os.path.join(directory, 'manifest.json')
+        self.manifest = self.load_manifest()
+
+    def load_manifest(self) -> list:
+        if not os.path.exists(self.manifest_path):
+            return []
+        with open(self.manifest_path, 'r') as file:
+            return json.load(file)
+
+    def write_segment(self, entries: list) -> dict:
+        """
+        Write entries to a new segment and add it to the manifest.
+
+        :param entries: Entries in the order they were logged.
+        :return: The segment's manifest record.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        number = max((int(segment['name'].split('-')[1].split('.')[0]) for segment in self.manifest), default=0) + 1
+        name = f"segment-{number:06d}.jsonl.gz"
+        path = os.path.join(self.directory, name)
+        with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as file:
+            for entry in entries:
+                file.write(json.dumps(entry) + '\n')
+        os.replace(path + '.tmp', path)
+        vector_ids = [int(entry['vector_index']) for entry in entries if str(entry.get('vector_index') or '').isdigit()]
+        record = {
+            'name': name,
+            'count': len(entries),
+            'first_timestamp': entries[0]['timestamp'],
+            'last_timestamp': entries[-1]['timestamp'],
+            'min_vector_id': min(vector_ids, default=None),
+            'max_vector_id': max(vector_ids, default=None),
+        }
+        self.manifest.append(record)
+        with open(self.manifest_path + '.tmp', 'w') as file:
+            json.dump(self.manifest, file, indent=1)
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+        return record
+
+    def read_segment(self, name: str) -> dict:
+        """The entries of a segment by id, decompressing it unless it is cached."""
+        if name in self.cache:
+            self.cache.move_to_end(name)
+            return self.cache[name]
+        with gzip.open(os.path.join(self.directory, name), 'rt', encoding='utf-8') as file:
+            entries = {entry['id']: entry for entry in map(json.loads, file)}
+        self.cache[name] = entries
+        while len(self.cache) > self.cached_segments:
+            self.cache.popitem(last=False)
+        return entries
+
+    def get_entries(self, locations) -> dict:
+        """
+        Read archived entries.
+
+        :param locations: Iterable of (entry id, segment name) tuples.
+        :return: Dict of entry id to entry.
+        """
+        found = {}
+        by_segment = {}
+        for entry_id, name in locations:
+            by_segment.setdefault(name, []).append(entry_id)
+        for name, entry_ids in by_segment.items():
+            entries = self.read_segment(name)
+            found.update({entry_id: entries[entry_id] for entry_id in entry_ids if entry_id in entries})
+        return found
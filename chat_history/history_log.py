@@ -1,18 +1,83 @@
+import os
+import re
 import json
+import time
 import uuid
-from sqlite3 import IntegrityError
+import asyncio
+from collections import deque
 
 import aiosqlite
+import numpy as np
 
-from chat_history.loggers import BaseLogger, get_timestamp
+from chat_history.loggers import BaseLogger, session_path, DEFAULT_SESSION
+from chat_history.chat_entry import ChatEntry, parse_vector_id, parse_timestamp
+from chat_history.jsonl_writer import JsonlWriter, read_records, read_segment, segment_paths
+from chat_history.history_archive import HistoryArchive
 from output_handler import OutputHandler
 
 class HistoryLog(BaseLogger):
+    """
+    Chat history kept in SQLite and appended to a JSONL file.
+
+    Only the most recent `window` entries are held in memory, in `history`, for
+    building prompts, as compact ChatEntry records. Older entries are read from the database a page at a time,
+    keyed on rowid, so startup and memory don't grow with the length of the history.
+
+    Logged entries are queued and written by a background writer, which gathers
+    everything logged within `flush_interval` seconds into one transaction. With
+    'turn' durability, end_turn also waits for the writer, and SQLite syncs every
+    commit; with 'interval' durability a crash can lose the last window of entries.
+    Everything queued is written on close.
+
+    Old entries can be moved out of the table into compressed archive segments. The
+    table `{table_name}_archived` keeps only the id, segment, vector id, role and
+    timestamp of each, so get_by_id and get_by_vector_indices still find them and
+    filtered vector searches still reach them.
+
+    Many conversations can share the database: each row carries the `session_id` of
+    its conversation, every query is restricted to this log's session through indexes
+    led by session_id, and the history file and archive are kept per session.
+
+    Filtered vector searches are restricted by a mask of vector ids built in memory,
+    from the role and timestamp of each vectorized entry. They are read from the
+    table once, on the first filtered search, and kept up to date as entries are
+    written and vectorized, so filtering doesn't read every matching id each turn.
+    """
+    DURABILITY_MODES = ('turn', 'interval')
+
     def __init__(self, output_handler: OutputHandler, db_name='logs/chat_db',
-                 table_name='chat_history', file_name='chat_history.jsonl'):
-        super().__init__(output_handler, db_name, table_name, file_name)
-        self.history = self.load_from_file()
-        self.archived_history = self.load_from_file()
+                 table_name='chat_history', file_name='chat_history.jsonl', window=200,
+                 durability='interval', flush_interval=0.05, log_writer: JsonlWriter = None,
+                 archive_dir='logs/archive', segment_size=5000, session_id=DEFAULT_SESSION):
+        """
+        :param window: Number of recent entries held in memory.
+        :param durability: 'turn' to flush at the end of every turn, or 'interval' to only flush on the timer.
+        :param flush_interval: Seconds the writer waits to gather entries into one transaction.
+        :param log_writer: Writer the history file is appended through, shared with other logs;
+            defaults to one of its own.
+        :param archive_dir: Directory of the archive segments.
+        :param segment_size: Largest number of entries per archive segment.
+        :param session_id: Conversation this log reads and writes; other sessions' rows are never read.
+        """
+        if durability not in self.DURABILITY_MODES:
+            raise ValueError(f"Unknown durability {durability!r}, expected one of {', '.join(self.DURABILITY_MODES)}")
+        super().__init__(output_handler, db_name, table_name, session_path(file_name, session_id))
+        self.session_id = session_id
+        self.window = window
+        self.history = deque(maxlen=window)
+        self.durability = durability
+        self.flush_interval = flush_interval
+        self.flush_requested = asyncio.Event()
+        self.writer_task = None
+        self.owns_log_writer = log_writer is None
+        self.log_writer = log_writer or JsonlWriter()
+        self.archive = HistoryArchive(session_path(archive_dir, session_id))
+        self.segment_size = segment_size
+        # Role code and epoch timestamp of each vector id, 0 where no entry has it
+        self.vector_roles = np.zeros(0, dtype='uint8')
+        self.vector_times = np.zeros(0, dtype='int64')
+        self.role_codes = {}
+        self.vector_attributes_loaded = False
 
     async def init(self):
         await self.init_db()
@@ -22,6 +87,11 @@ class HistoryLog(BaseLogger):
         """Initialize the database and create the chat history table."""
         try:
             self.connection = await aiosqlite.connect(self.db_name)
+            # WAL lets reads run during a write and makes each commit an append
+            await self.connection.execute("PRAGMA journal_mode=WAL")
+            await self.connection.execute(f"PRAGMA synchronous={'FULL' if self.durability == 'turn' else 'NORMAL'}")
+            await self.connection.execute("PRAGMA temp_store=MEMORY")
+            await self.connection.execute("PRAGMA busy_timeout=5000")
             async with self.connection.cursor() as cursor:
                 await cursor.execute(f"""
                 CREATE TABLE IF NOT EXISTS {self.table_name} (
@@ -31,9 +101,46 @@ class HistoryLog(BaseLogger):
                     timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    vector_index TEXT
+                    vector_index TEXT,
+                    session_id TEXT NOT NULL DEFAULT '{DEFAULT_SESSION}'
                     )
                 """)
+                await cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS {self.table_name}_archived (
+                    id VARCHAR(36) PRIMARY KEY,
+                    segment TEXT,
+                    vector_index TEXT,
+                    session_id TEXT NOT NULL DEFAULT '{DEFAULT_SESSION}',
+                    role VARCHAR(10),
+                    timestamp TIMESTAMP
+                    )
+                """)
+                await self.add_session_column(cursor, self.table_name)
+                await self.add_session_column(cursor, f"{self.table_name}_archived")
+                await self.add_archived_filter_columns(cursor)
+                # Every query is led by the session, so one conversation never scans another's rows.
+                # Windows and pages are read in (timestamp, rowid) order
+                await cursor.execute(f"""
+                CREATE INDEX IF NOT EXISTS {self.table_name}_session_timestamp
+                ON {self.table_name} (session_id, timestamp)
+                """)
+                # Retrieval filters by role and time range
+                await cursor.execute(f"""
+                CREATE INDEX IF NOT EXISTS {self.table_name}_session_role_timestamp
+                ON {self.table_name} (session_id, role, timestamp)
+                """)
+                # Retrieval looks entries up by the id of their vector, which is only unique within a session
+                await cursor.execute(f"""
+                CREATE INDEX IF NOT EXISTS {self.table_name}_session_vector_index
+                ON {self.table_name} (session_id, vector_index)
+                """)
+                await cursor.execute(f"""
+                CREATE INDEX IF NOT EXISTS {self.table_name}_archived_session_vector_index
+                ON {self.table_name}_archived (session_id, vector_index)
+                """)
+                for replaced in ('vector_index', 'role_timestamp', 'archived_vector_index'):
+                    await cursor.execute(f"DROP INDEX IF EXISTS {self.table_name}_{replaced}")
+                await self.init_text_search(cursor)
                 await self.connection.commit()
                 await self.output_handler.send_output(f"Table {self.table_name} in {self.db_name} initialises",
                                                  message_type="system")
@@ -41,27 +148,152 @@ class HistoryLog(BaseLogger):
             await self.output_handler.send_output(
                 f"Error initializing database: {str(e)}", message_type="error"
             )
+            return
+        await self.backfill_archived_filter_columns()
+
+    @staticmethod
+    async def add_session_column(cursor, table):
+        """Add the session_id column to a table created before there were sessions; its rows join the default one."""
+        await cursor.execute(f"PRAGMA table_info({table})")
+        if 'session_id' not in [row[1] for row in await cursor.fetchall()]:
+            await cursor.execute(
+                f"ALTER TABLE {table} ADD COLUMN session_id TEXT NOT NULL DEFAULT '{DEFAULT_SESSION}'")
+
+    async def add_archived_filter_columns(self, cursor):
+        """Add the role and timestamp columns to an archived table created before they were kept."""
+        table = f"{self.table_name}_archived"
+        await cursor.execute(f"PRAGMA table_info({table})")
+        columns = [row[1] for row in await cursor.fetchall()]
+        if 'role' not in columns:
+            await cursor.execute(f"ALTER TABLE {table} ADD COLUMN role VARCHAR(10)")
+        if 'timestamp' not in columns:
+            await cursor.execute(f"ALTER TABLE {table} ADD COLUMN timestamp TIMESTAMP")
+
+    async def backfill_archived_filter_columns(self):
+        """Fill in the role and timestamp of entries archived before they were kept, from their segments."""
+        try:
+            async with self.save_lock:
+                entries = await self.get_archived_entries(
+                    f"SELECT id, segment FROM {self.table_name}_archived WHERE session_id = ? AND role IS NULL",
+                    (self.session_id,))
+                if not entries:
+                    return
+                await self.connection.executemany(
+                    f"UPDATE {self.table_name}_archived SET role = ?, timestamp = ? WHERE id = ?",
+                    [(entry['role'], entry['timestamp'], entry_id) for entry_id, entry in entries.items()])
+                await self.connection.commit()
+        except Exception as e:
+            await self.output_handler.send_output(
+                f"Error reading the roles of archived entries: {str(e)}", message_type="warning"
+            )
+
+    async def init_text_search(self, cursor):
+        """Create the full text index of entry content, kept in sync with the table by triggers."""
+        fts = f"{self.table_name}_fts"
+        await cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (fts,))
+        exists = await cursor.fetchone() is not None
+        await cursor.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS {fts}
+        USING fts5(content, content='{self.table_name}', content_rowid='rowid')
+        """)
+        await cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {self.table_name} BEGIN
+            INSERT INTO {fts} (rowid, content) VALUES (new.rowid, new.content);
+        END
+        """)
+        await cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {self.table_name} BEGIN
+            INSERT INTO {fts} ({fts}, rowid, content) VALUES ('delete', old.rowid, old.content);
+        END
+        """)
+        await cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF content ON {self.table_name} BEGIN
+            INSERT INTO {fts} ({fts}, rowid, content) VALUES ('delete', old.rowid, old.content);
+            INSERT INTO {fts} (rowid, content) VALUES (new.rowid, new.content);
+        END
+        """)
+        if not exists:
+            # Index the rows written before the table existed
+            await cursor.execute(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
 
     async def load_history(self):
-        """Load chat history from database or file."""
+        """Load the most recent `window` entries from the database, or from the file if that fails."""
         try:
-            self.history =  await self.load_from_db()
+            entries, _ = await self.entries_before(limit=self.window)
+            self.history = deque(entries, maxlen=self.window)
         except Exception as e:
             await self.output_handler.send_output(
                 f"Error loading from DB: {str(e)}. Loading from file.",
                 message_type="system"
             )
-            self.history = self.load_from_file()
+            self.history = deque(map(ChatEntry.from_dict, self.load_from_file()), maxlen=self.window)
+
+    async def entries_before(self, before=None, limit=50):
+        """
+        Read a page of entries older than a cursor, for paging back through the history.
+
+        :param before: Cursor returned by the previous call, or None to start at the newest entry.
+        :param limit: Largest number of entries returned.
+        :return: Tuple of the entries, oldest first, and the cursor of the page before them,
+            or None if there is none.
+        """
+        where, params = '', [self.session_id]
+        if before is not None:
+            where = " AND (timestamp, rowid) < (?, ?)"
+            params.extend(before)
+        async with self.connection.cursor() as cursor:
+            await cursor.execute(f"""
+                SELECT id, role, content, timestamp, created, updated, vector_index, rowid
+                FROM {self.table_name} WHERE session_id = ?{where}
+                ORDER BY timestamp DESC, rowid DESC LIMIT ?
+            """, (*params, limit))
+            rows = await cursor.fetchall()
+        rows.reverse()
+        return [self.row_to_entry(row) for row in rows], ((rows[0][3], rows[0][7]) if len(rows) == limit else None)
+
+    async def entries_after(self, after=None, limit=500, unvectorized_only=False):
+        """
+        Read a page of entries newer than a cursor, for walking the history oldest first.
+
+        :param after: Cursor returned by the previous call, or None to start at the oldest entry.
+        :param limit: Largest number of entries returned.
+        :param unvectorized_only: Set to true to skip entries that have a vector.
+        :return: Tuple of the entries and the cursor of the page after them, or None if there is none.
+        """
+        where, params = '', [self.session_id]
+        if after is not None:
+            where = " AND (timestamp, rowid) > (?, ?)"
+            params.extend(after)
+        if unvectorized_only:
+            where += " AND (vector_index IS NULL OR vector_index = '')"
+        async with self.connection.cursor() as cursor:
+            await cursor.execute(f"""
+                SELECT id, role, content, timestamp, created, updated, vector_index, rowid
+                FROM {self.table_name} WHERE session_id = ?{where}
+                ORDER BY timestamp, rowid LIMIT ?
+            """, (*params, limit))
+            rows = await cursor.fetchall()
+        return [self.row_to_entry(row) for row in rows], ((rows[-1][3], rows[-1][7]) if len(rows) == limit else None)
+
+    async def iter_entries(self, page_size=500, unvectorized_only=False):
+        """Yield every entry of the session, oldest first, reading `page_size` at a time."""
+        entries, after = await self.entries_after(None, page_size, unvectorized_only)
+        while True:
+            for entry in entries:
+                yield entry
+            if after is None:
+                break
+            entries, after = await self.entries_after(after, page_size, unvectorized_only)
 
     async def load_from_db(self):
-        """Load history from the database."""
+        """Load the session's whole history from the database, for tools that compare it against the other stores."""
         history = []
         try:
             async with self.connection.cursor() as cursor:
                 await cursor.execute(f"""
                     SELECT id, role, content, timestamp, created, updated, vector_index 
-                    FROM {self.table_name}
-                """)
+                    FROM {self.table_name} WHERE session_id = ?
+                """, (self.session_id,))
                 async for row in cursor:
                     # Check if the row has the expected number of columns
                     if len(row) < 6:  # Ensure we have at least 6 columns
@@ -88,16 +320,15 @@ class HistoryLog(BaseLogger):
             await self.output_handler.queue_output(
                 f"Error loading from database: {str(e)}", message_type="error"
             )
-        self.history = history
         return history
 
     def load_from_file(self):
-        """Load history from a JSON file."""
+        """Load history from a JSON file and its rotated segments."""
         history = []
         try:
-            with open(self.history_file, 'r') as file:
-                for line in file:
-                    history.append(json.loads(line))
+            history = list(read_records(self.history_file))
+            if not history and not os.path.exists(self.history_file):
+                raise FileNotFoundError(self.history_file)
             self.output_handler.queue_output(
                 f"Chat history loaded from {self.history_file}.",
                 message_type="system"
@@ -115,95 +346,426 @@ class HistoryLog(BaseLogger):
         return history
 
     async def save_logs(self, logs=None):
-        """Save the current chat history to the database and/or file."""
+        """Save entries, or the in-memory window, to the database and file now, bypassing the writer."""
         if logs:
+            logs = [ChatEntry.from_dict(entry) for entry in logs]
             self.history.extend(logs)
-        logs = logs or self.history
+        logs = logs or list(self.history)
         if logs:
-            async with self.save_lock:
-                try:
-                    async with self.connection.cursor() as cursor:
-                        for entry in logs:
-                            await cursor.execute(f"""
-                                INSERT INTO {self.table_name} 
-                                (id, role, content, timestamp, created, updated, 
-                                vector_index)
-                                VALUES (?, ?, ?, ?, ?, ?, ?)
-                            """, (entry["id"], entry["role"], entry["content"],
-                                  entry["timestamp"], entry["created"],
-                                  entry["updated"], entry["vector_index"]))  # Update to vector_index
-                        await self.connection.commit()
-                    await self.output_handler.send_output(
-                        f"Chat history saved to {self.table_name}."
-                    )
-                except IntegrityError as e:
-                    self.output_handler.queue_output(
-                        f"Duplicate ID detected for {entry['id']} {entry['content']}. Skipping this entry.",
-                        message_type="warning"
-                    )
-                except Exception as e:
-                    await self.output_handler.send_output(
-                        f"Error saving to database: {str(e)}", message_type="error"
-                    )
+            await self.write_entries(logs)
 
+    async def write_entries(self, entries):
+        """Insert entries in one transaction and append them to the file, skipping ids already saved."""
+        async with self.save_lock:
             try:
-                with open(self.history_file, 'a') as file:
-                    for entry in logs:
-                        file.write(json.dumps(entry))
-                        file.write('\n')
-            except IOError as e:
+                async with self.connection.cursor() as cursor:
+                    await cursor.executemany(f"""
+                        INSERT OR IGNORE INTO {self.table_name}
+                        (id, role, content, timestamp, created, updated, vector_index, session_id)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    """, [(*entry.to_row(), self.session_id) for entry in entries])
+                    if cursor.rowcount < len(entries):
+                        self.output_handler.queue_output(
+                            f"Skipped {len(entries) - cursor.rowcount} entries with duplicate IDs.",
+                            message_type="warning"
+                        )
+                await self.connection.commit()
+                if self.vector_attributes_loaded:
+                    self.record_vectors([(entry.vector_id, entry.role, entry.timestamp) for entry in entries])
+            except Exception as e:
                 await self.output_handler.send_output(
-                    f"Error saving to file: {str(e)}", message_type="error"
+                    f"Error saving to database: {str(e)}", message_type="error"
                 )
+        await self.append_to_file(entries)
+
+    def start_writer(self):
+        if self.writer_task is None or self.writer_task.done():
+            self.writer_task = asyncio.get_running_loop().create_task(self.process_save_queue())
+
+    async def process_save_queue(self):
+        """Write queued entries in the background, one transaction per flush window."""
+        while True:
+            batch = [await self.save_queue.get()]
+            try:
+                await asyncio.wait_for(self.flush_requested.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_requested.clear()
+            while not self.save_queue.empty():
+                batch.append(self.save_queue.get_nowait())
+            try:
+                await self.write_entries(batch)
+            finally:
+                for _ in batch:
+                    self.save_queue.task_done()
+
+    async def flush(self):
+        """Wait until every queued entry has been written to the database and the file."""
+        if not self.save_queue.empty() or (self.writer_task is not None and not self.writer_task.done()):
+            self.start_writer()
+            self.flush_requested.set()
+            await self.save_queue.join()
+            self.flush_requested.clear()
+        await self.log_writer.flush()
+
+    async def end_turn(self):
+        """Mark the end of a user turn, waiting for its entries to be written under 'turn' durability."""
+        if self.durability == 'turn':
+            await self.flush()
+
+    async def close(self):
+        """Write everything queued, stop the writer and close the database."""
+        await self.flush()
+        if self.writer_task is not None:
+            self.writer_task.cancel()
+            await asyncio.gather(self.writer_task, return_exceptions=True)
+        if self.owns_log_writer:
+            await self.log_writer.close()
+        else:
+            await self.log_writer.flush()
+        if self.connection is not None:
+            await self.connection.close()
+
+    async def append_to_file(self, logs):
+        """Queue entries to be appended to the JSONL history file by the log writer's thread."""
+        self.log_writer.append(self.history_file, [ChatEntry.from_dict(entry).to_dict() for entry in logs])
+        for e in self.log_writer.take_errors():
+            await self.output_handler.send_output(
+                f"Error saving to file: {str(e)}", message_type="error"
+            )
+
+    async def restore_entries(self, entries):
+        """
+        Insert entries into the session in one transaction, skipping ids the database already has.
+
+        :param entries: Entries to insert, such as ones found only in the history file.
+        """
+        try:
+            async with self.save_lock:
+                await self.connection.executemany(f"""
+                    INSERT OR IGNORE INTO {self.table_name}
+                    (id, role, content, timestamp, created, updated, vector_index, session_id)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """, [(entry["id"], entry["role"], entry["content"], entry["timestamp"], entry["created"],
+                       entry["updated"], entry.get("vector_index") or '', self.session_id) for entry in entries])
+                await self.connection.commit()
+                if self.vector_attributes_loaded:
+                    self.record_vectors([(entry.get("vector_index"), entry["role"], entry["timestamp"])
+                                         for entry in entries])
+        except Exception as e:
+            await self.output_handler.send_output(
+                f"Error restoring chat entries: {str(e)}", message_type="error"
+            )
 
     async def log_entry(self, role, content, vector_index=None, entry_id=None):
-        now = get_timestamp()
-        entry_id = entry_id or str(uuid.uuid4())
-
-        entry = {
-            "id": entry_id,  # Generate a GUID for each entry
-            "role": role,
-            "content": content,
-            "timestamp": now,
-            "created": now,
-            "updated": now,  # Set created and updated timestamps
-            "vector_index": vector_index if vector_index is not None else ''  # Set vector index or empty
-        }
+        entry = ChatEntry(
+            entry_id or str(uuid.uuid4()),  # Generate a GUID for each entry
+            role,
+            content,
+            int(time.time()),  # Also the created and updated times
+            vector_id=parse_vector_id(vector_index)
+        )
         self.history.append(entry)
-
-        await self.save_logs([entry])
+        self.save_queue.put_nowait(entry)  # Written by the background writer
+        self.start_writer()
         return entry
 
+    async def update_vector_indices(self, updates):
+        """
+        Set the vector index of many entries in one transaction.
+
+        :param updates: Iterable of (vector_index, entry_id) tuples.
+        """
+        updates = list(updates)
+        try:
+            async with self.save_lock:
+                await self.connection.executemany(
+                    f"UPDATE {self.table_name} SET vector_index = ? WHERE id = ?", updates)
+                await self.connection.commit()
+                if self.vector_attributes_loaded:
+                    for start in range(0, len(updates), 500):
+                        chunk = [entry_id for _, entry_id in updates[start:start + 500]]
+                        async with self.connection.execute(f"""
+                            SELECT vector_index, role, timestamp FROM {self.table_name}
+                            WHERE id IN ({', '.join('?' * len(chunk))})
+                        """, chunk) as cursor:
+                            self.record_vectors(await cursor.fetchall())
+        except Exception as e:
+            await self.output_handler.send_output(
+                f"Error updating vector indices: {str(e)}", message_type="error"
+            )
+
     async def get_by_id(self, entry_id: str):
         """Retrieve a chat log entry by its ID."""
         try:
             async with self.connection.cursor() as cursor:
                 await cursor.execute(f"""
                     SELECT role, content, timestamp, created, updated, vector_index 
-                    FROM {self.table_name} WHERE id = ?
-                """, (entry_id,))
+                    FROM {self.table_name} WHERE id = ? AND session_id = ?
+                """, (entry_id, self.session_id))
                 row = await cursor.fetchone()
                 if row:
-                    entry = {
-                        "id": entry_id,
-                        "role": row[0],
-                        "content": row[1],
-                        "timestamp": row[2],
-                        "created": row[3],
-                        "updated": row[4],
-                        "vector_index": row[5]  # Update to vector_index
-                    }
+                    entry = ChatEntry.from_row((entry_id, *row))
                     await self.output_handler.send_output(
                         f"Chat entry retrieved: {entry}", message_type="system"
                     )
                     return entry
-                else:
-                    await self.output_handler.send_output(
-                        f"No chat entry found with ID: {entry_id}", message_type="warning"
-                    )
-                    return None
+                archived = await self.get_archived_entries(
+                    f"SELECT id, segment FROM {self.table_name}_archived WHERE id = ? AND session_id = ?",
+                    [entry_id, self.session_id])
+                if archived:
+                    return archived[entry_id]
+                await self.output_handler.send_output(
+                    f"No chat entry found with ID: {entry_id}", message_type="warning"
+                )
+                return None
         except Exception as e:
             await self.output_handler.send_output(
                 f"Error retrieving chat entry by ID: {str(e)}", message_type="error"
             )
             return None
+
+    async def get_by_vector_indices(self, vector_indices):
+        """
+        Retrieve the entries whose vectors have the given ids, in the order of the ids.
+
+        :param vector_indices: Vector ids, as returned by a vector search.
+        :return: List of entries; ids with no entry are skipped.
+        """
+        keys = [int(vector_index) for vector_index in vector_indices]
+        if not keys:
+            return []
+        try:
+            async with self.connection.cursor() as cursor:
+                await cursor.execute(f"""
+                    SELECT id, role, content, timestamp, created, updated, vector_index
+                    FROM {self.table_name}
+                    WHERE session_id = ? AND vector_index IN ({', '.join('?' * len(keys))})
+                """, (self.session_id, *map(str, keys)))
+                rows = await cursor.fetchall()
+        except Exception as e:
+            await self.output_handler.send_output(
+                f"Error retrieving chat entries by vector index: {str(e)}", message_type="error"
+            )
+            return []
+        entries = {entry.vector_id: entry for entry in map(self.row_to_entry, rows)}
+        missing = [key for key in keys if key not in entries]
+        if missing:
+            archived = await self.get_archived_entries(f"""
+                SELECT id, segment FROM {self.table_name}_archived
+                WHERE session_id = ? AND vector_index IN ({', '.join('?' * len(missing))})
+            """, (self.session_id, *map(str, missing)))
+            entries.update({entry.vector_id: entry for entry in archived.values()})
+        return [entries[key] for key in keys if key in entries]
+
+    async def archived_vector_indices(self):
+        """Dict of the id of every archived entry of the session to its vector index."""
+        async with self.connection.execute(f"SELECT id, vector_index FROM {self.table_name}_archived "
+                                           f"WHERE session_id = ?", (self.session_id,)) as cursor:
+            return {row[0]: row[1] for row in await cursor.fetchall()}
+
+    async def get_archived_entries(self, query, params):
+        """
+        Read archived entries from their segments.
+
+        :param query: SELECT of id and segment from the archived table.
+        :param params: Parameters of the query.
+        :return: Dict of entry id to entry.
+        """
+        async with self.connection.cursor() as cursor:
+            await cursor.execute(query, params)
+            locations = await cursor.fetchall()
+        if not locations:
+            return {}
+        entries = await asyncio.to_thread(self.archive.get_entries, locations)
+        return {entry_id: ChatEntry.from_dict(entry) for entry_id, entry in entries.items()}
+
+    async def archive_entries(self, keep_count=None, older_than=None):
+        """
+        Move the session's old entries out of the table into compressed archive segments.
+
+        Entries are taken oldest first, `segment_size` at a time. Each segment is written
+        before its entries are deleted from the table, in one transaction with their
+        archive index rows, so a crash leaves every entry in the table or the archive.
+        Rotated history file segments whose entries are all archived are deleted after.
+
+        :param keep_count: Number of newest entries to keep in the table, or None for no limit.
+        :param older_than: Timestamp before which entries are archived, or None for no limit.
+        :return: Number of entries archived.
+        """
+        if keep_count is None and older_than is None:
+            return 0
+        await self.flush()
+        conditions, params = ["session_id = ?"], [self.session_id]
+        if keep_count is not None:
+            conditions.append(f"""(timestamp, rowid) <= (
+                SELECT timestamp, rowid FROM {self.table_name} WHERE session_id = ?
+                ORDER BY timestamp DESC, rowid DESC LIMIT 1 OFFSET ?)""")
+            params.extend((self.session_id, keep_count))
+        if older_than is not None:
+            conditions.append("timestamp < ?")
+            params.append(older_than)
+        archived = 0
+        while True:
+            async with self.save_lock:
+                async with self.connection.cursor() as cursor:
+                    await cursor.execute(f"""
+                        SELECT id, role, content, timestamp, created, updated, vector_index
+                        FROM {self.table_name} WHERE {' AND '.join(conditions)}
+                        ORDER BY timestamp, rowid LIMIT ?
+                    """, (*params, self.segment_size))
+                    entries = [self.row_to_entry(row) for row in await cursor.fetchall()]
+                if not entries:
+                    break
+                segment = await asyncio.to_thread(self.archive.write_segment, [entry.to_dict() for entry in entries])
+                await self.connection.executemany(
+                    f"INSERT OR REPLACE INTO {self.table_name}_archived "
+                    f"(id, segment, vector_index, session_id, role, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(entry['id'], segment['name'], entry['vector_index'], self.session_id, entry['role'],
+                      entry['timestamp']) for entry in entries])
+                await self.connection.executemany(
+                    f"DELETE FROM {self.table_name} WHERE id = ?", [(entry['id'],) for entry in entries])
+                await self.connection.commit()
+            archived += len(entries)
+        if archived:
+            await self.prune_file_segments()
+        return archived
+
+    async def prune_file_segments(self):
+        """Delete rotated history file segments none of whose entries are left in the table."""
+        for path in segment_paths(self.history_file)[:-1]:
+            entry_ids = [record['id'] for record in read_segment(path)]
+            still_hot = False
+            for start in range(0, len(entry_ids), 500):
+                chunk = entry_ids[start:start + 500]
+                async with self.connection.execute(
+                        f"SELECT 1 FROM {self.table_name} WHERE id IN ({', '.join('?' * len(chunk))}) LIMIT 1",
+                        chunk) as cursor:
+                    still_hot = await cursor.fetchone() is not None
+                if still_hot:
+                    break
+            if still_hot:
+                break  # Later segments are newer, so they have entries left too
+            os.remove(path)
+
+    @staticmethod
+    def filter_clause(roles=None, since=None, until=None, alias=''):
+        """
+        SQL conditions restricting entries by role and time range.
+
+        :param roles: Roles to keep, or None for all.
+        :param since: Earliest timestamp kept, as written by get_timestamp, or None.
+        :param until: Timestamp entries must be older than, or None.
+        :param alias: Prefix of the column names, such as 'h.'.
+        :return: Tuple of a string of ' AND ' prefixed conditions and their parameters.
+        """
+        conditions, params = [], []
+        if roles is not None:
+            conditions.append(f"{alias}role IN ({', '.join('?' * len(roles))})")
+            params.extend(roles)
+        if since is not None:
+            conditions.append(f"{alias}timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append(f"{alias}timestamp < ?")
+            params.append(until)
+        return ''.join(' AND ' + condition for condition in conditions), params
+
+    def record_vectors(self, rows):
+        """
+        Note the role and timestamp of vector ids in the filtering arrays.
+
+        :param rows: (vector index, role, timestamp) tuples; rows without a vector are skipped.
+        """
+        rows = [(parse_vector_id(vector_index), role, timestamp) for vector_index, role, timestamp in rows]
+        rows = [row for row in rows if row[0] is not None]
+        if not rows:
+            return
+        size = max(vector_id for vector_id, _, _ in rows) + 1
+        if size > len(self.vector_roles):
+            size = max(size, 2 * len(self.vector_roles))  # Doubled, so growing one id at a time stays linear
+            self.vector_roles = np.concatenate([self.vector_roles, np.zeros(size - len(self.vector_roles), 'uint8')])
+            self.vector_times = np.concatenate([self.vector_times, np.zeros(size - len(self.vector_times), 'int64')])
+        ids = np.array([vector_id for vector_id, _, _ in rows], dtype='int64')
+        self.vector_roles[ids] = [self.role_codes.setdefault(role, len(self.role_codes) + 1) for _, role, _ in rows]
+        self.vector_times[ids] = [parse_timestamp(timestamp) or 0 for _, _, timestamp in rows]
+
+    async def load_vector_attributes(self):
+        """Read the role and timestamp of the session's vectorized entries, archived too, into the filter arrays."""
+        # Under the save lock, so no write lands between the read and the flag that makes writes update the arrays
+        async with self.save_lock:
+            if self.vector_attributes_loaded:
+                return
+            async with self.connection.execute(f"""
+                SELECT vector_index, role, timestamp FROM {self.table_name}
+                WHERE session_id = ? AND vector_index != ''
+                UNION ALL
+                SELECT vector_index, role, timestamp FROM {self.table_name}_archived
+                WHERE session_id = ? AND vector_index != ''
+            """, (self.session_id, self.session_id)) as cursor:
+                self.record_vectors(await cursor.fetchall())
+            self.vector_attributes_loaded = True
+
+    async def vector_id_mask(self, roles=None, since=None, until=None):
+        """
+        Which vector ids belong to the session's entries passing a filter, for a search restricted to them.
+
+        :param roles: Roles to keep, or None for all.
+        :param since: Earliest timestamp kept, or None.
+        :param until: Timestamp entries must be older than, or None.
+        :return: Boolean array indexed by vector id; ids past its end are excluded.
+        """
+        if not self.vector_attributes_loaded:
+            try:
+                await self.load_vector_attributes()
+            except Exception as e:
+                await self.output_handler.send_output(
+                    f"Error filtering chat entries: {str(e)}", message_type="error"
+                )
+                return np.zeros(0, dtype=bool)
+        if roles is None:
+            mask = self.vector_roles != 0
+        else:
+            mask = np.isin(self.vector_roles, [self.role_codes[role] for role in roles if role in self.role_codes])
+        if since is not None:
+            mask &= self.vector_times >= parse_timestamp(since)
+        if until is not None:
+            mask &= self.vector_times < parse_timestamp(until)
+        return mask
+
+    async def search_text(self, query: str, limit=10, roles=None, since=None, until=None):
+        """
+        Find entries of the session sharing words with the query, best BM25 match first.
+
+        :param query: Free text; every word in it is searched for.
+        :param limit: Largest number of entries returned.
+        :param roles: Roles to keep, or None for all.
+        :param since: Earliest timestamp kept, or None.
+        :param until: Timestamp entries must be older than, or None.
+        """
+        words = re.findall(r"\w+", query)
+        if not words:
+            return []
+        # Quoted so words like AND or NEAR aren't read as query syntax
+        match = ' OR '.join('"' + word + '"' for word in dict.fromkeys(words))
+        fts = f"{self.table_name}_fts"
+        where, params = self.filter_clause(roles, since, until, alias='h.')
+        try:
+            async with self.connection.cursor() as cursor:
+                await cursor.execute(f"""
+                    SELECT h.id, h.role, h.content, h.timestamp, h.created, h.updated, h.vector_index
+                    FROM {fts} JOIN {self.table_name} h ON h.rowid = {fts}.rowid
+                    WHERE {fts} MATCH ? AND h.session_id = ?{where} ORDER BY bm25({fts}) LIMIT ?
+                """, (match, self.session_id, *params, limit))
+                rows = await cursor.fetchall()
+        except Exception as e:
+            await self.output_handler.send_output(
+                f"Error searching chat history: {str(e)}", message_type="error"
+            )
+            return []
+        return [self.row_to_entry(row) for row in rows]
+
+    @staticmethod
+    def row_to_entry(row):
+        """An entry from a row of id, role, content, timestamp, created, updated and vector_index."""
+        return ChatEntry.from_row(row)
@@ -0,0 +1,159 @@
+import uuid
+
+from chat_history.history_log import HistoryLog
+from chat_history.loggers import get_timestamp
+
+
+class HistorySummarizer:
+    """
+    Condenses older chat history into a hierarchy of summaries, so prompts stay short as it grows.
+
+    Each run of `span` entries older than the newest `keep_recent` is summarized into a
+    level 0 summary, and every `fanout` summaries of one level not yet condensed are
+    summarized again into one of the next level, which becomes their parent. The
+    summaries without a parent cover the whole summarized history, oldest and coarsest
+    first, and there are at most `fanout - 1` of them per level, so they grow with the
+    logarithm of the history's length.
+
+    Summaries are kept in the `{table_name}_summaries` table of the chat database, per
+    session. Each level 0 summary records the (timestamp, rowid) cursor of its last
+    entry, so the next run pages on from there. Entries archived before they were
+    summarized are skipped.
+
+    The text of a summary comes from `summarize`, a coroutine function taking a list of
+    lines to condense and returning the summary; nothing is summarized until it is set,
+    and a span whose summary comes back empty is left for the next run.
+    """
+
+    def __init__(self, chat_logger: HistoryLog, summarize=None, span=10, fanout=4, keep_recent=10):
+        """
+        :param chat_logger: History to summarize, whose database connection the summaries share.
+        :param summarize: Coroutine function turning a list of lines into a summary.
+        :param span: Entries per level 0 summary.
+        :param fanout: Summaries condensed into one of the next level.
+        :param keep_recent: Newest entries left unsummarized, as they go into prompts verbatim; at least as
+            many as prompts offer, or those turns appear in both.
+        """
+        self.chat_logger = chat_logger
+        self.summarize = summarize
+        self.span = span
+        self.fanout = fanout
+        self.keep_recent = keep_recent
+        self.table_name = f"{chat_logger.table_name}_summaries"
+
+    async def init_db(self):
+        """Create the summaries table, once the chat logger's database is open; without it there is nothing to do."""
+        connection = self.chat_logger.connection
+        if connection is None:
+            return
+        await connection.execute(f"""
+        CREATE TABLE IF NOT EXISTS {self.table_name} (
+            id VARCHAR(36) PRIMARY KEY,
+            session_id TEXT NOT NULL,
+            level INTEGER,
+            content TEXT,
+            first_timestamp TIMESTAMP,
+            last_timestamp TIMESTAMP,
+            entry_count INTEGER,
+            cursor_timestamp TIMESTAMP,
+            cursor_rowid INTEGER,
+            parent_id VARCHAR(36),
+            created TIMESTAMP
+            )
+        """)
+        # Prompts read the summaries without a parent, and condensing reads them by level
+        await connection.execute(f"""
+        CREATE INDEX IF NOT EXISTS {self.table_name}_session_level
+        ON {self.table_name} (session_id, parent_id, level, first_timestamp)
+        """)
+        await connection.commit()
+
+    async def summaries(self):
+        """The summaries covering the summarized history, without their parts, oldest first."""
+        if self.chat_logger.connection is None:
+            return []
+        async with self.chat_logger.connection.execute(f"""
+            SELECT level, content, first_timestamp, last_timestamp, entry_count FROM {self.table_name}
+            WHERE session_id = ? AND parent_id IS NULL ORDER BY first_timestamp, level DESC
+        """, (self.chat_logger.session_id,)) as cursor:
+            rows = await cursor.fetchall()
+        return [{'level': row[0], 'content': row[1], 'first_timestamp': row[2], 'last_timestamp': row[3],
+                 'entry_count': row[4]} for row in rows]
+
+    async def run(self):
+        """
+        Summarize every full span of entries old enough, then condense every full run of summaries.
+
+        :return: Number of summaries written.
+        """
+        if self.summarize is None:
+            return 0
+        await self.chat_logger.flush()
+        written = 0
+        while await self.summarize_next_span():
+            written += 1
+        level = 0
+        while await self.has_level(level):
+            written += await self.condense_level(level)
+            level += 1
+        return written
+
+    async def summarize_next_span(self):
+        """Summarize the next `span` entries if `keep_recent` newer ones follow them; return whether it did."""
+        async with self.chat_logger.connection.execute(f"""
+            SELECT cursor_timestamp, cursor_rowid FROM {self.table_name}
+            WHERE session_id = ? AND level = 0 ORDER BY cursor_timestamp DESC, cursor_rowid DESC LIMIT 1
+        """, (self.chat_logger.session_id,)) as cursor:
+            row = await cursor.fetchone()
+        entries, after = await self.chat_logger.entries_after(tuple(row) if row else None, self.span)
+        if after is None:
+            return False
+        newer, _ = await self.chat_logger.entries_after(after, self.keep_recent)
+        if len(newer) < self.keep_recent:
+            return False
+        content = await self.summarize([f"{entry['role']}: {entry['content']}" for entry in entries])
+        if not content:
+            return False
+        await self.save_summary(0, content, entries[0]['timestamp'], entries[-1]['timestamp'], len(entries),
+                                cursor=after)
+        return True
+
+    async def condense_level(self, level):
+        """Condense the oldest `fanout` summaries of a level into their parent while enough are waiting."""
+        condensed = 0
+        while True:
+            async with self.chat_logger.connection.execute(f"""
+                SELECT id, content, first_timestamp, last_timestamp, entry_count FROM {self.table_name}
+                WHERE session_id = ? AND parent_id IS NULL AND level = ? ORDER BY first_timestamp LIMIT ?
+            """, (self.chat_logger.session_id, level, self.fanout)) as cursor:
+                parts = await cursor.fetchall()
+            if len(parts) < self.fanout:
+                return condensed
+            content = await self.summarize([part[1] for part in parts])
+            if not content:
+                return condensed
+            await self.save_summary(level + 1, content, parts[0][2], parts[-1][3], sum(part[4] for part in parts),
+                                    parts=[part[0] for part in parts])
+            condensed += 1
+
+    async def has_level(self, level):
+        async with self.chat_logger.connection.execute(
+                f"SELECT 1 FROM {self.table_name} WHERE session_id = ? AND level = ? LIMIT 1",
+                (self.chat_logger.session_id, level)) as cursor:
+            return await cursor.fetchone() is not None
+
+    async def save_summary(self, level, content, first_timestamp, last_timestamp, entry_count, cursor=None,
+                           parts=()):
+        """Insert a summary and point its parts at it, in one transaction; return its id."""
+        summary_id = str(uuid.uuid4())
+        connection = self.chat_logger.connection
+        async with self.chat_logger.save_lock:
+            await connection.execute(f"""
+                INSERT INTO {self.table_name} (id, session_id, level, content, first_timestamp, last_timestamp,
+                entry_count, cursor_timestamp, cursor_rowid, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (summary_id, self.chat_logger.session_id, level, content, first_timestamp, last_timestamp,
+                  entry_count, *(cursor or (None, None)), get_timestamp()))
+            await connection.executemany(f"UPDATE {self.table_name} SET parent_id = ? WHERE id = ?",
+                                         [(summary_id, part_id) for part_id in parts])
+            await connection.commit()
+        return summary_id
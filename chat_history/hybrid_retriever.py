@@ -0,0 +1,60 @@
+from chat_history.history_log import HistoryLog
+from chat_history.vector_storage import VectorStorageBase
+
+
+class HybridRetriever:
+    """
+    Finds chat entries relevant to a query by fusing full text and vector search.
+
+    BM25 matches from the history's full text index catch exact words and identifiers
+    that embeddings blur, and vector matches catch paraphrases. The two rankings are
+    merged by reciprocal rank fusion: each entry scores the sum of 1 / (rrf_k + rank)
+    over the lists it appears in. Until the embedding model is loaded, retrieval is
+    full text only.
+    """
+
+    def __init__(self, chat_logger: HistoryLog, vector_storage: VectorStorageBase, rrf_k=60, candidate_factor=3):
+        """
+        :param chat_logger: History whose full text index is searched.
+        :param vector_storage: Vector index of the same history.
+        :param rrf_k: Rank offset of the fusion; larger values flatten the difference between ranks.
+        :param candidate_factor: Each search fetches this many times the results asked for, so fusion has room.
+        """
+        self.chat_logger = chat_logger
+        self.vector_storage = vector_storage
+        self.rrf_k = rrf_k
+        self.candidate_factor = candidate_factor
+
+    async def retrieve(self, query: str, n=10, lexical_only=False, roles=None, since=None, until=None):
+        """
+        Return up to n entries for the query, most relevant first.
+
+        Filters are applied inside both searches, so each still returns its full share of
+        candidates rather than losing most of them to filtering afterwards.
+
+        :param query: Text to find related entries for.
+        :param n: Number of entries to return.
+        :param lexical_only: Set to true to skip the vector search, as is done while the model loads.
+        :param roles: Roles to keep, or None for all.
+        :param since: Earliest timestamp kept, or None.
+        :param until: Timestamp entries must be older than, or None.
+        """
+        candidates = n * self.candidate_factor
+        rankings = [await self.chat_logger.search_text(query, candidates, roles, since, until)]
+        if not lexical_only and self.vector_storage.model_ready:
+            ids = None
+            if roles is not None or since is not None or until is not None:
+                ids = await self.chat_logger.vector_id_mask(roles, since, until)
+            indices, _ = await self.vector_storage.retrieve_vectors_async(query, candidates, ids)
+            rankings.append(await self.chat_logger.get_by_vector_indices([index for index in indices if index >= 0]))
+        return self.fuse(rankings)[:n]
+
+    def fuse(self, rankings):
+        """Merge ranked lists of entries by reciprocal rank fusion, best first."""
+        scores = {}
+        entries = {}
+        for ranking in rankings:
+            for rank, entry in enumerate(ranking, start=1):
+                scores[entry['id']] = scores.get(entry['id'], 0.0) + 1.0 / (self.rrf_k + rank)
+                entries.setdefault(entry['id'], entry)
+        return [entries[entry_id] for entry_id in sorted(scores, key=scores.get, reverse=True)]
@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import queue
+import asyncio
+import threading
+
+FSYNC_POLICIES = ('never', 'batch', 'interval')
+
+
+def segment_paths(path: str) -> list:
+    """The rotated segments of a log followed by the live file, oldest first, leaving out missing files."""
+    directory, name = os.path.split(path)
+    numbers = []
+    for file_name in os.listdir(directory or '.'):
+        suffix = file_name[len(name) + 1:]
+        if file_name.startswith(name + '.') and suffix.isdigit():
+            numbers.append(int(suffix))
+    paths = [f"{path}.{number}" for number in sorted(numbers)]
+    return paths + [path] if os.path.exists(path) else paths
+
+
+def read_records(path: str):
+    """Yield the records of a log across all its segments, oldest first."""
+    for segment in segment_paths(path):
+        yield from read_segment(segment)
+
+
+def read_segment(segment: str):
+    """Yield the records of one segment file."""
+    with open(segment, 'r') as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+class JsonlWriter:
+    """
+    Appends JSON lines to log files from a background thread, so the event loop never waits on the disk.
+
+    Records are serialized when they are appended, so later changes to them don't
+    leak into the file, and handed to the thread, which writes everything queued
+    for a file in one buffered write. A file that would grow past
+    `max_segment_bytes` is first renamed to the next numbered segment (path.1,
+    path.2, ...) and started afresh; read_records reads the segments back in order.
+    One writer can serve any number of files.
+
+    The fsync policy decides when writes reach the disk and not just the OS:
+    'never' leaves it to the OS, 'batch' syncs after every write and 'interval'
+    syncs at most every `fsync_interval` seconds.
+    """
+
+    def __init__(self, max_segment_bytes=64 * 2 ** 20, fsync='never', fsync_interval=1.0, buffer_size=2 ** 16):
+        """
+        :param max_segment_bytes: Size at which a file is rotated into a numbered segment.
+        :param fsync: One of FSYNC_POLICIES.
+        :param fsync_interval: Seconds between syncs under the 'interval' policy.
+        :param buffer_size: Write buffer of each open file.
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy {fsync!r}, expected one of {', '.join(FSYNC_POLICIES)}")
+        self.max_segment_bytes = max_segment_bytes
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.buffer_size = buffer_size
+        self.requests = queue.Queue()  # (path, data) to write, or (None, callback) to call once written
+        self.files = {}  # Path -> open file, used by the writer thread only
+        self.last_sync = time.monotonic()
+        self.unsynced = False  # Whether something was written since the last sync
+        self.errors = []  # Errors of the writer thread, taken by take_errors
+        self.stats = {'records': 0, 'writes': 0, 'rotations': 0, 'fsyncs': 0}
+        self.thread = None
+        self.thread_lock = threading.Lock()
+
+    def append(self, path: str, records: list):
+        """Queue records to be appended to the file, without waiting for the write."""
+        if not records:
+            return
+        data = ''.join(json.dumps(record) + '\n' for record in records)
+        self.stats['records'] += len(records)
+        self.start()
+        self.requests.put((path, data))
+
+    def start(self):
+        with self.thread_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='jsonl-writer', daemon=True)
+                self.thread.start()
+
+    def take_errors(self) -> list:
+        errors, self.errors = self.errors, []
+        return errors
+
+    async def flush(self):
+        """Wait until everything appended so far has been written, and synced if the policy syncs."""
+        if self.thread is None:
+            return
+        loop = asyncio.get_running_loop()
+        written = loop.create_future()
+        self.requests.put((None, lambda: loop.call_soon_threadsafe(written.set_result, None)))
+        await written
+
+    async def close(self):
+        """Write everything queued, close the files and stop the thread."""
+        if self.thread is None:
+            return
+        self.requests.put((None, None))
+        await asyncio.to_thread(self.thread.join)
+        self.thread = None
+
+    def run(self):
+        while True:
+            try:
+                # Under the interval policy, a quiet spell still gets the last writes synced
+                timeout = self.fsync_interval if self.fsync == 'interval' and self.unsynced else None
+                requests = [self.requests.get(timeout=timeout)]
+            except queue.Empty:
+                self.sync(force=True)
+                continue
+            while not self.requests.empty():
+                requests.append(self.requests.get_nowait())
+            pending = {}
+            callbacks = []
+            stop = False
+            for path, data in requests:
+                if path is None:
+                    stop = stop or data is None
+                    if data is not None:
+                        callbacks.append(data)
+                else:
+                    pending.setdefault(path, []).append(data)
+            for path, chunks in pending.items():
+                try:
+                    self.write(path, chunks)
+                except OSError as e:
+                    self.errors.append(e)
+            self.sync(force=bool(callbacks) and self.fsync != 'never')
+            for callback in callbacks:
+                callback()
+            if stop:
+                for file in self.files.values():
+                    file.close()
+                self.files = {}
+                return
+
+    def write(self, path, chunks):
+        """Write the chunks appended for a file, rotating it between chunks as it fills; the buffer joins the writes."""
+        file = self.files.get(path)
+        if file is None:
+            file = self.files[path] = open(path, 'a', buffering=self.buffer_size)
+        for data in chunks:
+            if file.tell() and file.tell() + len(data) > self.max_segment_bytes:
+                file.flush()
+                file = self.rotate(path)
+            file.write(data)
+        file.flush()
+        self.stats['writes'] += 1
+        self.unsynced = True
+
+    def rotate(self, path):
+        self.files.pop(path).close()
+        segments = segment_paths(path)
+        number = int(segments[-2].rsplit('.', 1)[1]) + 1 if len(segments) > 1 else 1
+        os.replace(path, f"{path}.{number}")
+        self.stats['rotations'] += 1
+        file = self.files[path] = open(path, 'a', buffering=self.buffer_size)
+        return file
+
+    def sync(self, force=False):
+        if self.fsync == 'never' or not self.unsynced:
+            return
+        now = time.monotonic()
+        if self.fsync == 'batch' or force or now - self.last_sync >= self.fsync_interval:
+            for file in self.files.values():
+                os.fsync(file.fileno())
+            self.stats['fsyncs'] += 1
+            self.last_sync = now
+            self.unsynced = False
@@ -1,3 +1,5 @@
+import os
+import re
 import asyncio
 import time
 from abc import ABC, abstractmethod
@@ -5,10 +7,30 @@ from abc import ABC, abstractmethod
 from output_handler import OutputHandler
 
 
+DEFAULT_SESSION = 'default'
+
+
 def get_timestamp():
     return time.strftime("%Y-%m-%d %H:%M:%S")
 
 
+def session_path(path: str, session_id: str = DEFAULT_SESSION) -> str:
+    """
+    Where a conversation keeps its own copy of a file.
+
+    The default session keeps files where they have always been; any other session
+    keeps them in a sessions/<session_id>/ directory beside them, created on first use.
+    """
+    if session_id == DEFAULT_SESSION:
+        return path
+    if not re.fullmatch(r"[\w-][\w.-]*", session_id):
+        raise ValueError(f"Session id {session_id!r} must be letters, digits, '_', '-' or '.'")
+    directory, name = os.path.split(path)
+    path = os.path.join(directory, 'sessions', session_id, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
 class BaseLogger(ABC):
     def __init__(self, output_handler: OutputHandler, db_name: str,
                  table_name: str, file_name: str):
@@ -0,0 +1,107 @@
+import time
+import asyncio
+
+import faiss
+import numpy as np
+
+from chat_history.history_log import HistoryLog
+from chat_history.vector_storage import VectorStorageBase
+
+
+class HistoryReconciler:
+    """
+    Finds and repairs drift between the chat history file, its database table and its vector index.
+
+    The three are written independently, so a crash can leave entries in one and not
+    the others. The database is taken as the record of which vector belongs to which
+    entry: entries missing from the database or the file are copied over from the other,
+    vectors no entry points to are removed, and only entries without a valid vector of
+    their own are encoded again.
+    """
+
+    def __init__(self, chat_logger: HistoryLog, vector_storage: VectorStorageBase):
+        self.chat_logger = chat_logger
+        self.vector_storage = vector_storage
+
+    async def diff(self):
+        """
+        Compare the three stores.
+
+        :return: Dict of lists: 'missing_in_db' and 'missing_in_file' entries, 'unvectorized'
+            entries with no vector id, 'dangling' entries whose vector id is not in the index,
+            'shared' entries whose vector id an earlier entry already has, and 'orphaned'
+            vector ids no entry points to.
+        """
+        await self.chat_logger.flush()
+        file_entries = {entry['id']: entry for entry in self.chat_logger.load_from_file()}
+        db_entries = {entry['id']: entry for entry in await self.chat_logger.load_from_db()}
+        archived = await self.chat_logger.archived_vector_indices()
+        index = self.vector_storage.vector_index
+        vector_ids = set(faiss.vector_to_array(index.id_map).tolist()) if index.ntotal else set()
+
+        report = {'missing_in_db': [entry for entry_id, entry in file_entries.items()
+                                    if entry_id not in db_entries and entry_id not in archived],
+                  'missing_in_file': [entry for entry_id, entry in db_entries.items() if entry_id not in file_entries],
+                  'unvectorized': [], 'dangling': [], 'shared': []}
+        # Archived entries keep their vectors, but are otherwise left alone
+        owners = {int(vector_index): entry_id for entry_id, vector_index in archived.items()
+                  if str(vector_index or '').isdigit()}
+        for entry in list(db_entries.values()) + report['missing_in_db']:
+            vector_index = str(entry.get('vector_index') or '')
+            if not vector_index.isdigit():
+                report['unvectorized'].append(entry)
+            elif int(vector_index) not in vector_ids:
+                report['dangling'].append(entry)
+            elif int(vector_index) in owners:
+                report['shared'].append(entry)
+            else:
+                owners[int(vector_index)] = entry
+        report['orphaned'] = sorted(vector_ids - owners.keys())
+        return report
+
+    async def repair(self, report, batch_size=256, concurrency=None):
+        """
+        Bring the stores back in line with each other.
+
+        Entries to encode are split into batches of `batch_size`, and `concurrency`
+        batches are encoded at once, so a process pool executor keeps every worker busy.
+
+        :param report: Result of diff.
+        :param batch_size: Number of entries per call to the model.
+        :param concurrency: Batches in flight at once, defaults to the executor's workers.
+        :return: Dict of what was repaired, with the encoding throughput.
+        """
+        started = time.perf_counter()
+        if report['missing_in_db']:
+            await self.chat_logger.restore_entries(report['missing_in_db'])
+        if report['missing_in_file']:
+            await self.chat_logger.append_to_file(report['missing_in_file'])
+        removed = await self.vector_storage.remove_vectors(report['orphaned'])
+
+        entries = report['unvectorized'] + report['dangling'] + report['shared']
+        executor = self.vector_storage.embedding_executor
+        concurrency = concurrency or executor.workers
+        encode_started = time.perf_counter()
+        batches = [entries[start:start + batch_size] for start in range(0, len(entries), batch_size)]
+        for wave_start in range(0, len(batches), concurrency):
+            wave = batches[wave_start:wave_start + concurrency]
+            encoded = await asyncio.gather(*(executor.encode([entry['content'] for entry in batch])
+                                             for batch in wave))
+            vectors = np.concatenate(encoded)
+            first_id = self.vector_storage.add_vectors(vectors)
+            wave_entries = [entry for batch in wave for entry in batch]
+            await self.chat_logger.update_vector_indices(
+                [(str(first_id + offset), entry['id']) for offset, entry in enumerate(wave_entries)])
+        encode_seconds = time.perf_counter() - encode_started
+        await self.vector_storage.checkpoint()
+
+        return {
+            'restored_to_db': len(report['missing_in_db']),
+            'restored_to_file': len(report['missing_in_file']),
+            'orphans_removed': removed,
+            'encoded': len(entries),
+            'batches': len(batches),
+            'encode_seconds': encode_seconds,
+            'entries_per_second': len(entries) / encode_seconds if entries and encode_seconds else 0.0,
+            'total_seconds': time.perf_counter() - started,
+        }
@@ -1,43 +1,154 @@
-import faiss
+import os
+import time
+
 import numpy as np
 
 from chat_history.history_log import HistoryLog
 from chat_history.vector_storage import VectorStorageBase
+from chat_history.loggers import session_path, DEFAULT_SESSION
 
 
 class VectorChatStorage(VectorStorageBase):
-    def __init__(self, chat_logger: HistoryLog, vector_file='chat_vectors.index'):
-        super().__init__(vector_file=vector_file)
+    def __init__(self, chat_logger: HistoryLog, vector_file='chat_vectors.index', vector_model=None,
+                 embedding_workers=1, embedding_cache=None, index_type='hnsw', mmap=False, session_id=DEFAULT_SESSION):
+        """
+        :param session_id: Conversation the index partition belongs to, the same as the chat logger's;
+            vector ids are only unique within it.
+        """
+        super().__init__(vector_model=vector_model, vector_file=session_path(vector_file, session_id),
+                         embedding_workers=embedding_workers, embedding_cache=embedding_cache,
+                         index_type=index_type, mmap=mmap)
+        self.session_id = session_id
         self.chat_logger = chat_logger  # Reference to the ChatLogger for interaction
 
     async def save_chat_vector(self, entry):
         """Calculate and save the vector representation for a chat entry."""
         # Aggregate the content of the chat entry for vectorization
-        vector = self.vector_model.encode(entry["content"])
-        self.vector_index.add(np.array([vector]).astype('float32'))
-        index = self.vector_index.ntotal
-        faiss.write_index(self.vector_index, self.vector_file)  # Save index to file
-        return self.vector_index.ntotal
+        vector = await self.encode_async(entry["content"])
+        # Logged rather than rewriting the index file; the index is checkpointed in the background
+        return self.add_vectors(np.array([vector]).astype('float32'))
+
+    async def init_vector_db(self, batch_size=64, rebuild=False, on_progress=None):
+        """
+        Vectorize chat entries that have no vector yet, in batches.
+
+        Each batch is encoded in one call and added to the index in one call; the index
+        file is written once at the end. Encoded batches are also appended to an ingest
+        journal, so an interrupted run resumes where it stopped instead of starting over.
+        Entry vector indexes are only updated once the index file has been written, and
+        the journal is only cleared after that, so a crash in between is finished on the
+        next run without adding the vectors a second time.
 
-    async def init_vector_db(self):
-        """Initialize vector storage by processing existing chat entries."""
-        new_entries_count = 0
+        :param batch_size: Number of entries encoded per call to the model.
+        :param rebuild: Set to true to clear the index and re-encode every entry.
+        :param on_progress: Optional function called with (done, total) after each batch.
+        :return: Number of entries vectorized.
+        """
+        if rebuild:
+            with self.index_lock:
+                self.own_index()
+                self.vector_index.reset()
+                self.next_id = 1
+            self.vector_log.clear()
+            self.clear_ingest_files()
+        entries = [entry async for entry in self.chat_logger.iter_entries(unvectorized_only=not rebuild)]
+        total = len(entries)
+        if not total:
+            return 0
 
+        first_id, done = self.resume_ingest(entries)
+        resumed = done
+        started = time.perf_counter()
+        for batch_start in range(done, total, batch_size):
+            batch = entries[batch_start:batch_start + batch_size]
+            vectors = await self.encode_async([entry["content"] for entry in batch])
+            self.add_vectors(vectors, log=False)  # Saved in the ingest journal instead
+            self.append_ingest_batch(batch, vectors)
+            done += len(batch)
+            rate = (done - resumed) / max(time.perf_counter() - started, 1e-9)
+            if on_progress:
+                on_progress(done, total)
+            self.chat_logger.output_handler.queue_output(
+                f"Vectorized {done}/{total} chat entries ({rate:.0f}/s)", message_type="system")
+
+        await self.checkpoint()
+        updates = [(str(first_id + offset), entry['id']) for offset, entry in enumerate(entries)]
+        await self.chat_logger.update_vector_indices(updates)
+        vector_indices = {entry_id: vector_index for vector_index, entry_id in updates}
         for entry in self.chat_logger.history:
-            if 'vectorized' not in entry:  # Only process unvectorized entries
-                await self.save_chat_vector(entry)  # Save the vector representation for the entry
-                new_entries_count += 1
+            entry['vector_index'] = vector_indices.get(entry['id'], entry['vector_index'])
+        self.clear_ingest_files()
 
         await self.chat_logger.output_handler.send_output(
-            f"Added {new_entries_count} new chat vectors to the vector database.")
+            f"Added {total} new chat vectors to the vector database.")
+        return total
+
+    @property
+    def ingest_files(self):
+        return (self.vector_file + '.ingest.ids', self.vector_file + '.ingest.f32',
+                self.vector_file + '.ingest.start')
+
+    def resume_ingest(self, entries):
+        """
+        Pick up the journal of an interrupted run.
+
+        If the run stopped before the index was written, the journaled vectors are added
+        to the index. If it stopped after, the index already holds them and only the
+        entries' vector indexes are left to update.
+
+        :param entries: The entries being ingested, in order.
+        :return: Tuple of the id given to the first entry, and the number of leading
+            entries that are already encoded.
+        """
+        progress_file, vectors_file, start_file = self.ingest_files
+        next_id = self.next_id
+        if not all(os.path.exists(path) for path in self.ingest_files):
+            self.clear_ingest_files()
+            return next_id, 0
+        with open(start_file, 'r') as file:
+            first_id = int(file.read().strip() or -1)
+        with open(progress_file, 'r') as file:
+            ingested_ids = file.read().split()
+        dimension = self.vector_index.d
+        vectors = np.fromfile(vectors_file, dtype='float32')
+        count = min(len(ingested_ids), vectors.size // dimension)
+        if count > len(entries) or [entry['id'] for entry in entries[:count]] != ingested_ids[:count]:
+            # The history changed since the interrupted run, so its vectors can't be trusted
+            self.clear_ingest_files()
+            return next_id, 0
+        if next_id == first_id + count:
+            # The index was written before the crash, so the vectors are already in it
+            return first_id, count
+        if next_id != first_id:
+            self.clear_ingest_files()
+            return next_id, 0
+        if count:
+            self.add_vectors(vectors[:count * dimension].reshape(count, dimension), log=False)
+        return first_id, count
+
+    def append_ingest_batch(self, batch, vectors):
+        progress_file, vectors_file, start_file = self.ingest_files
+        if not os.path.exists(start_file):
+            with open(start_file, 'w') as file:
+                file.write(str(self.next_id - len(batch)))
+        # Both files only grow; on resume the shorter of the two decides how much was saved
+        with open(vectors_file, 'ab') as file:
+            vectors.tofile(file)
+        with open(progress_file, 'a') as file:
+            file.writelines(entry['id'] + '\n' for entry in batch)
+
+    def clear_ingest_files(self):
+        for path in self.ingest_files:
+            if os.path.exists(path):
+                os.remove(path)
 
     async def retrieve_chat_vector(self, entry_id: str):
         """Retrieve the vector associated with a specific chat entry ID."""
-        entry = next((e for e in self.chat_logger.history if e['id'] == entry_id), None)
+        entry = await self.chat_logger.get_by_id(entry_id)
         if entry:
-            chat_vector_index = entry.get('chat_vector_index')
-            if chat_vector_index is not None:
-                vector = self.vector_index.reconstruct(chat_vector_index)  # Retrieve vector from the FAISS index
+            chat_vector_index = entry.get('vector_index')
+            if chat_vector_index:
+                vector = self.vector_index.reconstruct(int(chat_vector_index))  # Retrieve vector from the FAISS index
                 return vector
             else:
                 print(f"No chat vector found for entry ID '{entry_id}'.")
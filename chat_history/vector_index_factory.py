@@ -0,0 +1,196 @@
+import math
+import time
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ('flat', 'fp16', 'sq8', 'pq', 'ivf_flat', 'ivf_pq', 'hnsw')
+MIN_APPROXIMATE_VECTORS = 256  # Below this an approximate index has too little to train on and nothing to gain
+
+
+def create_index(index_type: str, vectors=None, dimension=768, pq_subquantizers=48, hnsw_neighbors=32):
+    """
+    Create an empty index of the given type, trained on `vectors` if the type needs it.
+
+    Every index is wrapped in an IndexIDMap2, so vectors keep the ids they were added with
+    whatever the type. The flat types search exhaustively; fp16 halves the memory of
+    each vector, sq8 quarters it and pq stores `pq_subquantizers` bytes, at some cost in
+    recall that build time measures.
+
+    :param index_type: One of INDEX_TYPES.
+    :param vectors: Float32 array of the vectors the index will hold, needed to train every type but flat and hnsw.
+    :param dimension: Number of floats in each vector.
+    :param pq_subquantizers: Number of product quantizer codes per vector for pq and ivf_pq.
+    :param hnsw_neighbors: Number of graph neighbours per vector for hnsw.
+    """
+    if index_type == 'flat':
+        inner = faiss.IndexFlatL2(dimension)
+    elif index_type in ('fp16', 'sq8'):
+        quantizer_type = faiss.ScalarQuantizer.QT_fp16 if index_type == 'fp16' else faiss.ScalarQuantizer.QT_8bit
+        inner = faiss.IndexScalarQuantizer(dimension, quantizer_type)
+        inner.train(vectors)
+    elif index_type == 'pq':
+        inner = faiss.IndexPQ(dimension, pq_subquantizers, code_bits(vectors))
+        inner.train(vectors)
+    elif index_type in ('ivf_flat', 'ivf_pq'):
+        # Around 4 * sqrt(n) lists, with enough vectors per list for k-means to be meaningful
+        lists = max(1, min(int(4 * math.sqrt(len(vectors))), len(vectors) // 39))
+        quantizer = faiss.IndexFlatL2(dimension)
+        if index_type == 'ivf_flat':
+            inner = faiss.IndexIVFFlat(quantizer, dimension, lists)
+        else:
+            inner = faiss.IndexIVFPQ(quantizer, dimension, lists, pq_subquantizers, code_bits(vectors))
+        inner.train(vectors)
+        inner.make_direct_map()  # Lets vectors be reconstructed by position
+    elif index_type == 'hnsw':
+        inner = faiss.IndexHNSWFlat(dimension, hnsw_neighbors)
+    else:
+        raise ValueError(f"Unknown index type {index_type!r}, expected one of {', '.join(INDEX_TYPES)}")
+    return faiss.IndexIDMap2(inner)
+
+
+def code_bits(vectors) -> int:
+    # Fewer centroids per code when there is little to train them on
+    return 8 if len(vectors) >= 256 * 39 else 4
+
+
+def index_type_of(index) -> str:
+    """The INDEX_TYPES name of an index, looking through an id map."""
+    inner = faiss.downcast_index(index.index) if hasattr(index, 'id_map') else index
+    if isinstance(inner, faiss.IndexScalarQuantizer):
+        return 'fp16' if inner.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else 'sq8'
+    if isinstance(inner, faiss.IndexPQ):
+        return 'pq'
+    if isinstance(inner, faiss.IndexIVFPQ):
+        return 'ivf_pq'
+    if isinstance(inner, faiss.IndexIVF):
+        return 'ivf_flat'
+    if isinstance(inner, faiss.IndexHNSW):
+        return 'hnsw'
+    return 'flat'
+
+
+def breadth_candidates(index):
+    """Search breadths worth trying for the index, narrowest first, or an empty list if it has none."""
+    index_type = index_type_of(index)
+    if index_type in ('ivf_flat', 'ivf_pq'):
+        lists = faiss.extract_index_ivf(index).nlist
+        return [probes for probes in (1, 2, 4, 8, 16, 32, 64, 128, 256) if probes < lists] + [lists]
+    if index_type == 'hnsw':
+        return [16, 32, 64, 128, 256, 512]
+    return []
+
+
+def set_search_breadth(index, breadth: int):
+    """Set nprobe of an IVF index or efSearch of an HNSW index."""
+    index_type = index_type_of(index)
+    if index_type in ('ivf_flat', 'ivf_pq'):
+        faiss.extract_index_ivf(index).nprobe = breadth
+    elif index_type == 'hnsw':
+        faiss.downcast_index(index.index).hnsw.efSearch = breadth
+
+
+def search_breadth(index):
+    """The nprobe of an IVF index or efSearch of an HNSW index, or None for types without a breadth."""
+    index_type = index_type_of(index)
+    if index_type in ('ivf_flat', 'ivf_pq'):
+        return faiss.extract_index_ivf(index).nprobe
+    if index_type == 'hnsw':
+        return faiss.downcast_index(index.index).hnsw.efSearch
+    return None
+
+
+def max_search_breadth(index):
+    """The breadth at which a search of the index visits everything it holds."""
+    if index_type_of(index) in ('ivf_flat', 'ivf_pq'):
+        return faiss.extract_index_ivf(index).nlist
+    return max(index.ntotal, 1)
+
+
+def search_parameters(index, selector, breadth=None):
+    """
+    Search parameters restricting a search of the index to the ids the selector accepts.
+
+    :param index: The index to be searched.
+    :param selector: A FAISS IDSelector.
+    :param breadth: nprobe or efSearch for this search, or None to keep the index's own.
+    """
+    index_type = index_type_of(index)
+    if index_type in ('ivf_flat', 'ivf_pq'):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=breadth or search_breadth(index))
+    if index_type == 'hnsw':
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=breadth or search_breadth(index))
+    return faiss.SearchParameters(sel=selector)
+
+
+def sample_queries(vectors: np.ndarray, ids: np.ndarray, k: int, queries: int):
+    """
+    Sample stored vectors as queries and find their exact nearest neighbours.
+
+    :return: Tuple of the query vectors and the ids of their exact top k.
+    """
+    rng = np.random.default_rng(0)
+    sample = vectors[rng.choice(len(vectors), size=min(queries, len(vectors)), replace=False)]
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    _, expected = exact.search(sample, k)
+    return sample, ids[expected]
+
+
+def measure_recall(index, sample: np.ndarray, expected: np.ndarray, k: int) -> dict:
+    """
+    Search the index with the sample and compare against the exact results.
+
+    :return: Dict of the fraction of the exact top k found and the average milliseconds per query.
+    """
+    started = time.perf_counter()
+    _, found = index.search(sample, k)
+    milliseconds = (time.perf_counter() - started) * 1000 / len(sample)
+    recall = np.mean([len(set(row) & set(hits)) / k for row, hits in zip(expected, found)])
+    return {'recall': float(recall), 'search_ms': milliseconds}
+
+
+def tune_search_breadth(index, vectors: np.ndarray, ids: np.ndarray, target_recall=0.95, max_search_ms=None,
+                        k=10, queries=200):
+    """
+    Pick the narrowest search breadth that reaches `target_recall` against an exact search.
+
+    If `max_search_ms` is given and no breadth reaching the recall is fast enough, the
+    breadth with the best recall within the latency limit is used instead. Index types
+    without a breadth are only measured, which shows the recall lost to compression.
+
+    :param index: The index, already holding `vectors`.
+    :param vectors: Float32 array of the vectors in the index.
+    :param ids: The id of each vector.
+    :param target_recall: Fraction of the exact top k that must be found.
+    :param max_search_ms: Largest average milliseconds per query, or None for no limit.
+    :param k: Number of neighbours compared.
+    :param queries: Number of stored vectors sampled as queries.
+    :return: Dict of the chosen breadth (None for types without one), its recall and its
+        average milliseconds per query, or None if there are no vectors.
+    """
+    if not len(vectors):
+        return None
+    k = min(k, len(vectors))
+    sample, expected = sample_queries(vectors, ids, k, queries)
+    candidates = breadth_candidates(index)
+    if not candidates:
+        return {'breadth': None, **measure_recall(index, sample, expected, k)}
+
+    measured = []
+    for breadth in candidates:
+        set_search_breadth(index, breadth)
+        measured.append({'breadth': breadth, **measure_recall(index, sample, expected, k)})
+        if measured[-1]['recall'] >= target_recall:
+            break
+
+    reaching = [m for m in measured if m['recall'] >= target_recall]
+    fast_enough = [m for m in measured if max_search_ms is None or m['search_ms'] <= max_search_ms]
+    if reaching and (max_search_ms is None or reaching[0]['search_ms'] <= max_search_ms):
+        choice = reaching[0]
+    elif fast_enough:
+        choice = max(fast_enough, key=lambda m: m['recall'])
+    else:
+        choice = measured[0]
+    set_search_breadth(index, choice['breadth'])
+    return choice
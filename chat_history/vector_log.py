@@ -0,0 +1,114 @@
+import os
+import struct
+import zlib
+
+import numpy as np
+
+
+class VectorLog:
+    """
+    Append-only log of the vectors added to a FAISS index since its last checkpoint.
+
+    Each record holds the vector's id in the index, a crc32 of the vector and the
+    float32 vector itself. Ids only grow, so replaying the log onto the checkpoint
+    skips ids below the checkpoint's next id, and a crash between writing a
+    checkpoint and compacting the log never adds a vector twice. A record torn by
+    a crash fails its checksum, and it and everything after it are dropped.
+    """
+    HEADER = struct.Struct('<qI')  # Vector id, crc32 of the vector bytes
+
+    def __init__(self, path: str, dimension: int, fsync=False):
+        """
+        :param path: File the log is kept in.
+        :param dimension: Number of floats in each vector.
+        :param fsync: Set to true to fsync after every append, so records survive power loss
+            and not just a crash of the process.
+        """
+        self.path = path
+        self.dimension = dimension
+        self.fsync = fsync
+        self.record_size = self.HEADER.size + dimension * 4
+        self.records = 0  # Records in the file, set by replay and kept up to date by append
+        self.file = None
+
+    def append(self, first_id: int, vectors):
+        """Append vectors that were added to the index with ids counting up from `first_id`."""
+        vectors = np.ascontiguousarray(vectors, dtype='float32').reshape(-1, self.dimension)
+        data = bytearray()
+        for offset, vector in enumerate(vectors):
+            payload = vector.tobytes()
+            data += self.HEADER.pack(first_id + offset, zlib.crc32(payload))
+            data += payload
+        if self.file is None:
+            self.file = open(self.path, 'ab')
+        self.file.write(data)
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        self.records += len(vectors)
+
+    def read(self):
+        """
+        Read the valid records in the log, cutting off a torn or corrupt tail.
+
+        :return: List of (id, vector) tuples in the order they were appended.
+        """
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, 'rb') as file:
+            data = file.read()
+        records = []
+        offset = 0
+        while offset + self.record_size <= len(data):
+            vector_id, checksum = self.HEADER.unpack_from(data, offset)
+            payload = data[offset + self.HEADER.size:offset + self.record_size]
+            if zlib.crc32(payload) != checksum:
+                break
+            records.append((vector_id, np.frombuffer(payload, dtype='float32')))
+            offset += self.record_size
+        if offset != len(data):
+            self.close()
+            with open(self.path, 'r+b') as file:
+                file.truncate(offset)
+        return records
+
+    def replay(self, index, next_id: int) -> int:
+        """
+        Add logged vectors the index does not hold yet.
+
+        :param index: The FAISS index with ids loaded from the last checkpoint.
+        :param next_id: One past the largest id in the index.
+        :return: Number of vectors added.
+        """
+        records = self.read()
+        self.records = len(records)
+        missing = [(vector_id, vector) for vector_id, vector in records if vector_id >= next_id]
+        if missing:
+            index.add_with_ids(np.stack([vector for _, vector in missing]),
+                               np.array([vector_id for vector_id, _ in missing], dtype='int64'))
+        return len(missing)
+
+    def compact(self, checkpoint_next_id: int):
+        """Drop records for ids below `checkpoint_next_id`, which a checkpoint now holds."""
+        self.close()
+        remaining = [(vector_id, vector) for vector_id, vector in self.read() if vector_id >= checkpoint_next_id]
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as file:
+            for vector_id, vector in remaining:
+                payload = vector.tobytes()
+                file.write(self.HEADER.pack(vector_id, zlib.crc32(payload)) + payload)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+        self.records = len(remaining)
+
+    def clear(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.records = 0
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -1,39 +1,352 @@
 import os
+import time
+import asyncio
+import threading
 import numpy as np
 import faiss
 from sentence_transformers import SentenceTransformer
 
-from chat_history.history_log import HistoryLog
+from chat_history.vector_log import VectorLog
+from chat_history.embedding_executor import EmbeddingExecutor
+from chat_history.embedding_cache import EmbeddingCache
+from chat_history.vector_index_factory import (create_index, index_type_of, tune_search_breadth, search_breadth,
+                                               max_search_breadth, search_parameters, MIN_APPROXIMATE_VECTORS)
+
+DEFAULT_VECTOR_MODEL = 'distilbert-base-nli-stsb-mean-tokens'
+EXACT_FILTER_LIMIT = 2048  # Filters allowing at most this many vectors compare against each of them directly
 
 
 class VectorStorageBase:
-    def __init__(self, vector_model=None, vector_file='vectors.index'):
-        self.vector_model = vector_model or SentenceTransformer('distilbert-base-nli-stsb-mean-tokens')
-        self.vector_index = faiss.IndexFlatL2(768)  # Dimension of DistilBERT embeddings
-        self.vector_file = vector_file
+    """
+    A FAISS index of text embeddings, kept on disk as a checkpoint plus a vector log.
+
+    New vectors are appended to the log instead of rewriting the whole index file.
+    The full index is checkpointed in the background once `checkpoint_every` vectors
+    have been logged or `checkpoint_interval` seconds have passed, and on close.
+    Vectors are stored under stable integer ids, so a search returns the same id that
+    was given to the entry when it was stored. Encoding and searching have async
+    versions that run on the embedding executor and a worker thread, so they don't
+    block the event loop. Every encode goes through the embedding cache, so text that
+    was embedded before is not encoded again.
+
+    The index starts out flat, which searches exactly but scans every vector. Once it
+    holds `index_threshold` vectors it is rebuilt in the background as `index_type`,
+    with its search breadth tuned to reach `target_recall`.
+
+    With `mmap`, the checkpoint is memory-mapped instead of read into memory, so
+    startup doesn't wait on reading the file and pages are loaded as searches touch
+    them. A mapped index can't grow, so it is copied into memory on the first change.
+    """
+
+    def __init__(self, vector_model=None, vector_file='vectors.index', checkpoint_every=256,
+                 checkpoint_interval=300.0, clock=time.monotonic, embedding_executor=None,
+                 embedding_workers=1, model_name=DEFAULT_VECTOR_MODEL, embedding_cache=None,
+                 index_type='hnsw', index_threshold=50_000, target_recall=0.95, max_search_ms=None,
+                 mmap=False):
+        """
+        :param vector_model: Sentence embedding model, loaded on first use if not given.
+        :param vector_file: Checkpoint file for the index, or None to keep it in memory only.
+        :param checkpoint_every: Number of logged vectors that triggers a checkpoint.
+        :param checkpoint_interval: Seconds after which logged vectors trigger a checkpoint.
+        :param clock: Function returning the current time in seconds.
+        :param embedding_executor: EmbeddingExecutor used by the async methods,
+            defaults to one running this storage's model in `embedding_workers` threads.
+        :param embedding_workers: Number of threads encoding at once in the default executor.
+        :param model_name: Name of the sentence model, loaded if no vector_model is given.
+        :param embedding_cache: EmbeddingCache to share, defaults to an in-memory one for the model.
+        :param index_type: Approximate index type used past the threshold, one of INDEX_TYPES.
+        :param index_threshold: Number of vectors at which the flat index is rebuilt, or None to stay flat.
+        :param target_recall: Fraction of the exact nearest neighbours the rebuilt index must find.
+        :param max_search_ms: Milliseconds per search the rebuilt index should stay under, or None.
+        :param mmap: Set to true to memory-map the checkpoint instead of reading it into memory.
+        """
+        self.model_name = model_name
+        self.loaded_model = vector_model  # Loaded on first use, or in the background by load_model
+        self.model_loading = None
+        self.vector_index = self.new_index()
+        self.mmap = mmap
+        self.index_mapped = False  # True while the index is a read-only view of the checkpoint file
+        self.next_id = 1  # Id given to the next vector added
+        self.vector_file = vector_file  # None keeps the index in memory only
+        self.vector_log = VectorLog(vector_file + '.log', 768) if vector_file else None
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_interval = checkpoint_interval
+        self.clock = clock
+        self.last_checkpoint = clock()
+        self.checkpoint_lock = asyncio.Lock()
+        self.checkpoint_task = None
+        self.embedding_executor = embedding_executor or EmbeddingExecutor(vector_model, workers=embedding_workers)
+        self.embedding_cache = embedding_cache or EmbeddingCache(model_name)
+        self.index_lock = threading.Lock()  # Held while the index is changed or searched from another thread
+        self.index_type = index_type
+        self.index_threshold = index_threshold
+        self.target_recall = target_recall
+        self.max_search_ms = max_search_ms
+        self.index_tuning = None  # Breadth, recall and latency chosen by the last rebuild
+        self.rebuild_task = None
         self.load_vector_index()  # Load existing vectors from a file into the FAISS index
 
+    @property
+    def vector_model(self):
+        """The sentence model, loaded on the calling thread if it hasn't been yet."""
+        if self.loaded_model is None:
+            self.set_model(SentenceTransformer(self.model_name))
+        return self.loaded_model
+
+    @property
+    def model_ready(self) -> bool:
+        return self.loaded_model is not None
+
+    def set_model(self, model):
+        self.loaded_model = model
+        if self.embedding_executor.vector_model is None:
+            self.embedding_executor.vector_model = model
+
+    async def load_model(self):
+        """Load the sentence model in a worker thread, so the event loop keeps running meanwhile."""
+        if self.loaded_model is None:
+            if self.model_loading is None:
+                self.model_loading = asyncio.ensure_future(asyncio.to_thread(SentenceTransformer, self.model_name))
+            model = await asyncio.shield(self.model_loading)
+            if self.loaded_model is None:
+                self.set_model(model)
+        return self.loaded_model
+
     def save_vector(self, entry, key):
         """Save the vector representation of the entry's key."""
-        vector = self.vector_model.encode(entry[key])
-        self.vector_index.add(np.array([vector]).astype('float32'))  # Add the vector to the FAISS index
-        faiss.write_index(self.vector_index, self.vector_file)  # Save index to file
+        vectors = self.embed([entry[key]])
+        # Associate the vector id with the entry's key
+        entry[f'{key}_vector_index'] = self.add_vectors(vectors)  # Add the vector to the FAISS index and log
+
+    @staticmethod
+    def new_index():
+        """An empty index that keeps the id each vector was added with."""
+        return create_index('flat')
+
+    @staticmethod
+    def next_id_of(index) -> int:
+        """One past the largest id in the index."""
+        if not index.ntotal or not hasattr(index, 'id_map'):
+            return index.ntotal + 1
+        return int(faiss.vector_to_array(index.id_map).max()) + 1
+
+    def add_vectors(self, vectors, log=True) -> int:
+        """
+        Add vectors to the index and the vector log under the next free ids, checkpointing if one is due.
+
+        :param vectors: Float32 array of shape (n, 768).
+        :param log: Set to false for vectors saved some other way until the next checkpoint.
+        :return: Id of the first vector added; the rest follow it in order.
+        """
+        vectors = np.ascontiguousarray(vectors, dtype='float32')
+        with self.index_lock:
+            self.own_index()
+            first_id = self.next_id
+            self.vector_index.add_with_ids(vectors, np.arange(first_id, first_id + len(vectors), dtype='int64'))
+            self.next_id = first_id + len(vectors)
+        if self.vector_log and log:
+            self.vector_log.append(first_id, vectors)
+            self.maybe_checkpoint()
+        self.maybe_rebuild_index()
+        return first_id
+
+    def maybe_rebuild_index(self):
+        """Start rebuilding the index as `index_type` in the background once a flat index passes the threshold."""
+        if (self.index_threshold is None or self.vector_index.ntotal < self.index_threshold
+                or index_type_of(self.vector_index) != 'flat' or self.index_type == 'flat'
+                or (self.rebuild_task and not self.rebuild_task.done())):
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # Picked up by the next add made from the event loop
+        self.rebuild_task = loop.create_task(self.rebuild_index())
+
+    async def rebuild_index(self, index_type=None):
+        """
+        Rebuild the index as another type, training and tuning it in a worker thread.
+
+        Vectors added while the new index is built are copied over before it replaces
+        the old one, and the result is checkpointed.
+
+        :param index_type: One of INDEX_TYPES, defaults to `index_type`.
+        :return: Dict of the index type, vector count and tuning chosen.
+        """
+        index_type = index_type or self.index_type
+        with self.index_lock:
+            ids = faiss.vector_to_array(self.vector_index.id_map).copy()
+            vectors = self.vector_index.index.reconstruct_n(0, self.vector_index.ntotal) if len(ids) else \
+                np.zeros((0, 768), dtype='float32')
+            snapshot_next_id = self.next_id
+        index, tuning = await asyncio.to_thread(self.build_index, index_type, vectors, ids)
+        with self.index_lock:
+            current_ids = faiss.vector_to_array(self.vector_index.id_map)
+            late_ids = current_ids[current_ids >= snapshot_next_id]
+            if len(late_ids):
+                index.add_with_ids(np.stack([self.vector_index.reconstruct(int(i)) for i in late_ids]), late_ids)
+            self.vector_index = index
+            self.index_mapped = False
+            self.index_tuning = tuning
+        await self.checkpoint()
+        return {'type': index_type_of(index), 'vectors': index.ntotal, 'tuning': tuning}
+
+    async def remove_vectors(self, ids) -> int:
+        """
+        Remove vectors by id and checkpoint the result.
+
+        Index types that can't remove in place, like HNSW, are rebuilt without the
+        vectors instead.
+
+        :param ids: Ids of the vectors to remove.
+        :return: Number of vectors removed.
+        """
+        ids = np.asarray(ids, dtype='int64')
+        if not len(ids):
+            return 0
+        with self.index_lock:
+            self.own_index()
+            try:
+                removed = self.vector_index.remove_ids(faiss.IDSelectorBatch(ids))
+            except RuntimeError:
+                all_ids = faiss.vector_to_array(self.vector_index.id_map)
+                keep = ~np.isin(all_ids, ids)
+                vectors = self.vector_index.index.reconstruct_n(0, self.vector_index.ntotal)[keep]
+                index, tuning = self.build_index(index_type_of(self.vector_index), vectors, all_ids[keep])
+                removed = int(len(all_ids) - keep.sum())
+                self.vector_index, self.index_tuning = index, tuning
+        if self.vector_log:
+            await self.checkpoint()
+            self.vector_log.compact(self.next_id)  # The log may still hold the removed ids above the checkpoint's
+        return int(removed)
+
+    def build_index(self, index_type, vectors, ids):
+        if len(vectors) < MIN_APPROXIMATE_VECTORS:
+            index_type = 'flat'
+        index = create_index(index_type, vectors)
+        if len(vectors):
+            index.add_with_ids(vectors, ids)
+        if index_type == 'flat':
+            return index, None  # Exact, so there is nothing to tune or lose
+        return index, tune_search_breadth(index, vectors, ids, self.target_recall, self.max_search_ms)
+
+    def checkpoint_due(self) -> bool:
+        records = self.vector_log.records if self.vector_log else 0
+        return records > 0 and (records >= self.checkpoint_every
+                                or self.clock() - self.last_checkpoint >= self.checkpoint_interval)
 
-        # Associate the vector index with the entry's key
-        entry[f'{key}_vector_index'] = self.vector_index.ntotal - 1  # Store the index of the vector added
+    def maybe_checkpoint(self):
+        """Start a background checkpoint if one is due and none is running."""
+        if not self.checkpoint_due() or (self.checkpoint_task and not self.checkpoint_task.done()):
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.write_checkpoint(self.vector_index)  # No event loop to run it in the background
+            return
+        self.checkpoint_task = loop.create_task(self.checkpoint())
+
+    async def checkpoint(self):
+        """
+        Write the whole index to the checkpoint file and drop the log records it now holds.
+
+        The index is copied under the index lock and the copy written, both from a worker
+        thread, so the event loop doesn't wait on either, and vectors can keep being added
+        and logged while the file is written.
+        """
+        if not self.vector_file:
+            return
+        async with self.checkpoint_lock:
+            next_id = await asyncio.to_thread(self.write_snapshot)
+            # Compacted back on the event loop, where vectors are appended to the log
+            self.vector_log.compact(next_id)
+            self.last_checkpoint = self.clock()
+
+    def write_snapshot(self) -> int:
+        """Copy the index and write the copy to the checkpoint file; return the next id after its vectors."""
+        with self.index_lock:
+            snapshot = faiss.clone_index(self.vector_index)
+        self.write_checkpoint_file(snapshot)
+        return self.next_id_of(snapshot)
+
+    def write_checkpoint(self, index):
+        self.write_checkpoint_file(index)
+        self.vector_log.compact(self.next_id_of(index))
+        self.last_checkpoint = self.clock()
+
+    def write_checkpoint_file(self, index):
+        temp_file = self.vector_file + '.tmp'
+        faiss.write_index(index, temp_file)
+        # Replace the old checkpoint in one step, so a crash leaves either the old or the new file
+        os.replace(temp_file, self.vector_file)
 
     def load_vector_index(self):
-        """Load existing vectors from a file into the FAISS index."""
-        if os.path.exists(self.vector_file):
-            self.vector_index = faiss.read_index(self.vector_file)
+        """Load the last checkpoint into the FAISS index and replay the vector log onto it."""
+        legacy = False
+        self.index_mapped = False
+        if self.vector_file and os.path.exists(self.vector_file):
+            self.vector_index = self.read_checkpoint()
+            legacy = not hasattr(self.vector_index, 'id_map')
+            if legacy:
+                self.vector_index = self.upgrade_legacy_index(self.vector_index)
+                self.index_mapped = False
         else:
-            self.vector_index = faiss.IndexFlatL2(768)  # Initialize a new FAISS index if the file does not exist
+            self.vector_index = self.new_index()  # Initialize a new FAISS index if the file does not exist
+        self.next_id = self.next_id_of(self.vector_index)
+        if self.vector_log:
+            if self.index_mapped and os.path.exists(self.vector_log.path) and os.path.getsize(self.vector_log.path):
+                self.own_index()
+            self.vector_log.replay(self.vector_index, self.next_id)
+            self.next_id = self.next_id_of(self.vector_index)
+            if legacy:
+                self.write_checkpoint(self.vector_index)
+
+    def read_checkpoint(self):
+        if self.mmap:
+            try:
+                index = faiss.read_index(self.vector_file, faiss.IO_FLAG_MMAP_IFC)
+                self.index_mapped = True
+                return index
+            except (AttributeError, RuntimeError):
+                pass  # This FAISS build or index type can't be mapped
+        return faiss.read_index(self.vector_file)
+
+    def own_index(self):
+        """Copy a memory-mapped index into memory so it can be changed."""
+        if self.index_mapped:
+            self.vector_index = faiss.deserialize_index(faiss.serialize_index(self.vector_index))
+            self.index_mapped = False
+
+    def upgrade_legacy_index(self, index):
+        """
+        Wrap a flat index saved without ids, giving each vector its position plus one as id.
+
+        That is the vector index older versions stored on each entry, so entries keep
+        pointing at their vectors.
+        """
+        upgraded = self.new_index()
+        if index.ntotal:
+            upgraded.add_with_ids(index.reconstruct_n(0, index.ntotal),
+                                  np.arange(1, index.ntotal + 1, dtype='int64'))
+        return upgraded
+
+    async def close(self):
+        """Finish background work, checkpoint any logged vectors and close the log."""
+        if self.rebuild_task:
+            await self.rebuild_task
+        if self.checkpoint_task:
+            await self.checkpoint_task
+        if self.vector_log and self.vector_log.records:
+            await self.checkpoint()
+        if self.vector_log:
+            self.vector_log.close()
+        self.embedding_executor.shutdown()
+        self.embedding_cache.close()
 
     def retrieve_vectors(self, vector, k=1):
         """Retrieve the top k nearest text entries corresponding to a given vector."""
         # Ensure the vector is encoded and reshaped to match FAISS's expectations
         if isinstance(vector, str):
-            vector = self.vector_model.encode(vector)
+            vector = self.embed([vector])
         vector = np.array(vector).astype('float32').reshape(1, -1)  # (1, 768) for DistilBERT embeddings
 
         # Run the search on the FAISS index directly and retrieve distances and indices
@@ -41,4 +354,92 @@ class VectorStorageBase:
 
         return indices[0].tolist(), distances[0].tolist()
 
+    def embed(self, texts: list) -> np.ndarray:
+        """Embed texts on the calling thread, encoding only the ones that aren't cached."""
+        return self.embedding_cache.encode_sync(texts, self.vector_model.encode)
+
+    async def encode_async(self, texts):
+        """Encode a text or list of texts on the embedding executor, encoding only the ones that aren't cached."""
+        await self.load_model()
+        if isinstance(texts, str):
+            return (await self.embedding_cache.encode([texts], self.embedding_executor.encode))[0]
+        return await self.embedding_cache.encode(list(texts), self.embedding_executor.encode)
 
+    async def search_async(self, vector, k=1, ids=None):
+        """
+        Search the index from a worker thread.
+
+        :param ids: Boolean mask indexed by id, or array of ids, the results are restricted to; None searches
+            every vector.
+        """
+        vector = np.array(vector).astype('float32').reshape(1, -1)
+
+        def search():
+            with self.index_lock:
+                if ids is None:
+                    return self.vector_index.search(vector, k)
+                return self.search_filtered(vector, k, ids)
+
+        return await asyncio.to_thread(search)
+
+    def search_filtered(self, vector, k, ids):
+        """
+        Search only the vectors with the given ids, inside the index rather than after it.
+
+        An approximate index walks the same number of candidates whatever the filter, so
+        a filter that excludes most vectors leaves few valid hits among them. The search
+        breadth is scaled up by the share of the index the filter excludes, and doubled
+        until k valid hits come back or the whole index has been visited. Small filters
+        skip the index and compare against each allowed vector.
+
+        :param ids: Boolean mask indexed by id, or array of ids, of the vectors searched.
+        """
+        mask = np.asarray(ids)
+        if mask.dtype != bool:
+            ids = np.unique(mask.astype('int64'))
+            mask = np.zeros(ids[-1] + 1 if len(ids) else 0, dtype=bool)
+            mask[ids] = True
+        allowed = int(np.count_nonzero(mask))
+        distances = np.full((1, k), np.inf, dtype='float32')
+        indices = np.full((1, k), -1, dtype='int64')
+        wanted = min(k, allowed)
+        if not wanted:
+            return distances, indices
+        if allowed <= EXACT_FILTER_LIMIT:
+            held, vectors = [], []
+            for vector_id in np.flatnonzero(mask):
+                try:
+                    vectors.append(self.vector_index.reconstruct(int(vector_id)))
+                    held.append(vector_id)
+                except RuntimeError:
+                    pass  # In the history but not in the index, e.g. lost in a crash before a checkpoint
+            wanted = min(k, len(held))
+            if wanted:
+                found_distances, positions = faiss.knn(vector, np.stack(vectors), wanted)
+                distances[:, :wanted], indices[:, :wanted] = found_distances, np.array(held)[positions]
+            return distances, indices
+        # One bit per id, tested in constant time, so the filter costs nothing to build beyond the packing
+        bitmap = np.packbits(mask, bitorder='little')
+        selector = faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap))
+        breadth = search_breadth(self.vector_index)
+        if breadth is not None:
+            limit = max_search_breadth(self.vector_index)
+            breadth = min(max(breadth * self.vector_index.ntotal // allowed, breadth, k), limit)
+        while True:
+            params = search_parameters(self.vector_index, selector, breadth)
+            distances, indices = self.vector_index.search(vector, k, params=params)
+            if breadth is None or breadth >= limit or (indices[0] >= 0).sum() >= wanted:
+                return distances, indices
+            breadth = min(breadth * 2, limit)
+
+    async def retrieve_vectors_async(self, vector, k=1, ids=None):
+        """
+        Like retrieve_vectors, without blocking the event loop.
+
+        :param ids: Boolean mask indexed by id, or array of ids, the results are restricted to; None searches
+            every vector.
+        """
+        if isinstance(vector, str):
+            vector = await self.encode_async(vector)
+        distances, indices = await self.search_async(vector, k, ids)
+        return indices[0].tolist(), distances[0].tolist()
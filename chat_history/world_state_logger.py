@@ -1,7 +1,8 @@
 import json
 import uuid
 import os
-from chat_history.loggers import BaseLogger, get_timestamp
+from chat_history.loggers import BaseLogger, get_timestamp, session_path, DEFAULT_SESSION
+from chat_history.jsonl_writer import JsonlWriter, read_records
 from output_handler import OutputHandler
 
 
@@ -15,30 +16,46 @@ class WorldStateLogger(BaseLogger):
     async def log_entry(self, role: str, content: str, vector_index=None):
         pass
 
-    def __init__(self, output_handler: OutputHandler, file_name='world_states.jsonl'):
+    def __init__(self, output_handler: OutputHandler, file_name='world_states.jsonl', log_writer: JsonlWriter = None,
+                 session_id=DEFAULT_SESSION):
+        """
+        :param log_writer: Writer the history file is appended through, shared with other logs;
+            defaults to one of its own.
+        :param session_id: Conversation whose world states are logged, each in a file of its own.
+        """
+        file_name = session_path(file_name, session_id)
         super().__init__(output_handler, file_name=file_name, db_name='world_states', table_name='states')
         self.history_file = file_name
+        self.session_id = session_id
         self.chat_history = []
+        self.log_writer = log_writer or JsonlWriter()
 
     async def load_history(self):
         """Load chat history from the file."""
         await self.load_from_file()
 
     async def load_from_file(self):
-        """Load history from a JSONL file, generating IDs for entries that lack them."""
+        """
+        Load history from a JSONL file and its rotated segments, generating IDs for entries that lack them.
+
+        A line with the id of an earlier entry updates its fields, as written by record_vector_index.
+        """
         self.chat_history = []
-        if os.path.exists(self.history_file):
+        if os.path.exists(self.history_file) or os.path.exists(self.history_file + '.1'):
             try:
-                with open(self.history_file, 'r') as file:
-                    for line in file:
-                        entry = json.loads(line)
-                        # Check if the entry has an ID; if not, generate one
-                        if 'id' not in entry:
-                            entry['id'] = str(uuid.uuid4())  # Generate a GUID
-                        # Initialize vector_index if it does not exist
-                        if 'vector_index' not in entry:
-                            entry['vector_index'] = None  # Default value for vector_index
-                        self.chat_history.append(entry)
+                entries = {}
+                for entry in read_records(self.history_file):
+                    if entry.get('id') in entries:
+                        entries[entry['id']].update(entry)
+                        continue
+                    # Check if the entry has an ID; if not, generate one
+                    if 'id' not in entry:
+                        entry['id'] = str(uuid.uuid4())  # Generate a GUID
+                    # Initialize vector_index if it does not exist
+                    if 'vector_index' not in entry:
+                        entry['vector_index'] = None  # Default value for vector_index
+                    entries[entry['id']] = entry
+                    self.chat_history.append(entry)
                 await self.output_handler.send_output(
                     f"World state history loaded from {self.history_file}.",
                     message_type="system"
@@ -55,21 +72,12 @@ class WorldStateLogger(BaseLogger):
             )
 
     async def save_logs(self):
-        """Save the current world state history to the file."""
-        if self.chat_history:
-            try:
-                with open(self.history_file, 'w') as file:
-                    for entry in self.chat_history:
-                        json.dump(entry, file)
-                        file.write('\n')
-                await self.output_handler.send_output(
-                    f"World state history saved to {self.history_file}.",
-                    message_type="system"
-                )
-            except IOError as e:
-                await self.output_handler.send_output(
-                    f"Error saving to file: {str(e)}", message_type="error"
-                )
+        """Wait for everything logged to be written to the file; entries are appended as they are logged."""
+        await self.log_writer.flush()
+        for e in self.log_writer.take_errors():
+            await self.output_handler.send_output(
+                f"Error saving to file: {str(e)}", message_type="error"
+            )
 
     async def log_world_state(self, entry):
         """Log a world state entry."""
@@ -80,6 +88,7 @@ class WorldStateLogger(BaseLogger):
         entry['modified'] = now
 
         self.chat_history.append(entry)  # Append the entry to the chat history
+        self.log_writer.append(self.history_file, [entry])
         await self.output_handler.send_output(
             f"World state logged.", message_type="system"
         )
@@ -89,7 +98,7 @@ class WorldStateLogger(BaseLogger):
         """Update the vector index of an entry by its ID."""
         for entry in self.chat_history:
             if entry.get('id') == entry_id:
-                entry['vector_index'] = vector_index
+                self.record_vector_index(entry, vector_index)
                 await self.output_handler.send_output(
                     f"Updated vector index for entry ID {entry_id}: {vector_index}",
                     message_type="system"
@@ -99,6 +108,11 @@ class WorldStateLogger(BaseLogger):
             f"No log entry found with ID: {entry_id}", message_type="warning"
         )
 
+    def record_vector_index(self, entry, vector_index: int):
+        """Set the vector index of a logged entry, appending the change to the file."""
+        entry['vector_index'] = vector_index
+        self.log_writer.append(self.history_file, [{'id': entry['id'], 'vector_index': vector_index}])
+
     async def get_by_id(self, entry_id: str):
         """Retrieve a log entry by its ID."""
         for entry in self.chat_history:
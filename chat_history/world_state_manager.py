@@ -3,17 +3,22 @@ import asyncio  # For asynchronous operations
 
 from output_handler import OutputHandler
 from chat_history.world_state_logger import WorldStateLogger
+from chat_history.loggers import session_path
 
 
 class WorldStateManager:
     def __init__(self, output_handler: OutputHandler, logger: WorldStateLogger, state_file='last_world_state.json'):
         self.output_handler = output_handler
         self.logger = logger  # Instance of WorldStateLogger
-        self.state_file = state_file
-        self.state_history_file = 'world_states.jsonl'
+        self.session_id = logger.session_id  # Each conversation has its own last world state
+        self.state_file = session_path(state_file, self.session_id)
+        self.state_history_file = logger.history_file
         self.last_world_state = {}
+        self.pending_world_state = {}  # Fields of a prediction that has not been committed yet
         self.save_lock = asyncio.Lock()
         self.save_queue = asyncio.Queue()
+        self.state_vectors = None  # WorldStateVectorStorage that logged states are embedded into, once ready
+        self.vector_tasks = set()  # Snapshots being embedded, referenced so they aren't collected
 
 
     async def save_last_world_state(self):
@@ -23,10 +28,12 @@ class WorldStateManager:
                 # Save to JSON file
                 with open(self.state_file, 'w') as file:
                     json.dump(self.last_world_state, file)
-                # Log to WorldStateLogger
-                entry = await self.logger.log_world_state(self.last_world_state)# Log the current state
-
-
+                # Log a snapshot to WorldStateLogger; the live state keeps changing
+                entry = await self.logger.log_world_state(dict(self.last_world_state))
+                if self.state_vectors is not None and self.state_vectors.model_ready:
+                    task = asyncio.get_running_loop().create_task(self.state_vectors.save_state_vector(entry))
+                    self.vector_tasks.add(task)
+                    task.add_done_callback(self.vector_tasks.discard)
                 await self.output_handler.send_output(f"Last world state saved to {self.state_file} and logged.", message_type="system")
 
     async def load_last_world_state(self):
@@ -44,3 +51,12 @@ class WorldStateManager:
         self.last_world_state["errors"] = []
         self.last_world_state.update(new_state)  # Merge new state into the last state
         await self.save_last_world_state()  # Save the updated state
+
+    async def stage_world_state(self, key, value):
+        """Hold a single predicted field until the prediction it belongs to is committed."""
+        self.pending_world_state[key] = value
+
+    def take_pending_world_state(self):
+        """Return and clear the fields staged since the last commit."""
+        pending, self.pending_world_state = self.pending_world_state, {}
+        return pending
@@ -0,0 +1,84 @@
+import numpy as np
+
+from chat_history.world_state_logger import WorldStateLogger
+from chat_history.vector_storage import VectorStorageBase
+from chat_history.loggers import session_path
+
+STATE_METADATA_KEYS = ('id', 'vector_index', 'created', 'modified', 'errors')
+
+
+def state_text(entry) -> str:
+    """The predicted fields of a world state snapshot as text, one 'key: value' line each."""
+    lines = []
+    for key, value in entry.items():
+        if key in STATE_METADATA_KEYS:
+            continue
+        if isinstance(value, dict) and 'newValue' in value:
+            value = value['newValue']
+        if isinstance(value, list):
+            value = '; '.join(str(item) for item in value)
+        lines.append(f"{key}: {value}")
+    return '\n'.join(lines)
+
+
+class WorldStateVectorStorage(VectorStorageBase):
+    """
+    A vector index over world state snapshots, so past states can be recalled by relevance.
+
+    Snapshots are embedded in the background as they are logged, and their vector id is
+    kept in the snapshot's `vector_index`. Lookups go through a dict of vector id to
+    snapshot, so recalling states costs one search of `n` results whatever the history size.
+    """
+
+    def __init__(self, world_state_logger: WorldStateLogger, vector_file='world_state_vectors.index',
+                 vector_model=None, embedding_cache=None, index_type='hnsw'):
+        # Each conversation's states have an index of their own
+        super().__init__(vector_model=vector_model, vector_file=session_path(vector_file, world_state_logger.session_id),
+                         embedding_cache=embedding_cache, index_type=index_type)
+        self.world_state_logger = world_state_logger
+        self.states_by_vector = {}  # Vector id -> snapshot
+
+    async def save_state_vector(self, entry):
+        """Embed a logged snapshot and record its vector id on it."""
+        text = state_text(entry)
+        if not text:
+            return None
+        vector = await self.encode_async(text)
+        vector_id = self.add_vectors(np.array([vector]).astype('float32'))
+        self.world_state_logger.record_vector_index(entry, vector_id)
+        self.states_by_vector[vector_id] = entry
+        return vector_id
+
+    async def init_vector_db(self, batch_size=64):
+        """
+        Embed the snapshots in the history that have no vector yet, in batches.
+
+        :param batch_size: Number of snapshots encoded per call to the model.
+        :return: Number of snapshots embedded.
+        """
+        self.states_by_vector = {int(entry['vector_index']): entry for entry in self.world_state_logger.chat_history
+                                 if entry.get('vector_index') is not None}
+        entries = [entry for entry in self.world_state_logger.chat_history
+                   if entry.get('vector_index') is None and state_text(entry)]
+        for batch_start in range(0, len(entries), batch_size):
+            batch = entries[batch_start:batch_start + batch_size]
+            vectors = await self.encode_async([state_text(entry) for entry in batch])
+            first_id = self.add_vectors(vectors)
+            for offset, entry in enumerate(batch):
+                self.world_state_logger.record_vector_index(entry, first_id + offset)
+                self.states_by_vector[first_id + offset] = entry
+        return len(entries)
+
+    async def retrieve_states(self, query: str, n=3, exclude_ids=()):
+        """
+        Return up to n past snapshots most relevant to the query, most relevant first.
+
+        :param query: Text to find related snapshots for.
+        :param n: Number of snapshots to return.
+        :param exclude_ids: Snapshot ids to leave out, such as the current state's.
+        """
+        if not self.model_ready or not self.vector_index.ntotal:
+            return []
+        indices, _ = await self.retrieve_vectors_async(query, n + len(exclude_ids))
+        states = [self.states_by_vector.get(index) for index in indices if index >= 0]
+        return [state for state in states if state is not None and state['id'] not in exclude_ids][:n]
@@ -1,31 +1,47 @@
-import asyncio
-
 from chat_history.chat_history_manager import ChatHistoryManager
 from command_processor import CommandProcessor
-from ai_implementation import AIImplementation
+from ai_implementation import AIImplementation, RECENT_HISTORY_CANDIDATES
 from input_handler import InputHandler
 from output_handler import OutputHandler  # Assuming you have this
 from debug_logger import DebugLogger
+from turn_scheduler import TurnScheduler, WorldStatePolicy
+from response_cache import ResponseCache
+from model_scheduler import ModelRequestScheduler
 
 
 class Chatbot:
-    def __init__(self, input_handler: InputHandler, output_handler: OutputHandler, model_name: str, debug_logger=None):
+    def __init__(self, input_handler: InputHandler, output_handler: OutputHandler, model_name: str, debug_logger=None,
+                 world_state_policy=WorldStatePolicy.COMMITTED, in_flight_timeout=None,
+                 use_response_cache=False, model_scheduler: ModelRequestScheduler = None,
+                 session_id='default'):
         self.debug_logger = debug_logger or DebugLogger(output_handler)
-        self.chat_manager = ChatHistoryManager(output_handler, self.debug_logger)
+        self.chat_manager = ChatHistoryManager(output_handler, self.debug_logger, session_id=session_id)
+        response_cache = None
+        if use_response_cache:
+            response_cache = ResponseCache(vector_storage=self.chat_manager.vector_chat_storage)
         self.ai = AIImplementation(
             model_name,
             self.chat_manager,
             debug_logger=self.debug_logger,
             output_handler=output_handler,
-
+            response_cache=response_cache,
+            model_backend=model_scheduler.backend_for(session_id) if model_scheduler else None,
            )
+        # Older history is condensed by the same model, at background priority. Only entries older than
+        # the recent messages the prompt offers are summarized, so no turn appears both ways
+        self.chat_manager.summarizer.summarize = self.ai.summarize_lines
+        self.chat_manager.summarizer.keep_recent = RECENT_HISTORY_CANDIDATES
         self.command_processor = CommandProcessor(self.chat_manager,
                                                   self.ai,
                                                   output_handler,
                                                   debug_logger=self.debug_logger)
         self.input_handler = input_handler
         self.output_handler = output_handler
-        self.generation_task = None
+        self.turn_scheduler = TurnScheduler(self.ai,
+                                            self.chat_manager.world_state_manager,
+                                            self.debug_logger,
+                                            policy=world_state_policy,
+                                            in_flight_timeout=in_flight_timeout)
 
     async def load(self):
         await self.chat_manager.load_history()
@@ -36,52 +52,13 @@ class Chatbot:
         return await self.input_handler.get_input()
 
     async def world_state_generation(self, user_input):
-        history_manager = self.chat_manager
-        state_manager = history_manager.world_state_manager
-        self.generation_task = asyncio.create_task(
-            self.ai.get_prediction_streaming(
-                user_input=user_input,
-                is_cancelled=lambda: False)
-        )
-
-        try:
-            prediction, errors = await self.generation_task
-            if prediction:
-                await state_manager.update_world_state(prediction)
-                # await history_manager.log_chat(role='system', content=prediction)
-            else:
-                await state_manager.update_world_state({ 'errors': [errors]})
-                # await history_manager.log_chat(role='system', content=f"[ERROR PROCESSING RESPONSE] {errors}")
-
-        except asyncio.CancelledError:
-            if self.generation_task:
-                self.generation_task.cancel()
-                try:
-                    partial_result, errors = await self.generation_task  # Get partial data if available
-                    if partial_result:
-                        await self.debug_logger.log("Partial data retained after cancellation.")
-                        await state_manager.update_world_state(partial_result)
-                    await history_manager.log_chat(role='system', content="[PARTIAL RESPONSE DUE TO CANCELLATION]")
-
-                except asyncio.CancelledError:
-                    await self.debug_logger.log("Generation task was successfully cancelled with no partial data.")
-            await self.debug_logger.log("Generation interrupted by user feedback.")
+        """Start predicting the world state for this turn in the background."""
+        await self.turn_scheduler.schedule_world_state(user_input)
 
     async def handle_input(self):
         """Handles user input and processes commands or chat responses."""
         while True:
             user_input = await self.listen()  # Call the listen method to get user input
-            if self.generation_task and not self.generation_task.done():
-                self.generation_task.cancel()
-                await self.debug_logger.log("Wrapping up world state genration.")
-                try:
-                    await self.generation_task  # Ensure cleanup
-                    await self.debug_logger.log("Previous generation task was successfully cancelled.")
-                except asyncio.CancelledError:
-                    await self.debug_logger.log("Previous generation task was successfully cancelled.")
-
-                await self.debug_logger.log("Finished wrapping up world state generation.")
-
             await self.chat_manager.log_chat(role='user', content=user_input)
             await self.debug_logger.log("Chat logged")
             # Command processing
@@ -96,24 +73,41 @@ class Chatbot:
                     user_input = f"<User ran {user_input} with result {result}>"
 
                 if not pass_on:
+                    await self.chat_manager.end_turn()
                     continue
 
             # Generate response
             await self.debug_logger.log("User input processed")
+            await self.turn_scheduler.prepare_prompt()
             quick_response, errors = await self.ai.get_chat_response(user_input=user_input)
             await self.chat_manager.log_chat(role='assistant', content=quick_response)
 
             # Handle errors if needed
             if errors:
                 await self.chat_manager.log_chat(role='system', content=f"[ERROR] {errors}")
+            await self.chat_manager.end_turn()
 
-            # Output the response
-            await self.output_handler.send_output(quick_response)
+            # The response has already been streamed to the output handler
+            await self.report_turn_timings()
             await self.world_state_generation(user_input)
 
+    async def report_turn_timings(self):
+        """Log the time to first token and total time of the last response."""
+        timings = self.ai.last_timings.get('response')
+        if not timings or timings['time_to_first_token'] is None:
+            return
+        await self.debug_logger.log(
+            f"Time to first token: {timings['time_to_first_token']:.3f}s, "
+            f"total: {timings['total_time']:.3f}s over {timings['chunks']} chunks")
+
     async def run(self):
         """Main method to run the chatbot."""
         await self.chat_manager.init()
         await self.output_handler.send_output("Chatbot is starting...")
         await self.load()
-        await self.handle_input()
+        try:
+            await self.handle_input()
+        finally:
+            await self.turn_scheduler.close()
+            await self.ai.close()
+            await self.chat_manager.close()
@@ -2,6 +2,7 @@ import subprocess
 import json
 
 from debug_logger import DebugLogger
+from chat_history.vector_index_factory import INDEX_TYPES, index_type_of
 
 
 async def handle_exit(command):
@@ -25,6 +26,8 @@ class CommandProcessor:
             "/archive": self.handle_archive,
             "/load": self.handle_load,
             "/states": self.handle_states,
+            "/stats": self.handle_stats,
+            "/reindex": self.handle_reindex,
             "/+": self.handle_rate_chat_positive,
             "/-": self.handle_rate_chat_negative,
             "/c ": self.handle_console_command
@@ -59,10 +62,13 @@ class CommandProcessor:
         return "History saved.", False
 
     async def handle_archive(self, command):
-        """Handle the archive command."""
-        self.chat_history_manager.archive_history()
-        self.chat_history_manager.save_last_world_state()
-        return "History archived.", False
+        """Handle the archive command: archive all but the newest N entries, by default the configured number."""
+        keep_count = command[len("/archive"):].strip()
+        if keep_count and not keep_count.isdigit():
+            return "Usage: /archive [number of newest entries to keep]", False
+        archived = await self.chat_history_manager.archive_history(int(keep_count) if keep_count else None)
+        segments = self.chat_history_manager.chat_logger.archive.manifest
+        return f"Archived {archived} entries; the archive has {len(segments)} segments.", False
 
     async def handle_load(self, command):
         """Handle the load command."""
@@ -74,6 +80,36 @@ class CommandProcessor:
         """Handle the states command."""
         return json.dumps(self.world_state_manager.last_world_state, indent=2), False
 
+    async def handle_stats(self, command):
+        """Handle the stats command."""
+        stats = {
+            "timings": self.ai.last_timings,
+            "prompt_tokens": self.ai.last_prompt_reports,
+        }
+        vector_storage = self.chat_history_manager.vector_chat_storage
+        stats["vector_index"] = {"type": index_type_of(vector_storage.vector_index),
+                                 "vectors": vector_storage.vector_index.ntotal,
+                                 "tuning": vector_storage.index_tuning}
+        embedding_cache = vector_storage.embedding_cache
+        stats["embedding_cache"] = {**embedding_cache.stats, "hit_rate": embedding_cache.hit_rate}
+        archive = self.chat_history_manager.chat_logger.archive
+        stats["archive"] = {"segments": len(archive.manifest),
+                            "entries": sum(segment['count'] for segment in archive.manifest)}
+        if self.ai.response_cache:
+            stats["response_cache"] = self.ai.response_cache.stats
+        scheduler = getattr(self.ai.model_backend, 'scheduler', None)
+        if scheduler:
+            stats["model_scheduler"] = scheduler.metrics()
+        return json.dumps(stats, indent=2), False
+
+    async def handle_reindex(self, command):
+        """Handle the reindex command: rebuild the chat vector index, optionally as another type."""
+        index_type = command[len("/reindex"):].strip() or None
+        if index_type and index_type not in INDEX_TYPES:
+            return f"Unknown index type {index_type}. Choose from: {', '.join(INDEX_TYPES)}.", False
+        result = await self.chat_history_manager.vector_chat_storage.rebuild_index(index_type)
+        return f"Chat vectors reindexed: {json.dumps(result)}", False
+
     async def handle_rate_chat_positive(self, command):
         """Rate chat positively."""
         self.chat_history_manager.rate_chat(1)
@@ -0,0 +1,212 @@
+import json
+import time
+import codecs
+import asyncio
+import subprocess
+from abc import ABC, abstractmethod
+from typing import AsyncIterator
+
+import httpx
+
+DEFAULT_CONTEXT_WINDOW = 8192
+DEFAULT_OLLAMA_URL = "http://127.0.0.1:11434"
+
+
+class RequestPriority:
+    """Lower values are served first when model calls have to queue."""
+    QUICK = 0  # Chat responses the user is waiting on
+    BACKGROUND = 1  # World state predictions and other work nobody is watching
+
+
+class ModelBackendUnavailable(Exception):
+    """Raised when a backend cannot reach its model before producing any output."""
+
+
+class ModelBackend(ABC):
+    """Abstract base class for anything that can stream text out of a model."""
+
+    @abstractmethod
+    def stream(self, prompt: str, is_jsonl=False,
+               context_window=DEFAULT_CONTEXT_WINDOW, priority=RequestPriority.QUICK) -> AsyncIterator[str]:
+        """
+        Stream the model's response to a prompt as text chunks.
+
+        :param prompt: The prompt to send to the model.
+        :param is_jsonl: Set to true to ask the model for json output.
+        :param context_window: Context window size in tokens.
+        :param priority: A RequestPriority value, used by backends that queue requests.
+        :return: Async iterator of text chunks.
+        """
+        pass
+
+    async def close(self):
+        """Release any resources held by the backend."""
+        pass
+
+
+class OllamaHttpBackend(ModelBackend):
+    """
+    Streams responses from an Ollama-compatible HTTP server.
+
+    A single client is kept for the lifetime of the backend so connections are
+    pooled and reused between quick responses and world state predictions.
+    The prompt travels in the request body, so it is not bound by argv limits.
+    """
+
+    def __init__(self, model_name: str, base_url=DEFAULT_OLLAMA_URL,
+                 max_connections=4, timeout=None):
+        """
+        :param model_name: The name of the model to run on the server.
+        :param base_url: Base url of the Ollama-compatible server.
+        :param max_connections: Number of pooled keep-alive connections.
+        :param timeout: Read timeout in seconds, or None to wait indefinitely.
+        """
+        self.model_name = model_name
+        self.base_url = base_url.rstrip('/')
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.client = None
+
+    def get_client(self) -> httpx.AsyncClient:
+        """Return the pooled client, creating it on first use."""
+        if self.client is None or self.client.is_closed:
+            self.client = httpx.AsyncClient(
+                base_url=self.base_url,
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections),
+                timeout=httpx.Timeout(self.timeout, connect=5.0),
+            )
+        return self.client
+
+    def build_request(self, prompt: str, is_jsonl: bool, context_window: int) -> dict:
+        body = {
+            "model": self.model_name,
+            "prompt": prompt,
+            "stream": True,
+            "options": {"num_ctx": context_window},
+        }
+        if is_jsonl:
+            body["format"] = "json"
+        return body
+
+    async def stream(self, prompt: str, is_jsonl=False,
+                     context_window=DEFAULT_CONTEXT_WINDOW, priority=RequestPriority.QUICK) -> AsyncIterator[str]:
+        body = self.build_request(prompt, is_jsonl, context_window)
+        try:
+            async with self.get_client().stream("POST", "/api/generate", json=body) as response:
+                if response.status_code != 200:
+                    detail = (await response.aread()).decode('utf-8', errors='replace')
+                    raise ModelBackendUnavailable(
+                        f"Model server returned {response.status_code}: {detail}")
+                async for line in response.aiter_lines():
+                    if not line.strip():
+                        continue
+                    message = json.loads(line)
+                    if message.get("error"):
+                        raise RuntimeError(message["error"])
+                    chunk = message.get("response", "")
+                    if chunk:
+                        yield chunk
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+            raise ModelBackendUnavailable(f"Could not reach model server at {self.base_url}: {e}") from e
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+
+class SubprocessBackend(ModelBackend):
+    """Streams responses by spawning `ollama run` for every call. Kept as a fallback."""
+
+    def __init__(self, model_name: str, read_size=256):
+        self.model_name = model_name
+        self.read_size = read_size
+
+    async def stream(self, prompt: str, is_jsonl=False,
+                     context_window=DEFAULT_CONTEXT_WINDOW, priority=RequestPriority.QUICK) -> AsyncIterator[str]:
+        args = ["context-window", str(context_window)]
+        if is_jsonl: args.extend(['--format', 'json'])
+        process = await asyncio.create_subprocess_exec(
+            "ollama", "run", self.model_name, prompt, *args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        try:
+            while True:
+                # read() returns as soon as any output is available, so text streams as it is produced
+                data = await process.stdout.read(self.read_size)
+                if not data:
+                    break
+                chunk = decoder.decode(data)
+                if chunk:
+                    yield chunk
+            tail = decoder.decode(b'', final=True)
+            if tail:
+                yield tail
+            await process.wait()
+        finally:
+            if process.returncode is None:
+                process.terminate()
+
+
+class FallbackBackend(ModelBackend):
+    """
+    Tries the primary backend and switches to the fallback when the primary is unreachable.
+
+    Once the primary has failed, the fallback is used for `retry_after` seconds,
+    after which the next call tries the primary again.
+    """
+
+    def __init__(self, primary: ModelBackend, fallback: ModelBackend, on_fallback=None,
+                 retry_after=30.0, clock=time.monotonic):
+        """
+        :param primary: The preferred backend.
+        :param fallback: The backend to use when the primary is unavailable.
+        :param on_fallback: Optional coroutine function called with the error on switching.
+        :param retry_after: Seconds to stay on the fallback before retrying the primary.
+        :param clock: Function returning the current time in seconds.
+        """
+        self.primary = primary
+        self.fallback = fallback
+        self.on_fallback = on_fallback
+        self.retry_after = retry_after
+        self.clock = clock
+        self.failed_at = None  # When the primary last failed, or None while it is in use
+
+    @property
+    def use_fallback(self) -> bool:
+        return self.failed_at is not None and self.clock() - self.failed_at < self.retry_after
+
+    def retry_primary(self):
+        self.failed_at = None
+
+    async def stream(self, prompt: str, is_jsonl=False,
+                     context_window=DEFAULT_CONTEXT_WINDOW, priority=RequestPriority.QUICK) -> AsyncIterator[str]:
+        if not self.use_fallback:
+            try:
+                async for chunk in self.primary.stream(prompt, is_jsonl, context_window):
+                    yield chunk
+                self.failed_at = None
+                return
+            except ModelBackendUnavailable as e:
+                already_fallen_back = self.failed_at is not None
+                self.failed_at = self.clock()
+                if self.on_fallback and not already_fallen_back:
+                    await self.on_fallback(e)
+        async for chunk in self.fallback.stream(prompt, is_jsonl, context_window):
+            yield chunk
+
+    async def close(self):
+        await self.primary.close()
+        await self.fallback.close()
+
+
+def create_default_backend(model_name: str, base_url=DEFAULT_OLLAMA_URL, on_fallback=None) -> ModelBackend:
+    """Pooled HTTP backend with the `ollama run` subprocess as fallback."""
+    return FallbackBackend(
+        OllamaHttpBackend(model_name, base_url=base_url),
+        SubprocessBackend(model_name),
+        on_fallback=on_fallback,
+    )
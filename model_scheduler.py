@@ -0,0 +1,178 @@
+import asyncio
+from collections import OrderedDict, deque
+from typing import AsyncIterator
+
+from model_backend import ModelBackend, RequestPriority, DEFAULT_CONTEXT_WINDOW
+
+
+class ModelRequestTimeout(Exception):
+    """Raised when a model request misses its deadline or runs past its timeout."""
+
+
+class ModelRequestScheduler:
+    """
+    Shares one model backend between many chat sessions with bounded concurrency.
+
+    At most `max_concurrency` streams run at once. Waiting requests are served
+    highest priority first, and within a priority the sessions take turns, so
+    one busy conversation cannot starve the others. A request can carry a
+    deadline by which it must have started, and a timeout on its whole run.
+    """
+
+    def __init__(self, backend: ModelBackend, max_concurrency=2, default_timeout=None, default_queue_timeout=None):
+        """
+        :param backend: The backend every session's requests are sent to.
+        :param max_concurrency: Number of model calls allowed to run at once.
+        :param default_timeout: Seconds a stream may run in total, or None for no limit.
+        :param default_queue_timeout: Seconds a request may wait for a slot, or None for no limit.
+        """
+        self.backend = backend
+        self.max_concurrency = max_concurrency
+        self.default_timeout = default_timeout
+        self.default_queue_timeout = default_queue_timeout
+        self.active = 0
+        # Priority -> session id -> waiting futures; session order is the round robin order
+        self.queues = {RequestPriority.QUICK: OrderedDict(), RequestPriority.BACKGROUND: OrderedDict()}
+        self.counters = {'started': 0, 'completed': 0, 'timeouts': 0, 'rejected': 0}
+        self.wait_totals = {priority: [0, 0.0] for priority in self.queues}  # Count and total seconds waited
+
+    def backend_for(self, session_id: str) -> 'SessionBackend':
+        """Return a backend that routes one session's requests through this scheduler."""
+        return SessionBackend(self, session_id)
+
+    def queue_depth(self, priority=None) -> int:
+        priorities = [priority] if priority is not None else self.queues
+        return sum(len(waiters) for p in priorities for waiters in self.queues[p].values())
+
+    def metrics(self) -> dict:
+        return {
+            'active': self.active,
+            'max_concurrency': self.max_concurrency,
+            'queue_depth': {name: self.queue_depth(priority) for name, priority in
+                            (('quick', RequestPriority.QUICK), ('background', RequestPriority.BACKGROUND))},
+            'sessions_waiting': len({session for queue in self.queues.values() for session in queue}),
+            'average_wait': {priority: (total / count if count else 0.0)
+                             for priority, (count, total) in self.wait_totals.items()},
+            **self.counters,
+        }
+
+    async def acquire(self, session_id: str, priority: int, deadline=None):
+        """
+        Wait for a free slot.
+
+        :param session_id: The session making the request.
+        :param priority: A RequestPriority value.
+        :param deadline: Event loop time by which the request must start, or None.
+        :raises ModelRequestTimeout: If the deadline passes first.
+        """
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        if self.active < self.max_concurrency and self.queue_depth() == 0:
+            self.active += 1
+            self.record_wait(priority, 0.0)
+            return
+
+        waiter = loop.create_future()
+        self.queues[priority].setdefault(session_id, deque()).append(waiter)
+        timeout = None if deadline is None else max(0.0, deadline - loop.time())
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as we gave up, so pass it on
+                self.release()
+            else:
+                waiter.cancel()
+                self.remove_waiter(priority, session_id, waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                self.counters['rejected'] += 1
+                raise ModelRequestTimeout(f"Request from session {session_id} waited past its deadline") from e
+            raise
+        self.record_wait(priority, loop.time() - started)
+
+    def record_wait(self, priority, seconds):
+        self.wait_totals[priority][0] += 1
+        self.wait_totals[priority][1] += seconds
+
+    def remove_waiter(self, priority, session_id, waiter):
+        waiters = self.queues[priority].get(session_id)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del self.queues[priority][session_id]
+
+    def release(self):
+        """Free a slot, handing it straight to the next waiting request if there is one."""
+        for priority in sorted(self.queues):
+            queue = self.queues[priority]
+            while queue:
+                session_id, waiters = next(iter(queue.items()))
+                waiter = waiters.popleft()
+                # Move the session to the back so other sessions at this priority go next
+                del queue[session_id]
+                if waiters:
+                    queue[session_id] = waiters
+                if not waiter.done():
+                    waiter.set_result(None)
+                    return
+        self.active -= 1
+
+    async def stream(self, prompt: str, session_id: str, is_jsonl=False,
+                     context_window=DEFAULT_CONTEXT_WINDOW, priority=RequestPriority.QUICK,
+                     deadline=None, timeout=None) -> AsyncIterator[str]:
+        """
+        Stream a model response once a slot is free.
+
+        :param prompt: The prompt to send to the model.
+        :param session_id: The session making the request.
+        :param is_jsonl: Set to true to ask the model for json output.
+        :param context_window: Context window size in tokens.
+        :param priority: A RequestPriority value.
+        :param deadline: Event loop time by which the request must start, defaults to now plus default_queue_timeout.
+        :param timeout: Seconds the stream may run once started, defaults to default_timeout.
+        :raises ModelRequestTimeout: If the request waits past its deadline or runs past its timeout.
+        """
+        loop = asyncio.get_running_loop()
+        if deadline is None and self.default_queue_timeout is not None:
+            deadline = loop.time() + self.default_queue_timeout
+        timeout = timeout if timeout is not None else self.default_timeout
+
+        await self.acquire(session_id, priority, deadline)
+        self.counters['started'] += 1
+        stream = self.backend.stream(prompt, is_jsonl=is_jsonl, context_window=context_window, priority=priority)
+        finish_by = None if timeout is None else loop.time() + timeout
+        try:
+            while True:
+                remaining = None if finish_by is None else max(0.0, finish_by - loop.time())
+                try:
+                    chunk = await asyncio.wait_for(stream.__anext__(), remaining)
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError as e:
+                    self.counters['timeouts'] += 1
+                    raise ModelRequestTimeout(f"Request from session {session_id} ran past {timeout}s") from e
+                yield chunk
+            self.counters['completed'] += 1
+        finally:
+            await stream.aclose()
+            self.release()
+
+    async def close(self):
+        await self.backend.close()
+
+
+class SessionBackend(ModelBackend):
+    """A session's view of a shared ModelRequestScheduler."""
+
+    def __init__(self, scheduler: ModelRequestScheduler, session_id: str):
+        self.scheduler = scheduler
+        self.session_id = session_id
+
+    def stream(self, prompt: str, is_jsonl=False,
+               context_window=DEFAULT_CONTEXT_WINDOW, priority=RequestPriority.QUICK) -> AsyncIterator[str]:
+        return self.scheduler.stream(prompt, self.session_id, is_jsonl=is_jsonl,
+                                     context_window=context_window, priority=priority)
+
+    async def close(self):
+        # The underlying backend is shared by other sessions and closed by the scheduler's owner
+        pass
@@ -0,0 +1,117 @@
+import json
+import asyncio
+import argparse
+
+
+def echo_responder(body: dict) -> list:
+    """Default responder: answers json requests with a world state line and echoes everything else."""
+    if body.get("format") == "json":
+        return ['{"CurrentState": ', '{"newValue": "stub"}}', '\n']
+    return [word + ' ' for word in f"stub response to {len(body.get('prompt', ''))} chars".split(' ')]
+
+
+class StubModelServer:
+    """
+    A tiny local server speaking the streaming part of the Ollama `/api/generate` api.
+
+    It exists so the HTTP backend can be exercised offline. Responses are produced by
+    `responder`, which receives the decoded request body and returns a list of text chunks.
+    Connections are kept alive, and `connection_count` records how many were opened.
+    """
+
+    def __init__(self, responder=echo_responder, host='127.0.0.1', port=0, chunk_delay=0.0):
+        self.responder = responder
+        self.host = host
+        self.port = port
+        self.chunk_delay = chunk_delay
+        self.server = None
+        self.connection_count = 0
+        self.requests = []
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connection_count += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, value = line.decode('latin-1').split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                if method != 'POST' or path != '/api/generate':
+                    await self.write_response(writer, 404, [json.dumps({"error": "not found"}).encode()])
+                    continue
+
+                request = json.loads(body or b'{}')
+                self.requests.append(request)
+                lines = []
+                for chunk in self.responder(request):
+                    lines.append(json.dumps({"model": request.get("model"), "response": chunk,
+                                             "done": False}).encode() + b'\n')
+                lines.append(json.dumps({"model": request.get("model"), "response": "",
+                                         "done": True}).encode() + b'\n')
+                await self.write_response(writer, 200, lines)
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionResetError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def write_response(self, writer: asyncio.StreamWriter, status: int, chunks: list):
+        reason = "OK" if status == 200 else "Not Found"
+        writer.write(
+            f"HTTP/1.1 {status} {reason}\r\n"
+            "Content-Type: application/x-ndjson\r\n"
+            "Transfer-Encoding: chunked\r\n"
+            "Connection: keep-alive\r\n\r\n".encode('latin-1')
+        )
+        for chunk in chunks:
+            writer.write(f"{len(chunk):x}\r\n".encode('latin-1') + chunk + b"\r\n")
+            await writer.drain()
+            if self.chunk_delay:
+                await asyncio.sleep(self.chunk_delay)
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+
+async def serve(host: str, port: int):
+    async with StubModelServer(host=host, port=port) as server:
+        print(f"Stub model server listening on {server.base_url}")
+        await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local stub of the Ollama generate api.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11434)
+    options = parser.parse_args()
+    asyncio.run(serve(options.host, options.port))
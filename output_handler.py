@@ -2,6 +2,9 @@ from abc import ABC, abstractmethod
 
 # Abstract base class for output handling
 class OutputHandler(ABC):
+    def __init__(self):
+        self.stream_buffer = []  # Chunks of the message being streamed, for handlers that can't render them
+
     @abstractmethod
     async def send_output(self, message: str, message_type: str=None):
         """Send output to the user."""
@@ -9,3 +12,18 @@ class OutputHandler(ABC):
 
     def queue_output(self, message: str, message_type: str=None):
         pass
+
+    async def stream_output(self, chunk: str, message_type: str=None):
+        """
+        Render part of a message as it streams in.
+
+        Handlers that cannot render incrementally get the whole message through
+        send_output once end_stream is called.
+        """
+        self.stream_buffer.append(chunk)
+
+    async def end_stream(self, message_type: str=None):
+        """Finish the message started by stream_output."""
+        chunks, self.stream_buffer = self.stream_buffer, []
+        if chunks:
+            await self.send_output(''.join(chunks), message_type=message_type)
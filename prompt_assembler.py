@@ -0,0 +1,169 @@
+import re
+import math
+
+
+class ApproximateTokenizer:
+    """
+    Fast token estimate that needs no model files.
+
+    Counts words and punctuation marks, and never estimates fewer than one token
+    per four characters, which keeps it on the safe side for most BPE tokenizers.
+    """
+    TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        return max(len(self.TOKEN_PATTERN.findall(text)), math.ceil(len(text) / 4))
+
+
+class HuggingFaceTokenizer:
+    """Exact token counts from a Hugging Face tokenizer, loaded by name."""
+
+    def __init__(self, name: str):
+        from transformers import AutoTokenizer
+        self.tokenizer = AutoTokenizer.from_pretrained(name)
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+
+def create_tokenizer(name=None):
+    """
+    Return a tokenizer for `name`, or the approximate tokenizer if none is given or it cannot be loaded.
+
+    :param name: Optional Hugging Face tokenizer name.
+    """
+    if name:
+        try:
+            return HuggingFaceTokenizer(name)
+        except Exception:
+            pass
+    return ApproximateTokenizer()
+
+
+class PromptSection:
+    """
+    A named part of a prompt holding items that compete for a share of the token budget.
+
+    Items are kept in priority order (the first item is the most important) until the
+    section's budget is spent; items that don't fit are dropped. The kept items are
+    returned in their original order.
+    """
+
+    def __init__(self, name: str, items: list, render=str, priority_order=None, required=False):
+        """
+        :param name: Section name, matched against the assembler's budgets.
+        :param items: Items in the order they should appear in the prompt.
+        :param render: Function turning an item into the text that will be counted.
+        :param priority_order: Indices of `items` from most to least important, defaults to list order.
+        :param required: If true, the first item is truncated to fit instead of being dropped.
+        """
+        self.name = name
+        self.items = items
+        self.render = render
+        self.priority_order = priority_order if priority_order is not None else range(len(items))
+        self.required = required
+
+
+class PromptAssembler:
+    """
+    Fills a context window from prompt sections, each with a share of the available tokens.
+
+    Budget a section does not use is handed to later sections in the order given, so a
+    short system prompt leaves more room for history.
+    """
+    DEFAULT_BUDGETS = {
+        'system': 0.15,
+        'world_state': 0.15,
+        'past_states': 0.1,
+        'summaries': 0.1,
+        'recent': 0.4,
+        'context': 0.3,
+    }
+    MESSAGE_OVERHEAD = 4  # Tokens spent on the role and framing of each message
+
+    def __init__(self, tokenizer=None, context_window=8192, response_reserve=None, budgets=None,
+                 max_user_input_share=0.5):
+        """
+        :param tokenizer: Object with a `count(text) -> int` method, defaults to ApproximateTokenizer.
+        :param context_window: Total tokens the model accepts.
+        :param response_reserve: Tokens kept free for the model's response,
+            defaults to a quarter of the window capped at 1024.
+        :param budgets: Mapping of section name to its fraction of the available tokens.
+        :param max_user_input_share: Largest fraction of the available tokens the user input may
+            take; longer input is truncated so the sections still fit.
+        """
+        self.tokenizer = tokenizer or ApproximateTokenizer()
+        self.context_window = context_window
+        self.response_reserve = response_reserve if response_reserve is not None else min(1024, context_window // 4)
+        self.budgets = budgets or dict(self.DEFAULT_BUDGETS)
+        self.max_user_input_share = max_user_input_share
+
+    def count(self, text: str) -> int:
+        return self.tokenizer.count(text) + self.MESSAGE_OVERHEAD
+
+    def assemble(self, sections: list, user_input: str = ''):
+        """
+        Choose which items of each section fit in the context window.
+
+        :param sections: PromptSection instances, in the order budget is handed down.
+        :param user_input: Text that is always included and comes out of the total first,
+            truncated if it is longer than its share of the window.
+        :return: Tuple of a dict of section name to kept items (with the possibly truncated
+            user input under 'user_input'), and a report dict of section name to used tokens,
+            budget, kept and dropped item counts. The total never exceeds the window minus the reserve.
+        """
+        limit = max(0, self.context_window - self.response_reserve)
+        user_tokens = 0
+        original_input = user_input
+        if user_input:
+            user_input = self.truncate(user_input, int(limit * self.max_user_input_share))
+            user_tokens = self.count(user_input)
+        available = max(0, limit - user_tokens)
+        total_share = sum(self.budgets.get(section.name, 0) for section in sections) or 1
+
+        kept = {'user_input': user_input}
+        report = {'user_input': {'used': user_tokens, 'truncated': user_input != original_input}}
+        carry = 0
+        for section in sections:
+            budget = int(available * self.budgets.get(section.name, 0) / total_share) + carry
+            chosen, used = self.fill_section(section, budget)
+            kept[section.name] = chosen
+            carry = max(0, budget - used)
+            report[section.name] = {
+                'used': used,
+                'budget': budget,
+                'kept': len(chosen),
+                'dropped': len(section.items) - len(chosen),
+            }
+        report['total'] = {'used': sum(r['used'] for r in report.values()),
+                           'window': self.context_window}
+        return kept, report
+
+    def fill_section(self, section: PromptSection, budget: int):
+        chosen = {}
+        used = 0
+        for index in section.priority_order:
+            item = section.items[index]
+            cost = self.count(section.render(item))
+            if used + cost <= budget:
+                chosen[index] = item
+                used += cost
+            elif (section.required and not chosen and isinstance(item, str)
+                  and budget - used > self.MESSAGE_OVERHEAD):
+                item = self.truncate(item, budget - used)
+                chosen[index] = item
+                used += self.count(item)
+        return [chosen[index] for index in sorted(chosen)], used
+
+    def truncate(self, text: str, budget: int) -> str:
+        """Cut text down to roughly `budget` tokens."""
+        limit = max(0, budget - self.MESSAGE_OVERHEAD)
+        tokens = self.tokenizer.count(text)
+        while tokens > limit and text:
+            text = text[:int(len(text) * limit / tokens)]
+            tokens = self.tokenizer.count(text)
+        return text
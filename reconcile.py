@@ -0,0 +1,56 @@
+import os
+import asyncio
+import argparse
+
+from terminal_output_handler import TerminalOutputHandler
+from chat_history.history_log import HistoryLog
+from chat_history.loggers import session_path, DEFAULT_SESSION
+from chat_history.embedding_executor import EmbeddingExecutor
+from chat_history.reconciler import HistoryReconciler
+from chat_history.vector_storage import VectorStorageBase, DEFAULT_VECTOR_MODEL
+
+
+async def reconcile(args):
+    output_handler = TerminalOutputHandler()
+    chat_logger = HistoryLog(output_handler, db_name=args.db, file_name=args.history, session_id=args.session)
+    await chat_logger.init_db()
+    # Encoding runs in worker processes that each load the model, so this process never does
+    executor = EmbeddingExecutor(workers=args.workers, max_batch_size=args.batch_size, use_processes=True,
+                                 model_name=args.model)
+    storage = VectorStorageBase(vector_file=session_path(args.index, args.session), model_name=args.model,
+                                embedding_executor=executor)
+    reconciler = HistoryReconciler(chat_logger, storage)
+
+    report = await reconciler.diff()
+    print(f"Only in {args.history}: {len(report['missing_in_db'])}")
+    print(f"Only in {args.db}: {len(report['missing_in_file'])}")
+    print(f"Entries without a vector: {len(report['unvectorized'])}")
+    print(f"Entries pointing at a missing vector: {len(report['dangling'])}")
+    print(f"Entries sharing another entry's vector: {len(report['shared'])}")
+    print(f"Vectors no entry points to: {len(report['orphaned'])}")
+
+    if args.repair:
+        result = await reconciler.repair(report, batch_size=args.batch_size)
+        print(f"Restored {result['restored_to_db']} entries to the database "
+              f"and {result['restored_to_file']} to the history file")
+        print(f"Removed {result['orphans_removed']} orphaned vectors")
+        print(f"Encoded {result['encoded']} entries in {result['batches']} batches on {args.workers} workers: "
+              f"{result['encode_seconds']:.1f}s, {result['entries_per_second']:.0f} entries/s")
+        print(f"Done in {result['total_seconds']:.1f}s")
+    await storage.close()
+    await chat_logger.close()
+
+
+if __name__ == "__main__":
+    os.environ["TOKENIZERS_PARALLELISM"] = 'false'
+    parser = argparse.ArgumentParser(
+        description="Compare the chat history file, database and vector index, and repair drift between them.")
+    parser.add_argument('--history', default='chat_history.jsonl', help="Chat history JSONL file")
+    parser.add_argument('--db', default='logs/chat_db', help="Chat history SQLite database")
+    parser.add_argument('--index', default='chat_vectors.index', help="Chat vector index checkpoint")
+    parser.add_argument('--session', default=DEFAULT_SESSION, help="Conversation to reconcile")
+    parser.add_argument('--model', default=DEFAULT_VECTOR_MODEL, help="Sentence model to encode with")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Encoding processes")
+    parser.add_argument('--batch-size', type=int, default=256, help="Entries per call to the model")
+    parser.add_argument('--repair', action='store_true', help="Repair the drift found, not just report it")
+    asyncio.run(reconcile(parser.parse_args()))
@@ -0,0 +1,177 @@
+import re
+import json
+import time
+import hashlib
+from collections import OrderedDict
+
+import faiss
+import numpy as np
+
+from chat_history.vector_storage import VectorStorageBase
+
+
+class ResponseCache(VectorStorageBase):
+    """
+    Opt-in cache of chat responses keyed on the user's input and the turns before it.
+
+    The input and its preceding `context_turns` messages form the cache prompt, so
+    "yes" after one question never answers "yes" after another. Inputs shorter
+    than `min_words` are not cached at all, since they mean little on their own.
+    Lookups try an exact hash of the normalised prompt first, then the nearest
+    cached prompt embedding in an in-memory FAISS index. Entries are evicted in
+    least recently used order once `max_entries` is reached, or when older than
+    `ttl` seconds. The whole cache is dropped when the world state changes enough
+    that old answers are likely stale.
+
+    Prompts are embedded through `vector_storage`, on its executor and embedding cache,
+    so neither building the cache nor a lookup loads or runs the model on the event
+    loop. Until the model has loaded, only exact hits are found, and responses are
+    stored for exact hits only.
+    """
+
+    def __init__(self, vector_storage: VectorStorageBase = None, vector_model=None, similarity_threshold=0.92,
+                 max_entries=256, ttl=3600, world_state_change_threshold=0.5, context_turns=2, min_words=3,
+                 clock=time.monotonic):
+        """
+        :param vector_storage: Storage whose model, loaded in the background, encodes the prompts;
+            defaults to this cache itself.
+        :param vector_model: Sentence embedding model, used when no vector_storage is given.
+        :param similarity_threshold: Minimum cosine similarity for a semantic hit.
+        :param max_entries: Number of responses kept before the least recently used is evicted.
+        :param ttl: Seconds a response stays valid, or None to keep it until evicted.
+        :param world_state_change_threshold: Fraction of world state keys that must change to invalidate the cache.
+        :param context_turns: Number of preceding messages that are part of the cache key.
+        :param min_words: Inputs with fewer words are never cached.
+        :param clock: Function returning the current time in seconds.
+        """
+        super().__init__(vector_model=vector_model, vector_file=None)
+        self.encoder = vector_storage or self
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.world_state_change_threshold = world_state_change_threshold
+        self.context_turns = context_turns
+        self.min_words = min_words
+        self.clock = clock
+        self.entries = OrderedDict()  # Key -> {"response", "created"}, least recently used first
+        self.keys_by_position = []  # FAISS position -> key
+        self.world_state_fingerprint = None
+        self.stats = {'exact_hits': 0, 'semantic_hits': 0, 'misses': 0, 'skipped': 0,
+                      'evictions': 0, 'invalidations': 0}
+
+    @staticmethod
+    def new_index():
+        # Entries are found by position through keys_by_position, so no ids are needed
+        return faiss.IndexFlatL2(768)
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return re.sub(r'\s+', ' ', text).strip().lower()
+
+    def key_for(self, text: str) -> str:
+        return hashlib.sha256(self.normalize(text).encode('utf-8')).hexdigest()
+
+    def cache_prompt(self, user_input: str, context=()) -> str:
+        """The text that is hashed and embedded: the preceding turns followed by the input."""
+        lines = [f"{message['role']}: {message['content']}" for message in context]
+        lines.append(f"user: {user_input}")
+        return '\n'.join(lines)
+
+    def is_cacheable(self, user_input: str) -> bool:
+        return len(user_input.split()) >= self.min_words
+
+    async def encode(self, text: str):
+        vector = np.array(await self.encoder.encode_async(self.normalize(text))).astype('float32').reshape(1, -1)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    async def lookup(self, user_input: str, context=()):
+        """
+        Find a cached response for the input in this context.
+
+        :param user_input: Input from the user.
+        :param context: Recent chat messages before the input, oldest first.
+        :return: Tuple of the cached response or None, and the prompt's embedding (or None on
+            an exact hit, a skip or before the model loads) so a miss can be stored without encoding twice.
+        """
+        if not self.is_cacheable(user_input):
+            self.stats['skipped'] += 1
+            return None, None
+        self.expire()
+        prompt = self.cache_prompt(user_input, context)
+        key = self.key_for(prompt)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.stats['exact_hits'] += 1
+            return self.entries[key]['response'], None
+
+        if not self.encoder.model_ready:
+            self.stats['misses'] += 1
+            return None, None
+        vector = await self.encode(prompt)
+        if self.vector_index.ntotal:
+            distances, positions = self.vector_index.search(vector, 1)
+            # Vectors are unit length, so squared L2 distance d gives cosine similarity 1 - d / 2
+            similarity = 1 - distances[0][0] / 2
+            if positions[0][0] >= 0 and similarity >= self.similarity_threshold:
+                match = self.keys_by_position[positions[0][0]]
+                self.entries.move_to_end(match)
+                self.stats['semantic_hits'] += 1
+                return self.entries[match]['response'], vector
+
+        self.stats['misses'] += 1
+        return None, vector
+
+    async def store(self, user_input: str, response: str, vector=None, context=()):
+        """Cache a response, evicting the least recently used entry if the cache is full."""
+        if not self.is_cacheable(user_input):
+            return
+        prompt = self.cache_prompt(user_input, context)
+        key = self.key_for(prompt)
+        if key in self.entries:
+            self.entries[key] = {'response': response, 'created': self.clock()}
+            self.entries.move_to_end(key)
+            return
+        while len(self.entries) >= self.max_entries:
+            self.evict(next(iter(self.entries)))
+        if vector is None and self.encoder.model_ready:
+            vector = await self.encode(prompt)
+        if vector is not None:
+            self.vector_index.add(vector)
+            self.keys_by_position.append(key)
+        self.entries[key] = {'response': response, 'created': self.clock()}
+
+    def evict(self, key: str):
+        if key in self.keys_by_position:  # Entries stored before the model loaded have no vector
+            position = self.keys_by_position.index(key)
+            # Flat indexes compact on removal, so positions after this one shift down by one like the list
+            self.vector_index.remove_ids(np.array([position], dtype='int64'))
+            del self.keys_by_position[position]
+        del self.entries[key]
+        self.stats['evictions'] += 1
+
+    def expire(self):
+        if self.ttl is None:
+            return
+        cutoff = self.clock() - self.ttl
+        for key in [key for key, entry in self.entries.items() if entry['created'] < cutoff]:
+            self.evict(key)
+
+    def invalidate(self):
+        """Drop every cached response."""
+        self.entries.clear()
+        self.keys_by_position = []
+        self.vector_index.reset()
+        self.stats['invalidations'] += 1
+
+    def observe_world_state(self, state: dict):
+        """Invalidate the cache if enough of the world state has changed since it was last seen."""
+        fingerprint = {key: json.dumps(value, sort_keys=True)
+                       for key, value in state.items() if key != 'errors'}
+        previous, self.world_state_fingerprint = self.world_state_fingerprint, fingerprint
+        if previous is None or not self.entries:
+            return
+        keys = set(previous) | set(fingerprint)
+        changed = sum(1 for key in keys if previous.get(key) != fingerprint.get(key))
+        if keys and changed / len(keys) >= self.world_state_change_threshold:
+            self.invalidate()
@@ -9,12 +9,21 @@ class TerminalOutputHandler(OutputHandler):
         "chatbot": "\033[92m",  # Green for chatbot responses
         "reset": "\033[0m"      # Reset to default color
     }
+
+    def __init__(self):
+        super().__init__()
+        self.streaming = False
+        self.held_messages = []
+
     # Theoretically this should queue the output for rendering at the next time
     # but we can just print here as this is more for sync processes allowing them to interact with async
     # and we dont care here.
     def queue_output(self, message: str, message_type: str='reset'):
         color = self.COLORS.get(message_type, self.COLORS["reset"])
         formatted_message = f"{color}{message}{self.COLORS['reset']}"
+        if self.streaming:
+            self.held_messages.append(formatted_message)
+            return
         print(formatted_message)
 
     async def send_output(self, message: str, message_type: str = "reset"):
@@ -23,6 +32,11 @@ class TerminalOutputHandler(OutputHandler):
         color = self.COLORS.get(message_type, self.COLORS["reset"])
         formatted_message = f"{color}{message}{self.COLORS['reset']}"
 
+        # Hold messages from background tasks so they don't break into a streaming response
+        if self.streaming:
+            self.held_messages.append(formatted_message)
+            return
+
         # Simulate asynchronous output handling
         loop = asyncio.get_running_loop()
         try:
@@ -31,6 +45,23 @@ class TerminalOutputHandler(OutputHandler):
             # Handle any exceptions that occur during printing
             print(f"{self.COLORS['error']}Error printing message: {e}{self.COLORS['reset']}")
 
+    async def stream_output(self, chunk: str, message_type: str = "chatbot"):
+        """Print a chunk of a streaming message straight away, without a trailing newline."""
+        if not self.streaming:
+            self.streaming = True
+            chunk = self.COLORS.get(message_type, self.COLORS["reset"]) + chunk.lstrip()
+        print(chunk, end='', flush=True)
+
+    async def end_stream(self, message_type: str = "chatbot"):
+        """Close the streaming message and print anything held back while it was rendering."""
+        if not self.streaming:
+            return
+        self.streaming = False
+        print(self.COLORS['reset'], flush=True)
+        held, self.held_messages = self.held_messages, []
+        for message in held:
+            print(message)
+
 # Example Usage
 if __name__ == "__main__":
     output_handler = TerminalOutputHandler()
@@ -0,0 +1,110 @@
+import asyncio
+
+from debug_logger import DebugLogger
+from chat_history.world_state_manager import WorldStateManager
+
+
+class WorldStatePolicy:
+    """Which world state a prompt is built against while a prediction is still running."""
+    COMMITTED = "committed"  # Use the last committed world state and never wait
+    IN_FLIGHT = "in_flight"  # Wait for the running prediction to commit before building the prompt
+
+
+class TurnScheduler:
+    """
+    Runs world state predictions as background tasks alongside the next turn.
+
+    At most one prediction is in flight. Starting a new one first cancels the
+    previous prediction and merges whatever it produced, so results are always
+    committed through `WorldStateManager.update_world_state` in turn order.
+    Fields are staged on the manager as soon as they are parsed, so even a
+    prediction cancelled mid-stream contributes every field it completed.
+    """
+
+    def __init__(self, ai, world_state_manager: WorldStateManager, debug_logger: DebugLogger,
+                 policy=WorldStatePolicy.COMMITTED, in_flight_timeout=None):
+        """
+        :param ai: The AIImplementation used to stream predictions.
+        :param world_state_manager: The manager predictions are committed to.
+        :param debug_logger: The debug logger
+        :param policy: A WorldStatePolicy value.
+        :param in_flight_timeout: Seconds to wait for an in flight prediction under
+            WorldStatePolicy.IN_FLIGHT before falling back to the committed state, or None to wait fully.
+        """
+        self.ai = ai
+        self.world_state_manager = world_state_manager
+        self.debug_logger = debug_logger
+        self.policy = policy
+        self.in_flight_timeout = in_flight_timeout
+        self.prediction_task = None
+        self.commit_lock = asyncio.Lock()
+        self.turn = 0
+        self.committed_turn = 0
+
+    @property
+    def prediction_in_flight(self) -> bool:
+        return self.prediction_task is not None and not self.prediction_task.done()
+
+    async def prepare_prompt(self):
+        """Apply the world state policy before a prompt is built for a new turn."""
+        if self.policy != WorldStatePolicy.IN_FLIGHT or not self.prediction_in_flight:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(self.prediction_task), self.in_flight_timeout)
+        except asyncio.TimeoutError:
+            await self.debug_logger.log("World state prediction still running, using the committed state.")
+
+    async def schedule_world_state(self, user_input: str):
+        """Settle any running prediction, then start predicting the world state for this turn."""
+        await self.settle()
+        self.turn += 1
+        self.prediction_task = asyncio.create_task(self.run_prediction(self.turn, user_input))
+        return self.prediction_task
+
+    async def settle(self):
+        """Cancel the in flight prediction, if any, and wait until its partial result is committed."""
+        task = self.prediction_task
+        if task is None:
+            return
+        if not task.done() and not self.commit_lock.locked():
+            # Only the model stream is cancelled; a commit that has started always completes
+            await self.debug_logger.log("Wrapping up world state generation.")
+            task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            if self.world_state_manager.pending_world_state:
+                await self.commit(self.turn, {}, [], partial=True)
+            else:
+                await self.debug_logger.log("Generation task was successfully cancelled with no partial data.")
+        self.prediction_task = None
+
+    async def run_prediction(self, turn: int, user_input: str):
+        prediction, errors = await self.ai.get_prediction_streaming(
+            user_input=user_input,
+            is_cancelled=lambda: False,
+            on_field=self.world_state_manager.stage_world_state)
+        # The model stream swallows cancellation and hands back what it produced so far
+        cancelled = asyncio.current_task().cancelling() > 0
+        await self.commit(turn, prediction, errors, partial=cancelled)
+
+    async def commit(self, turn: int, prediction, errors, partial=False):
+        """Merge a prediction into the world state, ignoring results older than the last commit."""
+        async with self.commit_lock:
+            staged = self.world_state_manager.take_pending_world_state()
+            if turn < self.committed_turn:
+                await self.debug_logger.log(f"Dropping stale world state prediction for turn {turn}.")
+                return
+            self.committed_turn = turn
+            prediction = {**staged, **(prediction or {})}
+            if prediction:
+                if partial:
+                    await self.debug_logger.log("Partial data retained after cancellation.")
+                await self.world_state_manager.update_world_state(prediction)
+            elif not partial:
+                await self.world_state_manager.update_world_state({'errors': [errors]})
+            if partial:
+                await self.debug_logger.log("Generation interrupted by user feedback.")
+
+    async def close(self):
+        await self.settle()